@@ -3,7 +3,7 @@ from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
-SECRET_KEY = 'django-insecure-1234567890abcdef'
+SECRET_KEY = os.getenv('SECRET_KEY', 'django-insecure-1234567890abcdef')
 
 DEBUG = True
 
@@ -20,15 +20,27 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+  # Первой, чтобы в замер попали все остальные middleware (recipes/instrumentation.py)
+  'recipes.instrumentation.InstrumentationMiddleware',
   'django.middleware.security.SecurityMiddleware',
   'django.contrib.sessions.middleware.SessionMiddleware',
   'django.middleware.common.CommonMiddleware',
   'django.middleware.csrf.CsrfViewMiddleware',
   'django.contrib.auth.middleware.AuthenticationMiddleware',
+  'recipes.plan_state.PlanStateMiddleware',
   'django.contrib.messages.middleware.MessageMiddleware',
   'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Сессия хранит только вход и живет на сервере: выход из аккаунта ее
+# действительно отзывает. cached_db читает ее из общего кэша recipes, в
+# базу пишет только при входе и выходе. Фильтры, выбранные блюда и очереди
+# подбора меняются на каждом обновлении блюда и лежат в отдельной
+# подписанной cookie (recipes/plan_state.py), поэтому обновление не пишет
+# в django_session. Просроченные сессии чистит manage.py clear_stale_sessions.
+SESSION_ENGINE = os.getenv('SESSION_ENGINE', 'django.contrib.sessions.backends.cached_db')
+SESSION_CACHE_ALIAS = 'recipes'
+
 ROOT_URLCONF = 'foodplan.urls'
 
 TEMPLATES = [
@@ -49,13 +61,62 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'foodplan.wsgi.application'
 
-DATABASES = {
-  'default': {
-    'ENGINE': 'django.db.backends.sqlite3',
-    'NAME': BASE_DIR / 'db.sqlite3',
-  }
+# Профиль базы задается DATABASE_PROFILE: sqlite (по умолчанию) или postgres.
+#
+# sqlite: каждое новое соединение включает WAL (читатели не ждут писателя),
+# synchronous=NORMAL, mmap и ожидание блокировки вместо мгновенной ошибки
+# "database is locked". Транзакции открываются как BEGIN IMMEDIATE, чтобы
+# запись не падала при повышении блокировки с чтения до записи.
+#
+# postgres: нужен psycopg (pip install "psycopg[binary,pool]"). Соединения
+# либо переиспользуются между запросами (DB_CONN_MAX_AGE) с проверкой
+# живости, либо берутся из пула psycopg при POSTGRES_POOL_MAX_SIZE > 0 —
+# Django не допускает одновременно пул и постоянные соединения.
+DATABASE_PROFILE = os.getenv('DATABASE_PROFILE', 'sqlite')
+
+SQLITE_PRAGMAS = {
+  'journal_mode': 'WAL',
+  'synchronous': 'NORMAL',
+  'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+  'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 128 * 1024 * 1024)),
 }
 
+SQLITE_OPTIONS = {
+  'init_command': ';'.join(f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items()),
+  'transaction_mode': 'IMMEDIATE',
+  'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000,
+}
+
+if DATABASE_PROFILE == 'postgres':
+  POSTGRES_POOL_MAX_SIZE = int(os.getenv('POSTGRES_POOL_MAX_SIZE', 0))
+  DATABASES = {
+    'default': {
+      'ENGINE': 'django.db.backends.postgresql',
+      'NAME': os.getenv('POSTGRES_DB', 'foodplan'),
+      'USER': os.getenv('POSTGRES_USER', 'foodplan'),
+      'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+      'HOST': os.getenv('POSTGRES_HOST', 'localhost'),
+      'PORT': os.getenv('POSTGRES_PORT', '5432'),
+      'CONN_MAX_AGE': 0 if POSTGRES_POOL_MAX_SIZE else int(os.getenv('DB_CONN_MAX_AGE', 60)),
+      'CONN_HEALTH_CHECKS': True,
+      'OPTIONS': {
+        'pool': {
+          'min_size': int(os.getenv('POSTGRES_POOL_MIN_SIZE', 2)),
+          'max_size': POSTGRES_POOL_MAX_SIZE,
+          'timeout': int(os.getenv('POSTGRES_POOL_TIMEOUT', 10)),
+        },
+      } if POSTGRES_POOL_MAX_SIZE else {},
+    }
+  }
+else:
+  DATABASES = {
+    'default': {
+      'ENGINE': 'django.db.backends.sqlite3',
+      'NAME': os.getenv('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+      'OPTIONS': SQLITE_OPTIONS,
+    }
+  }
+
 AUTH_PASSWORD_VALIDATORS = [
   {
     'NAME': (
@@ -74,6 +135,17 @@ STATICFILES_DIRS = [
 ]
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
+# Продакшен-сборка статики (foodplan/staticfiles.py): STATIC_MANIFEST=1
+# python manage.py collectstatic добавляет хэши к именам и собирает WebP/AVIF,
+# .gz и .br; wsgi.py раздает результат с Cache-Control immutable.
+# Без сборки (разработка, тесты) статика берется из static/ как есть.
+STATIC_MANIFEST = os.environ.get('STATIC_MANIFEST') == '1'
+if STATIC_MANIFEST:
+  STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'foodplan.staticfiles.OptimizedManifestStaticFilesStorage'},
+  }
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
@@ -84,6 +156,84 @@ USE_TZ = True
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Кэш рецептов и фрагментов карточек (recipes/recipe_cache.py), снимков
+# страницы подбора, версии индекса кандидатов и сессий.
+# RECIPES_CACHE_BACKEND: file (по умолчанию) или db — общий для всех
+# воркеров без отдельного сервиса (для db сначала выполнить
+# manage.py createcachetable); locmem — свой кэш у каждого процесса,
+# годится только при одном процессе: сбросы в нем не видны соседям.
+RECIPES_CACHE_BACKENDS = {
+  'locmem': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'recipes',
+  },
+  'file': {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.getenv('RECIPES_CACHE_LOCATION', str(BASE_DIR / 'cache')),
+  },
+  'db': {
+    'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+    'LOCATION': os.getenv('RECIPES_CACHE_LOCATION', 'recipes_cache'),
+  },
+}
+
+CACHES = {
+  'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+  },
+  'recipes': {
+    **RECIPES_CACHE_BACKENDS[os.getenv('RECIPES_CACHE_BACKEND', 'file')],
+    'OPTIONS': {'MAX_ENTRIES': int(os.getenv('RECIPES_CACHE_MAX_ENTRIES', 10000))},
+  },
+}
+
+RECIPES_FRAGMENT_CACHE = 'recipes'
+RECIPES_FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# HTTP-кэширование страниц (recipes/page_cache.py): сколько секунд браузер
+# и прокси держат анонимную страницу без перепроверки и сколько живет
+# готовая главная для анонимов в кэше RECIPES_FRAGMENT_CACHE
+RECIPES_PAGE_MAX_AGE = int(os.getenv('RECIPES_PAGE_MAX_AGE', 60))
+RECIPES_PAGE_CACHE_TIMEOUT = int(os.getenv('RECIPES_PAGE_CACHE_TIMEOUT', 60 * 10))
+
+# Снимки состояния профиля для страницы подбора (recipes/plan_cache.py).
+# Кэш должен быть общим, иначе воркер покажет снимок, устаревший после
+# изменения в соседнем; в locmem снимок живет не дольше минуты.
+RECIPES_PLAN_CACHE = 'recipes'
+RECIPES_PLAN_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Индекс кандидатов (recipes/candidates.py). Алиас общего кэша, через
+# который версия индекса сбрасывается во всех процессах; None держит ее в
+# памяти процесса и годится только для запуска в один процесс. SHARED
+# дополнительно кладет в этот кэш построенный индекс, чтобы его не
+# пересобирал каждый воркер.
+RECIPES_CANDIDATE_INDEX_CACHE = 'recipes'
+RECIPES_CANDIDATE_INDEX_SHARED = False
+
+# Лимиты обновлений блюд (recipes/quota.py). Для нагруженных инсталляций:
+# RECIPES_QUOTA_BACKEND = 'recipes.quota.CacheTokenBucketQuota' и в
+# RECIPES_QUOTA_CACHE алиас кэша Redis или Memcached; с другими кэшами
+# этот бэкенд не запускается, потому что не держит лимит между воркерами.
+RECIPES_QUOTA_BACKEND = 'recipes.quota.DatabaseQuota'
+RECIPES_QUOTA_CACHE = 'default'
+
+# Массовые действия админки над выборкой больше этого размера выполняются
+# фоновой задачей (recipes/bulk_actions.py, manage.py run_bulk_jobs)
+RECIPES_BULK_ACTION_THRESHOLD = 5000
+
+# Потоки, собирающие уменьшенные копии изображений рецептов после загрузки
+# (recipes/images.py); 0 — собирать сразу в потоке запроса
+RECIPES_IMAGE_WORKERS = int(os.environ.get('RECIPES_IMAGE_WORKERS', 2))
+
+# Замеры запросов (recipes/instrumentation.py): порог медленного запроса
+# и после скольких повторов одного SQL писать предупреждение
+RECIPES_SLOW_REQUEST_MS = int(os.getenv('RECIPES_SLOW_REQUEST_MS', 500))
+RECIPES_DUPLICATE_QUERY_THRESHOLD = int(os.getenv('RECIPES_DUPLICATE_QUERY_THRESHOLD', 3))
+# /metrics/ отдается только с заголовком Authorization: Bearer <токен>.
+# Без токена страница выключена: за обратным прокси адрес клиента
+# всегда локальный, так что проверка по IP ничего не закрывает
+RECIPES_METRICS_TOKEN = os.getenv('RECIPES_METRICS_TOKEN', '')
+
 LOGGING = {
   'version': 1,
   'disable_existing_loggers': False,
@@ -99,7 +249,8 @@ LOGGING = {
   'loggers': {
     'recipes.views': {
       'handlers': ['console'],
-      'level': 'INFO',
+      # DEBUG добавляет строку замера для каждого запроса, а не только для медленных
+      'level': os.getenv('RECIPES_VIEWS_LOG_LEVEL', 'INFO'),
       'propagate': False,
     },
   },
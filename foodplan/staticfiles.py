@@ -0,0 +1,229 @@
+"""Сборка и раздача статики для продакшена.
+
+OptimizedManifestStaticFilesStorage — хранилище для collectstatic: к
+имени каждого файла добавляется хэш содержимого (ManifestStaticFilesStorage),
+затем для хэшированных файлов рядом пишутся:
+
+- name.webp и name.avif для JPEG и PNG, если они меньше оригинала;
+- name.gz и, если установлен пакет brotli, name.br для текстовых
+  форматов, если сжатие дает выигрыш.
+
+Все делает Pillow и стандартная библиотека, сеть не нужна. Уже собранные
+варианты не пересобираются, пока не изменится исходный файл.
+
+ImmutableStaticFiles — WSGI-обертка, которая раздает STATIC_ROOT сама, не
+доходя до Django. Хэшированные файлы отдаются с Cache-Control immutable
+на год, остальные — на час. По Accept и Accept-Encoding выбирается
+лучший из собранных вариантов, ответ помечается Vary.
+"""
+import gzip
+import json
+import mimetypes
+import posixpath
+from email.utils import formatdate, parsedate_to_datetime
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from PIL import Image, features
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+TEXT_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.html', '.json', '.xml', '.pdf')
+# Сжатые копии меньше этого размера не окупают лишний файл
+MIN_COMPRESS_SIZE = 256
+IMAGE_FORMATS = {
+  '.avif': ('AVIF', 'image/avif', {'quality': 55}),
+  '.webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 6}),
+}
+ENCODINGS = {'.br': 'br', '.gz': 'gzip'}
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+SHORT_LIVED = 'public, max-age=3600'
+
+
+def _is_fresh(target, source):
+  return target.exists() and target.stat().st_mtime >= source.stat().st_mtime
+
+
+def _write_smaller(target, data, source_size):
+  if len(data) < source_size:
+    target.write_bytes(data)
+    return True
+  return False
+
+
+def write_image_variants(path):
+  """Пишет WebP и AVIF рядом с картинкой; возвращает имена созданных файлов."""
+  written = []
+  formats = {suffix: spec for suffix, spec in IMAGE_FORMATS.items()
+             if features.check(spec[0].lower())}
+  pending = {suffix: spec for suffix, spec in formats.items()
+             if not _is_fresh(Path(f'{path}{suffix}'), path)}
+  if not pending:
+    return written
+  with Image.open(path) as image:
+    image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+      image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    for suffix, (pil_format, _, options) in pending.items():
+      buffer = BytesIO()
+      # PNG — обычно графика с резкими краями, сохраняем без потерь
+      lossless = pil_format == 'WEBP' and path.suffix.lower() == '.png'
+      image.save(buffer, pil_format, **({'lossless': True} if lossless else options))
+      if _write_smaller(Path(f'{path}{suffix}'), buffer.getvalue(), path.stat().st_size):
+        written.append(f'{path.name}{suffix}')
+  return written
+
+
+def write_compressed(path):
+  """Пишет .gz и .br рядом с текстовым файлом; возвращает имена созданных файлов."""
+  written = []
+  size = path.stat().st_size
+  if size < MIN_COMPRESS_SIZE:
+    return written
+  compressors = {'.gz': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+  if brotli is not None:
+    compressors['.br'] = lambda data: brotli.compress(data, quality=11)
+  data = None
+  for suffix, compress in compressors.items():
+    target = Path(f'{path}{suffix}')
+    if _is_fresh(target, path):
+      continue
+    if data is None:
+      data = path.read_bytes()
+    if _write_smaller(target, compress(data), size * 0.95):
+      written.append(target.name)
+  return written
+
+
+class OptimizedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+  # В шаблонах есть ссылки на файлы, которых нет в static/; без этого
+  # такая страница падала бы вместо битой картинки
+  manifest_strict = False
+
+  def post_process(self, paths, dry_run=False, **options):
+    yield from super().post_process(paths, dry_run=dry_run, **options)
+    if dry_run:
+      return
+    for hashed_name in sorted(set(self.hashed_files.values())):
+      path = Path(self.path(hashed_name))
+      if not path.exists():
+        continue
+      suffix = path.suffix.lower()
+      if suffix in IMAGE_EXTENSIONS:
+        created = write_image_variants(path)
+      elif suffix in TEXT_EXTENSIONS:
+        created = write_compressed(path)
+      else:
+        continue
+      for name in created:
+        yield name, posixpath.join(posixpath.dirname(hashed_name), name), True
+
+
+def _accepts(header, token):
+  return any(part.split(';')[0].strip() == token for part in header.split(','))
+
+
+class ImmutableStaticFiles:
+  """WSGI-обертка, раздающая STATIC_ROOT с кэшированием и согласованием формата."""
+
+  def __init__(self, application, root=None, prefix=None):
+    self.application = application
+    self.root = Path(root or settings.STATIC_ROOT).resolve()
+    self.prefix = prefix or settings.STATIC_URL
+    if not self.prefix.startswith('/'):
+      self.prefix = f'/{self.prefix}'
+    self.hashed = self._load_manifest()
+
+  def _load_manifest(self):
+    manifest = self.root / ManifestStaticFilesStorage.manifest_name
+    try:
+      return frozenset(json.loads(manifest.read_text())['paths'].values())
+    except (OSError, ValueError, KeyError):
+      return frozenset()
+
+  def __call__(self, environ, start_response):
+    path = environ.get('PATH_INFO', '')
+    if environ['REQUEST_METHOD'] not in ('GET', 'HEAD') or not path.startswith(self.prefix):
+      return self.application(environ, start_response)
+    name = unquote(path[len(self.prefix):])
+    source = (self.root / name).resolve()
+    if self.root not in source.parents or not source.is_file():
+      return self.application(environ, start_response)
+    return self._serve(environ, start_response, name, source)
+
+  def _choose(self, environ, source):
+    """(путь, Content-Type, Content-Encoding или None, Vary)."""
+    content_type = mimetypes.guess_type(source.name)[0] or 'application/octet-stream'
+    suffix = source.suffix.lower()
+    if suffix in IMAGE_EXTENSIONS:
+      accept = environ.get('HTTP_ACCEPT', '')
+      for variant_suffix, (_, mime, _) in IMAGE_FORMATS.items():
+        variant = Path(f'{source}{variant_suffix}')
+        if _accepts(accept, mime) and variant.is_file():
+          return variant, mime, None, 'Accept'
+      return source, content_type, None, 'Accept'
+    if suffix in TEXT_EXTENSIONS:
+      accept_encoding = environ.get('HTTP_ACCEPT_ENCODING', '')
+      for encoding_suffix, encoding in ENCODINGS.items():
+        variant = Path(f'{source}{encoding_suffix}')
+        if _accepts(accept_encoding, encoding) and variant.is_file():
+          return variant, content_type, encoding, 'Accept-Encoding'
+      return source, content_type, None, 'Accept-Encoding'
+    return source, content_type, None, None
+
+  def _serve(self, environ, start_response, name, source):
+    path, content_type, encoding, vary = self._choose(environ, source)
+    stat = path.stat()
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = [
+      ('Cache-Control', IMMUTABLE if name in self.hashed else SHORT_LIVED),
+      ('ETag', etag),
+      ('Last-Modified', formatdate(stat.st_mtime, usegmt=True)),
+    ]
+    if vary:
+      headers.append(('Vary', vary))
+
+    if self._not_modified(environ, etag, stat.st_mtime):
+      start_response('304 Not Modified', headers)
+      return []
+
+    headers += [('Content-Type', content_type), ('Content-Length', str(stat.st_size))]
+    if encoding:
+      headers.append(('Content-Encoding', encoding))
+    start_response('200 OK', headers)
+    if environ['REQUEST_METHOD'] == 'HEAD':
+      return []
+    file = open(path, 'rb')
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+      return file_wrapper(file, 64 * 1024)
+    return _iter_file(file)
+
+  @staticmethod
+  def _not_modified(environ, etag, mtime):
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+      return if_none_match.strip() == '*' or etag in [value.strip() for value in
+                                                     if_none_match.split(',')]
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+      try:
+        return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+      except (TypeError, ValueError):
+        return False
+    return False
+
+
+def _iter_file(file):
+  with file:
+    while chunk := file.read(64 * 1024):
+      yield chunk
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodplan.settings')
 
 application = get_wsgi_application()
+
+# Собранная collectstatic статика отдается в обход Django с долгим кэшем
+from foodplan.staticfiles import ImmutableStaticFiles  # noqa: E402
+
+application = ImmutableStaticFiles(application)
@@ -1,7 +1,20 @@
 from django.contrib import admin
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.html import format_html
-from .models import Recipe, Ingredient, UserProfile
+from . import bulk_actions, candidates, images, plan_cache, quota, recipe_cache
+from .models import Allergen, BulkJob, LikedRecipe, Recipe, Ingredient, UserProfile
+
+
+def _through_count(through):
+  counts = (through.objects
+            .filter(userprofile=OuterRef('pk'))
+            .order_by()
+            .values('userprofile')
+            .annotate(count=Count('*'))
+            .values('count'))
+  return Coalesce(Subquery(counts), Value(0))
 
 
 @admin.register(Recipe)
@@ -18,31 +31,48 @@ class RecipeAdmin(admin.ModelAdmin):
   actions = ['make_vegetarian', 'make_non_vegetarian', 'make_gluten_free',
              'make_non_gluten_free']
 
+  def get_queryset(self, request):
+    return super().get_queryset(request).annotate(_like_count=Count('liked_by'))
+
   def like_count(self, obj):
-    return obj.liked_by.count()
+    return obj._like_count
   like_count.short_description = 'Количество лайков'
+  like_count.admin_order_field = '_like_count'
 
   def image_preview(self, obj):
-    if obj.image:
-      return format_html('<img src="{}" style="max-height: 50px;" />',
-                        obj.image.url)
+    image = images.variant(obj, 'thumb')
+    if image:
+      return format_html('<img src="{}" style="max-height: 50px;" loading="lazy" />',
+                        image['jpeg'])
     return 'Нет изображения'
   image_preview.short_description = 'Превью'
 
   def make_vegetarian(self, request, queryset):
-    queryset.update(is_vegetarian=True)
+    recipe_ids = list(queryset.values_list('id', flat=True))
+    queryset.update(is_vegetarian=True, updated_at=timezone.now())
+    candidates.invalidate()
+    recipe_cache.bump(recipe_ids)
   make_vegetarian.short_description = 'Пометить как вегетарианское'
 
   def make_non_vegetarian(self, request, queryset):
-    queryset.update(is_vegetarian=False)
+    recipe_ids = list(queryset.values_list('id', flat=True))
+    queryset.update(is_vegetarian=False, updated_at=timezone.now())
+    candidates.invalidate()
+    recipe_cache.bump(recipe_ids)
   make_non_vegetarian.short_description = 'Пометить как невегетарианское'
 
   def make_gluten_free(self, request, queryset):
-    queryset.update(no_gluten=True)
+    recipe_ids = list(queryset.values_list('id', flat=True))
+    queryset.update(no_gluten=True, updated_at=timezone.now())
+    candidates.invalidate()
+    recipe_cache.bump(recipe_ids)
   make_gluten_free.short_description = 'Пометить как безглютеновое'
 
   def make_non_gluten_free(self, request, queryset):
-    queryset.update(no_gluten=False)
+    recipe_ids = list(queryset.values_list('id', flat=True))
+    queryset.update(no_gluten=False, updated_at=timezone.now())
+    candidates.invalidate()
+    recipe_cache.bump(recipe_ids)
   make_non_gluten_free.short_description = 'Пометить как содержащее глютен'
 
 
@@ -51,9 +81,31 @@ class IngredientAdmin(admin.ModelAdmin):
   list_display = ('name', 'weight', 'cost')
   search_fields = ('name',)
   list_editable = ('weight', 'cost')
+  list_filter = ('allergens',)
+  filter_horizontal = ('allergens',)
   ordering = ('name',)
 
 
+@admin.register(Allergen)
+class AllergenAdmin(admin.ModelAdmin):
+  list_display = ('name', 'bit')
+  search_fields = ('name',)
+  ordering = ('name',)
+
+  def bit(self, obj):
+    return obj.mask.bit_length() - 1 if obj.mask else '—'
+  bit.short_description = 'Бит'
+
+
+class LikedRecipeInline(admin.TabularInline):
+    model = LikedRecipe
+    fields = ('recipe', 'liked_at')
+    raw_id_fields = ('recipe',)
+    extra = 0
+    verbose_name = 'Лайкнутый рецепт'
+    verbose_name_plural = 'Лайкнутые рецепты'
+
+
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = (
@@ -66,9 +118,11 @@ class UserProfileAdmin(admin.ModelAdmin):
         'dinner_status_display',
         'last_refresh_date_display'
     )
-    filter_horizontal = ('liked_recipes', 'disliked_recipes')
+    list_select_related = ('user',)
+    filter_horizontal = ('disliked_recipes', 'allergens')
+    inlines = [LikedRecipeInline]
     search_fields = ('user__username', 'user__email', 'allergies')
-    list_filter = ('user__is_active',)
+    list_filter = ('user__is_active', 'is_vegetarian', 'no_gluten', 'low_calorie', 'dish_type')
     actions = [
         'reset_all_limits',
         'reset_breakfast_limits',
@@ -79,102 +133,94 @@ class UserProfileAdmin(admin.ModelAdmin):
     ]
     readonly_fields = ('last_refresh_date', 'breakfast_blocked_until', 'lunch_blocked_until', 'dinner_blocked_until')
 
+    def get_queryset(self, request):
+        # Подзапросы вместо двух Count по JOIN, чтобы не перемножать строки
+        return super().get_queryset(request).annotate(
+            _liked_count=_through_count(UserProfile.liked_recipes.through),
+            _disliked_count=_through_count(UserProfile.disliked_recipes.through),
+        )
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Лайки из инлайна сохраняются без m2m-сигналов
+        plan_cache.invalidate([form.instance.user_id])
+
     def liked_recipes_count(self, obj):
-        return obj.liked_recipes.count()
+        return obj._liked_count
     liked_recipes_count.short_description = 'Лайкнутые'
+    liked_recipes_count.admin_order_field = '_liked_count'
 
     def disliked_recipes_count(self, obj):
-        return obj.disliked_recipes.count()
+        return obj._disliked_count
     disliked_recipes_count.short_description = 'Дизлайкнутые'
+    disliked_recipes_count.admin_order_field = '_disliked_count'
 
     def last_refresh_date_display(self, obj):
         return obj.last_refresh_date.strftime('%d.%m.%Y %H:%M')
     last_refresh_date_display.short_description = 'Последнее обновление'
 
+    def _refresh_status_display(self, obj, meal_type):
+        status = obj.refresh_status(meal_type)
+        if status.blocked_until:
+            return f"🚫 До {status.blocked_until.strftime('%d.%m.%Y %H:%M')}"
+        return f"✅ {status.count}/{quota.REFRESH_LIMIT} (ост: {status.remaining})"
+
     def breakfast_status_display(self, obj):
-        obj.reset_refresh_counts()
-        if obj.breakfast_blocked_until and timezone.now() < obj.breakfast_blocked_until:
-            return f"🚫 До {obj.breakfast_blocked_until.strftime('%d.%m.%Y %H:%M')}"
-        remaining = 3 - obj.breakfast_refresh_count
-        return f"✅ {obj.breakfast_refresh_count}/3 (ост: {remaining})"
+        return self._refresh_status_display(obj, 'breakfast')
     breakfast_status_display.short_description = 'Завтрак'
 
     def lunch_status_display(self, obj):
-        obj.reset_refresh_counts()
-        if obj.lunch_blocked_until and timezone.now() < obj.lunch_blocked_until:
-            return f"🚫 До {obj.lunch_blocked_until.strftime('%d.%m.%Y %H:%M')}"
-        remaining = 3 - obj.lunch_refresh_count
-        return f"✅ {obj.lunch_refresh_count}/3 (ост: {remaining})"
+        return self._refresh_status_display(obj, 'lunch')
     lunch_status_display.short_description = 'Обед'
 
     def dinner_status_display(self, obj):
-        obj.reset_refresh_counts()
-        if obj.dinner_blocked_until and timezone.now() < obj.dinner_blocked_until:
-            return f"🚫 До {obj.dinner_blocked_until.strftime('%d.%m.%Y %H:%M')}"
-        remaining = 3 - obj.dinner_refresh_count
-        return f"✅ {obj.dinner_refresh_count}/3 (ост: {remaining})"
+        return self._refresh_status_display(obj, 'dinner')
     dinner_status_display.short_description = 'Ужин'
 
+    def _bulk_action(self, request, queryset, action, message):
+        if queryset.count() > bulk_actions.threshold():
+            job = bulk_actions.schedule(action, queryset, request.user)
+            self.message_user(
+                request, f"Выборка большая, действие запущено в фоне: задача #{job.pk}")
+            return
+        bulk_actions.apply(action, queryset)
+        self.message_user(request, message)
+
     def reset_all_limits(self, request, queryset):
-        for profile in queryset:
-            profile.breakfast_refresh_count = 0
-            profile.lunch_refresh_count = 0
-            profile.dinner_refresh_count = 0
-            profile.breakfast_blocked_until = None
-            profile.lunch_blocked_until = None
-            profile.dinner_blocked_until = None
-            profile.last_refresh_date = timezone.now()
-            profile.save()
-        self.message_user(request, "Все лимиты сброшены")
+        self._bulk_action(request, queryset, 'reset_all_limits', "Все лимиты сброшены")
     reset_all_limits.short_description = "Сбросить все лимиты"
 
     def reset_breakfast_limits(self, request, queryset):
-        for profile in queryset:
-            profile.breakfast_refresh_count = 0
-            profile.breakfast_blocked_until = None
-            profile.last_refresh_date = timezone.now()
-            profile.save()
-        self.message_user(request, "Лимиты завтрака сброшены")
+        self._bulk_action(request, queryset, 'reset_breakfast_limits', "Лимиты завтрака сброшены")
     reset_breakfast_limits.short_description = "Сбросить лимиты завтрака"
 
     def reset_lunch_limits(self, request, queryset):
-        for profile in queryset:
-            profile.lunch_refresh_count = 0
-            profile.lunch_blocked_until = None
-            profile.last_refresh_date = timezone.now()
-            profile.save()
-        self.message_user(request, "Лимиты обеда сброшены")
+        self._bulk_action(request, queryset, 'reset_lunch_limits', "Лимиты обеда сброшены")
     reset_lunch_limits.short_description = "Сбросить лимиты обеда"
 
     def reset_dinner_limits(self, request, queryset):
-        for profile in queryset:
-            profile.dinner_refresh_count = 0
-            profile.dinner_blocked_until = None
-            profile.last_refresh_date = timezone.now()
-            profile.save()
-        self.message_user(request, "Лимиты ужина сброшены")
+        self._bulk_action(request, queryset, 'reset_dinner_limits', "Лимиты ужина сброшены")
     reset_dinner_limits.short_description = "Сбросить лимиты ужина"
 
     def clear_disliked_recipes(self, request, queryset):
-        for profile in queryset:
-            profile.disliked_recipes.clear()
-            profile.save()
-        self.message_user(request, "Дизлайкнутые рецепты очищены")
+        self._bulk_action(request, queryset, 'clear_disliked_recipes',
+                          "Дизлайкнутые рецепты очищены")
     clear_disliked_recipes.short_description = "Очистить дизлайкнутые рецепты"
 
     def clear_liked_recipes(self, request, queryset):
-        for profile in queryset:
-            profile.liked_recipes.clear()
-            profile.save()
-        self.message_user(request, "Лайкнутые рецепты очищены")
+        self._bulk_action(request, queryset, 'clear_liked_recipes', "Лайкнутые рецепты очищены")
     clear_liked_recipes.short_description = "Очистить лайкнутые рецепты"
 
     fieldsets = (
         ('Основная информация', {
-            'fields': ('user', 'allergies', 'filters')
+            'fields': ('user', 'allergies', 'allergens')
+        }),
+        ('Фильтры', {
+            'fields': ('meal_types', 'low_calorie', 'is_vegetarian', 'no_gluten', 'dish_type',
+                       'max_cost')
         }),
         ('Рецепты', {
-            'fields': ('liked_recipes', 'disliked_recipes')
+            'fields': ('disliked_recipes',)
         }),
         ('Лимиты обновлений', {
             'fields': (
@@ -191,4 +237,26 @@ class UserProfileAdmin(admin.ModelAdmin):
                 'dinner_blocked_until'
             )
         }),
-    )
\ No newline at end of file
+    )
+
+
+@admin.register(BulkJob)
+class BulkJobAdmin(admin.ModelAdmin):
+  list_display = ('__str__', 'status', 'progress', 'created_by', 'created_at', 'finished_at')
+  list_filter = ('status', 'action')
+  readonly_fields = ('action', 'total', 'processed', 'status', 'error', 'heartbeat_at',
+                     'created_by', 'created_at', 'finished_at')
+  exclude = ('object_ids',)
+  ordering = ('-created_at',)
+
+  def progress(self, obj):
+    if not obj.total:
+      return '—'
+    return f"{obj.processed}/{obj.total} ({obj.processed * 100 // obj.total}%)"
+  progress.short_description = 'Прогресс'
+
+  def has_add_permission(self, request):
+    return False
+
+  def has_change_permission(self, request, obj=None):
+    return False
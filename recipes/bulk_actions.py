@@ -0,0 +1,152 @@
+"""Массовые действия над профилями из админки.
+
+Каждое действие — один UPDATE или DELETE по выборке. Для очень больших
+выборок действие ставится в фоновую задачу BulkJob, которая обрабатывает
+профили пачками по CHUNK_SIZE и записывает прогресс после каждой пачки.
+
+Задачу выполняет тот, кто захватил ее условным UPDATE: ожидающую или
+выполняющуюся, но без отклика дольше LEASE_TIMEOUT (обработчик упал).
+Прогресс каждой пачки пишется в той же транзакции, что и сама пачка, и
+только пока аренда своя; перехваченная задача откатывает пачку и
+останавливается, поэтому пачки не применяются дважды.
+"""
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import plan_cache
+from .models import BulkJob, UserProfile
+from .quota import MEAL_TYPES
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+DEFAULT_THRESHOLD = 5000
+LEASE_TIMEOUT = timedelta(minutes=5)
+
+
+class LeaseLost(Exception):
+  """Задачу перехватил другой обработчик."""
+
+
+def reset_limits(profiles, meal_types=MEAL_TYPES):
+  updates = {}
+  # Окно общее для всех приемов пищи: сброс одного не должен сдвигать его
+  # для остальных
+  if set(meal_types) == set(MEAL_TYPES):
+    updates['last_refresh_date'] = timezone.now()
+  for meal_type in meal_types:
+    updates[f'{meal_type}_refresh_count'] = 0
+    updates[f'{meal_type}_blocked_until'] = None
+  updated = profiles.update(**updates)
+  _invalidate_snapshots(profiles)
+  return updated
+
+
+def clear_liked(profiles):
+  deleted = UserProfile.liked_recipes.through.objects.filter(userprofile__in=profiles).delete()
+  _invalidate_snapshots(profiles)
+  return deleted
+
+
+def clear_disliked(profiles):
+  deleted = UserProfile.disliked_recipes.through.objects.filter(userprofile__in=profiles).delete()
+  _invalidate_snapshots(profiles)
+  return deleted
+
+
+def _invalidate_snapshots(profiles):
+  # UPDATE и DELETE по выборке не шлют сигналов, снимки сбрасываем сами
+  plan_cache.invalidate(profiles.values_list('user_id', flat=True))
+
+
+ACTIONS = {
+  'reset_all_limits': reset_limits,
+  'reset_breakfast_limits': lambda profiles: reset_limits(profiles, ['breakfast']),
+  'reset_lunch_limits': lambda profiles: reset_limits(profiles, ['lunch']),
+  'reset_dinner_limits': lambda profiles: reset_limits(profiles, ['dinner']),
+  'clear_liked_recipes': clear_liked,
+  'clear_disliked_recipes': clear_disliked,
+}
+
+
+def threshold():
+  return getattr(settings, 'RECIPES_BULK_ACTION_THRESHOLD', DEFAULT_THRESHOLD)
+
+
+def apply(action, queryset):
+  """Выполняет действие над выборкой одним запросом."""
+  ACTIONS[action](UserProfile.objects.filter(pk__in=queryset.values('pk')))
+
+
+def schedule(action, queryset, user=None):
+  """Создает фоновую задачу и запускает ее после коммита транзакции."""
+  object_ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+  job = BulkJob.objects.create(action=action, object_ids=object_ids,
+                               total=len(object_ids), created_by=user)
+  transaction.on_commit(lambda: start(job.pk))
+  return job
+
+
+def start(job_id):
+  thread = threading.Thread(target=_run_in_thread, args=(job_id,), daemon=True,
+                            name=f'bulk-job-{job_id}')
+  thread.start()
+  return thread
+
+
+def _run_in_thread(job_id):
+  close_old_connections()
+  try:
+    run(job_id)
+  finally:
+    close_old_connections()
+
+
+def claim(job_id):
+  """Захватывает задачу; время аренды или None, если ее выполняет кто-то еще."""
+  now = timezone.now()
+  stale = Q(heartbeat_at__isnull=True) | Q(heartbeat_at__lt=now - LEASE_TIMEOUT)
+  claimed = (BulkJob.objects
+             .filter(Q(status='pending') | Q(stale, status='running'), pk=job_id)
+             .update(status='running', heartbeat_at=now))
+  return now if claimed else None
+
+
+def _owned(job_id, heartbeat_at):
+  return BulkJob.objects.filter(pk=job_id, status='running', heartbeat_at=heartbeat_at)
+
+
+def run(job_id, chunk_size=CHUNK_SIZE):
+  """Выполняет задачу с места, где она остановилась; False, если она занята."""
+  heartbeat_at = claim(job_id)
+  if heartbeat_at is None:
+    return False
+  job = BulkJob.objects.get(pk=job_id)
+  action = ACTIONS[job.action]
+  try:
+    for offset in range(job.processed, job.total, chunk_size):
+      chunk = job.object_ids[offset:offset + chunk_size]
+      with transaction.atomic():
+        action(UserProfile.objects.filter(pk__in=chunk))
+        now = timezone.now()
+        if not _owned(job_id, heartbeat_at).update(processed=F('processed') + len(chunk),
+                                                    heartbeat_at=now):
+          raise LeaseLost
+        heartbeat_at = now
+  except LeaseLost:
+    logger.warning('Bulk job %s was taken over by another worker', job_id)
+    return False
+  except Exception as error:
+    logger.exception('Bulk job %s failed', job_id)
+    _owned(job_id, heartbeat_at).update(status='failed', error=str(error),
+                                        finished_at=timezone.now())
+    return True
+  _owned(job_id, heartbeat_at).update(status='done', finished_at=timezone.now())
+  return True
@@ -0,0 +1,217 @@
+"""Индекс кандидатов для подбора блюд.
+
+Для каждого приема пищи и каждой комбинации фильтров (low_calorie,
+is_vegetarian, no_gluten, dish_type) хранится компактный массив id рецептов,
+упорядоченный по (стоимость, id). Рядом лежат стоимость в копейках и
+калорийность, поэтому отсечение по max_cost — это bisect по префиксу.
+
+Индекс строится одним запросом и живет в памяти процесса. Версия индекса
+сбрасывается сигналами (recipes/signals.py) и хранится в общем кэше
+RECIPES_CANDIDATE_INDEX_CACHE (по умолчанию recipes), так что сброс виден
+всем процессам; с RECIPES_CANDIDATE_INDEX_SHARED там же хранится и
+построенный индекс. RECIPES_CANDIDATE_INDEX_CACHE = None держит версию в
+памяти процесса — только для запуска в один процесс.
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from decimal import Decimal
+from itertools import product
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+from .models import LOW_CALORIE_LIMIT, Recipe, parse_cost
+
+
+VERSION_KEY = 'recipes:candidate-index:version'
+INDEX_KEY = 'recipes:candidate-index:{version}'
+
+
+def parse_max_cost(value):
+  """Переводит max_cost из фильтров в копейки, None — если не задан или невалиден."""
+  cost = parse_cost(value)
+  if cost is None:
+    return None
+  return int((cost * 100).to_integral_value(rounding='ROUND_FLOOR'))
+
+
+def filter_signature(filters):
+  return (
+    bool(filters.get('low_calorie')),
+    bool(filters.get('is_vegetarian')),
+    bool(filters.get('no_gluten')),
+    filters.get('dish_type') or None,
+  )
+
+
+class CandidatePool:
+  __slots__ = ('ids', 'costs', 'calories')
+
+  def __init__(self, rows=()):
+    self.ids = array('q')
+    self.costs = array('q')
+    self.calories = array('l')
+    for recipe_id, cost, calories in rows:
+      self.ids.append(recipe_id)
+      self.costs.append(cost)
+      self.calories.append(calories)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def cut(self, max_cost=None):
+    """Количество кандидатов со стоимостью не выше max_cost (в копейках)."""
+    if max_cost is None:
+      return len(self.ids)
+    return bisect_right(self.costs, max_cost)
+
+  def ids_up_to(self, max_cost=None):
+    return self.ids[:self.cut(max_cost)]
+
+  def position(self, recipe_id, cost):
+    """Позиция рецепта в пуле или -1; cost — его стоимость в копейках."""
+    lo = bisect_left(self.costs, cost)
+    hi = bisect_right(self.costs, cost, lo)
+    i = bisect_left(self.ids, recipe_id, lo, hi)
+    if i < hi and self.ids[i] == recipe_id:
+      return i
+    return -1
+
+
+EMPTY_POOL = CandidatePool()
+
+
+class CandidateIndex:
+  def __init__(self, version, pools, recipe_ids=(), recipe_costs=(), allergen_masks=None):
+    self.version = version
+    self.pools = pools
+    # Все рецепты по возрастанию id и их стоимость — для поиска позиции в пуле
+    self.recipe_ids = array('q', recipe_ids)
+    self.recipe_costs = array('q', recipe_costs)
+    # Маски аллергенов только у рецептов, где они есть
+    self.allergen_masks = allergen_masks or {}
+    self._allergenic = {}
+
+  @classmethod
+  def build(cls, version):
+    rows = (Recipe.objects
+            .order_by('total_cost', 'id')
+            .values_list('id', 'meal_type', 'calories', 'is_vegetarian',
+                         'no_gluten', 'dish_type', 'total_cost', 'allergen_mask'))
+    buckets = defaultdict(list)
+    costs_by_id = {}
+    allergen_masks = {}
+    for (recipe_id, meal_type, calories, vegetarian, no_gluten, dish_type, cost,
+         allergen_mask) in rows.iterator():
+      entry = (recipe_id, int(Decimal(cost) * 100), calories)
+      costs_by_id[recipe_id] = entry[1]
+      if allergen_mask:
+        allergen_masks[recipe_id] = allergen_mask
+      for key in product(
+        (None, meal_type),
+        (False, True) if calories < LOW_CALORIE_LIMIT else (False,),
+        (False, True) if vegetarian else (False,),
+        (False, True) if no_gluten else (False,),
+        (None, dish_type),
+      ):
+        buckets[key].append(entry)
+    recipe_ids = sorted(costs_by_id)
+    return cls(version,
+               {key: CandidatePool(entries) for key, entries in buckets.items()},
+               recipe_ids, [costs_by_id[recipe_id] for recipe_id in recipe_ids],
+               allergen_masks)
+
+  def pool_key(self, meal_type, filters):
+    return (meal_type or None, *filter_signature(filters))
+
+  def pool(self, meal_type, filters):
+    return self.pools.get(self.pool_key(meal_type, filters), EMPTY_POOL)
+
+  def allergenic_ids(self, allergen_mask):
+    """id рецептов, содержащих хотя бы один аллерген из маски."""
+    if not allergen_mask:
+      return frozenset()
+    ids = self._allergenic.get(allergen_mask)
+    if ids is None:
+      ids = frozenset(recipe_id for recipe_id, mask in self.allergen_masks.items()
+                      if mask & allergen_mask)
+      self._allergenic[allergen_mask] = ids
+    return ids
+
+  def cost_of(self, recipe_id):
+    """Стоимость рецепта в копейках или None, если рецепта нет в индексе."""
+    i = bisect_left(self.recipe_ids, recipe_id)
+    if i < len(self.recipe_ids) and self.recipe_ids[i] == recipe_id:
+      return self.recipe_costs[i]
+    return None
+
+
+_lock = threading.Lock()
+_state = {'index': None, 'version': 1}
+
+
+def _shared_cache():
+  alias = getattr(settings, 'RECIPES_CANDIDATE_INDEX_CACHE', 'recipes')
+  return caches[alias] if alias else None
+
+
+def _initial_version():
+  # Версия, потерянная при вытеснении из кэша, не должна совпасть с версией
+  # индекса, который какой-то процесс уже держит в памяти
+  return time.time_ns()
+
+
+def current_version():
+  cache = _shared_cache()
+  if cache is None:
+    return _state['version']
+  version = cache.get(VERSION_KEY)
+  if version is None:
+    version = _initial_version()
+    if not cache.add(VERSION_KEY, version, None):
+      version = cache.get(VERSION_KEY, version)
+  return version
+
+
+def _bump_version():
+  _state['version'] += 1
+  cache = _shared_cache()
+  if cache is not None:
+    try:
+      cache.incr(VERSION_KEY)
+    except ValueError:
+      cache.add(VERSION_KEY, _initial_version(), None)
+
+
+def invalidate():
+  """Сбрасывает индекс сейчас и еще раз после коммита текущей транзакции."""
+  _bump_version()
+  if connection.in_atomic_block:
+    transaction.on_commit(_bump_version)
+
+
+def get_index():
+  version = current_version()
+  index = _state['index']
+  if index is not None and index.version == version:
+    return index
+
+  with _lock:
+    index = _state['index']
+    if index is not None and index.version == version:
+      return index
+
+    cache = _shared_cache() if getattr(settings, 'RECIPES_CANDIDATE_INDEX_SHARED', False) else None
+    index = None
+    if cache is not None:
+      index = cache.get(INDEX_KEY.format(version=version))
+    if index is None:
+      index = CandidateIndex.build(version)
+      if cache is not None:
+        cache.set(INDEX_KEY.format(version=version), index, None)
+    _state['index'] = index
+    return index
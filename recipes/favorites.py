@@ -0,0 +1,49 @@
+"""Постраничный вывод избранного по курсору.
+
+Страницы строятся по индексу (userprofile, -liked_at, -id): следующая
+страница начинается строго после последнего показанного лайка, поэтому
+время ответа не зависит от того, насколько далеко пролистан список.
+"""
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+from .models import LikedRecipe
+
+
+PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(like):
+  raw = f'{like.liked_at.isoformat()}|{like.pk}'
+  return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+  """Возвращает (liked_at, id) или None для пустого или испорченного курсора."""
+  if not cursor:
+    return None
+  try:
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    liked_at, like_id = raw.split('|')
+    return datetime.fromisoformat(liked_at), int(like_id)
+  except (ValueError, UnicodeDecodeError):
+    return None
+
+
+def get_page(profile, cursor=None, page_size=PAGE_SIZE):
+  """Страница избранного: (список рецептов, курсор следующей страницы или None)."""
+  likes = (LikedRecipe.objects
+           .filter(userprofile=profile)
+           .select_related('recipe')
+           .order_by('-liked_at', '-id'))
+  position = decode_cursor(cursor)
+  if position is not None:
+    liked_at, like_id = position
+    likes = likes.filter(Q(liked_at__lt=liked_at) | Q(liked_at=liked_at, id__lt=like_id))
+
+  likes = list(likes[:page_size + 1])
+  next_cursor = encode_cursor(likes[page_size - 1]) if len(likes) > page_size else None
+  return [like.recipe for like in likes[:page_size]], next_cursor
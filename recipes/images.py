@@ -0,0 +1,172 @@
+"""Уменьшенные копии изображений рецептов.
+
+Для каждого загруженного Recipe.image создаются варианты из VARIANTS
+в форматах JPEG и WebP; пути и размеры лежат в Recipe.image_variants:
+
+  {'source': 'recipes/plov.jpg',
+   'card': {'width': 480, 'height': 320,
+            'jpeg': 'recipes/variants/plov-card.jpg',
+            'webp': 'recipes/variants/plov-card.webp'}, ...}
+
+source — имя оригинала, из которого собраны варианты; если картинку
+заменили, варианты пересобираются. Генерация идет после коммита в пуле
+из RECIPES_IMAGE_WORKERS потоков (0 — сразу, в текущем потоке), поэтому
+загрузка в админке ее не ждет. Pillow отпускает GIL на масштабировании и
+кодировании, так что потоки действительно работают параллельно.
+Существующие картинки обрабатывает manage.py generate_recipe_images.
+"""
+import logging
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from . import recipe_cache
+from .models import Recipe
+
+
+logger = logging.getLogger(__name__)
+
+# Ширина варианта в пикселях: превью в админке и списках, карточка
+# избранного (и 1x на странице подбора), крупное фото рецепта
+VARIANTS = {
+  'thumb': 120,
+  'card': 480,
+  'large': 960,
+}
+FORMATS = {
+  'webp': ('WEBP', {'quality': 80, 'method': 4}),
+  'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+DEFAULT_WORKERS = 2
+
+_lock = threading.Lock()
+_executor = None
+
+
+def _workers():
+  return getattr(settings, 'RECIPES_IMAGE_WORKERS', DEFAULT_WORKERS)
+
+
+def _variant_name(source, variant, fmt):
+  stem = posixpath.splitext(posixpath.basename(source))[0]
+  directory = posixpath.join(posixpath.dirname(source), 'variants')
+  return posixpath.join(directory, f'{stem}-{variant}.{EXTENSIONS[fmt]}')
+
+
+def _encode(image, fmt):
+  pil_format, options = FORMATS[fmt]
+  if pil_format == 'JPEG' and image.mode != 'RGB':
+    # У JPEG нет альфа-канала: прозрачное кладем на белый фон
+    background = Image.new('RGB', image.size, 'white')
+    background.paste(image, mask=image.getchannel('A') if 'A' in image.getbands() else None)
+    image = background
+  buffer = BytesIO()
+  image.save(buffer, pil_format, **options)
+  return ContentFile(buffer.getvalue())
+
+
+def render_variants(field):
+  """Создает файлы вариантов для файла изображения и возвращает их описание."""
+  storage = field.storage
+  with field.open('rb'), Image.open(field) as original:
+    original = ImageOps.exif_transpose(original)
+    if original.mode not in ('RGB', 'RGBA'):
+      original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+    variants = {'source': field.name, 'width': original.width, 'height': original.height}
+    for variant, width in VARIANTS.items():
+      # Не увеличиваем: маленький оригинал дает вариант своего размера
+      if original.width > width:
+        size = (width, max(1, round(original.height * width / original.width)))
+        resized = original.resize(size, Image.Resampling.LANCZOS)
+      else:
+        resized = original
+      entry = {'width': resized.width, 'height': resized.height}
+      for fmt in FORMATS:
+        name = _variant_name(field.name, variant, fmt)
+        if storage.exists(name):
+          storage.delete(name)
+        entry[fmt] = storage.save(name, _encode(resized, fmt))
+      variants[variant] = entry
+  return variants
+
+
+def generate(recipe_id, force=False):
+  """Собирает варианты изображения рецепта; True, если они записаны."""
+  recipe = Recipe.objects.filter(pk=recipe_id).only('image', 'image_variants').first()
+  if recipe is None or not recipe.image:
+    return False
+  if not force and recipe.image_variants.get('source') == recipe.image.name:
+    return False
+  try:
+    variants = render_variants(recipe.image)
+  except (OSError, ValueError):
+    logger.exception('Cannot build image variants for recipe %s', recipe_id)
+    return False
+
+  # Пока шла генерация, картинку могли заменить — тогда ее варианты
+  # запишет задача, поставленная на новую картинку
+  updated = (Recipe.objects
+             .filter(pk=recipe_id, image=recipe.image.name)
+             .update(image_variants=variants, image_width=variants['width'],
+                     image_height=variants['height'], updated_at=timezone.now()))
+  if updated:
+    # UPDATE не шлет сигналов, закэшированный рецепт сбрасываем сами
+    recipe_cache.bump([recipe_id])
+  return bool(updated)
+
+
+def _run(recipe_id):
+  close_old_connections()
+  try:
+    generate(recipe_id)
+  finally:
+    close_old_connections()
+
+
+def _get_executor():
+  global _executor
+  with _lock:
+    if _executor is None:
+      _executor = ThreadPoolExecutor(max_workers=_workers(), thread_name_prefix='recipe-images')
+    return _executor
+
+
+def schedule(recipe_id):
+  """Ставит генерацию вариантов в пул после коммита текущей транзакции."""
+  def submit():
+    if _workers() <= 0:
+      generate(recipe_id)
+    else:
+      _get_executor().submit(_run, recipe_id)
+  transaction.on_commit(submit)
+
+
+def needs_variants(recipe):
+  if not recipe.image:
+    return bool(recipe.image_variants)
+  return recipe.image_variants.get('source') != recipe.image.name
+
+
+def variant(recipe, name):
+  """Описание варианта {'jpeg': url, 'webp': url, 'width', 'height'}.
+
+  Пока варианты не готовы, вместо них отдается оригинал без webp; без
+  картинки — None.
+  """
+  if not recipe.image:
+    return None
+  if not needs_variants(recipe):
+    entry = recipe.image_variants[name]
+    storage = recipe.image.storage
+    return {'jpeg': storage.url(entry['jpeg']), 'webp': storage.url(entry['webp']),
+            'width': entry['width'], 'height': entry['height']}
+  return {'jpeg': recipe.image.url, 'webp': None,
+          'width': recipe.image_width, 'height': recipe.image_height}
@@ -0,0 +1,249 @@
+"""Замеры запросов: время, SQL и размер ответа по представлениям.
+
+InstrumentationMiddleware стоит первой в MIDDLEWARE и для каждого запроса
+считает полное время, время и число SQL-запросов, повторы одного и того
+же SQL (типичный признак N+1) и размер ответа. Итог уходит одной
+JSON-строкой в логгер recipes.views: WARNING для медленных
+(RECIPES_SLOW_REQUEST_MS) и тех, где один SQL повторился
+RECIPES_DUPLICATE_QUERY_THRESHOLD раз и больше, остальные — DEBUG; при
+выключенном DEBUG строка для них даже не собирается.
+
+SQL считает обертка execute_wrapper, которую сигнал connection_created
+ставит на каждое соединение (recipes/signals.py). Текущий замер она
+находит через ContextVar, а sync_to_async копирует контекст в поток,
+поэтому запросы async-представлений тоже попадают в свой замер. Вне
+запроса обертка стоит одного обращения к ContextVar.
+
+Счетчики по представлениям живут в памяти процесса и отдаются в текстовом
+формате Prometheus по /metrics/, только если задан RECIPES_METRICS_TOKEN и
+запрос пришел с ним в заголовке Authorization: Bearer. При нескольких
+воркерах у каждого свои счетчики.
+"""
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+
+logger = logging.getLogger('recipes.views')
+
+METRIC_PREFIX = 'foodplan'
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# Собственные запросы к /metrics/ в счетчики и лог не пишем
+SKIP_VIEWS = frozenset({'recipes:metrics'})
+SQL_PREVIEW_LENGTH = 200
+
+_current = ContextVar('recipes_query_recorder', default=None)
+_lock = threading.Lock()
+_stats = {}
+
+
+class QueryRecorder:
+  __slots__ = ('queries', 'db_time', 'statements')
+
+  def __init__(self):
+    self.queries = 0
+    self.db_time = 0.0
+    self.statements = Counter()
+
+  @property
+  def duplicates(self):
+    """Сколько выполнений повторили уже выполненный SQL."""
+    return sum(count - 1 for count in self.statements.values() if count > 1)
+
+  def top_duplicate(self):
+    if not self.statements:
+      return None, 0
+    sql, count = self.statements.most_common(1)[0]
+    return (sql, count) if count > 1 else (None, 0)
+
+
+def _execute(execute, sql, params, many, context):
+  recorder = _current.get()
+  if recorder is None:
+    return execute(sql, params, many, context)
+  started = time.perf_counter()
+  try:
+    return execute(sql, params, many, context)
+  finally:
+    recorder.db_time += time.perf_counter() - started
+    recorder.queries += 1
+    # SQL здесь еще с плейсхолдерами, так что N+1 по разным id дает одну строку
+    recorder.statements[sql] += 1
+
+
+def install(connection):
+  if _execute not in connection.execute_wrappers:
+    connection.execute_wrappers.append(_execute)
+
+
+@contextmanager
+def record():
+  """Считает SQL-запросы внутри блока во всех потоках этого контекста."""
+  recorder = QueryRecorder()
+  token = _current.set(recorder)
+  try:
+    yield recorder
+  finally:
+    _current.reset(token)
+
+
+def _setting(name, default):
+  return getattr(settings, name, default)
+
+
+def _new_entry():
+  return {
+    'requests': Counter(),
+    'buckets': [0] * len(DURATION_BUCKETS),
+    'duration': 0.0,
+    'db_duration': 0.0,
+    'queries': 0,
+    'duplicates': 0,
+    'response_bytes': 0,
+  }
+
+
+def observe(view, method, status, duration, recorder, response_bytes):
+  with _lock:
+    entry = _stats.get(view)
+    if entry is None:
+      entry = _stats[view] = _new_entry()
+    entry['requests'][method, status] += 1
+    for index, bound in enumerate(DURATION_BUCKETS):
+      if duration <= bound:
+        entry['buckets'][index] += 1
+    entry['duration'] += duration
+    entry['db_duration'] += recorder.db_time
+    entry['queries'] += recorder.queries
+    entry['duplicates'] += recorder.duplicates
+    entry['response_bytes'] += response_bytes
+
+
+def stats():
+  with _lock:
+    return {view: {**entry, 'requests': Counter(entry['requests']),
+                   'buckets': list(entry['buckets'])}
+            for view, entry in _stats.items()}
+
+
+def reset_stats():
+  with _lock:
+    _stats.clear()
+
+
+def _label(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics():
+  """Счетчики в текстовом формате Prometheus 0.0.4."""
+  snapshot = stats()
+  lines = []
+
+  def family(name, kind, help_text):
+    lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+    lines.append(f'# TYPE {METRIC_PREFIX}_{name} {kind}')
+
+  family('requests_total', 'counter', 'Обработано запросов')
+  for view, entry in sorted(snapshot.items()):
+    for (method, status), count in sorted(entry['requests'].items()):
+      lines.append(f'{METRIC_PREFIX}_requests_total{{view="{_label(view)}",'
+                   f'method="{_label(method)}",status="{status}"}} {count}')
+
+  family('request_duration_seconds', 'histogram', 'Полное время обработки запроса')
+  for view, entry in sorted(snapshot.items()):
+    view_label = _label(view)
+    for bound, count in zip(DURATION_BUCKETS, entry['buckets'], strict=True):
+      lines.append(f'{METRIC_PREFIX}_request_duration_seconds_bucket'
+                   f'{{view="{view_label}",le="{bound}"}} {count}')
+    total = sum(entry['requests'].values())
+    lines.append(f'{METRIC_PREFIX}_request_duration_seconds_bucket'
+                 f'{{view="{view_label}",le="+Inf"}} {total}')
+    lines.append(f'{METRIC_PREFIX}_request_duration_seconds_sum{{view="{view_label}"}} '
+                 f'{entry["duration"]:.6f}')
+    lines.append(f'{METRIC_PREFIX}_request_duration_seconds_count{{view="{view_label}"}} {total}')
+
+  counters = (
+    ('db_duration_seconds_total', 'db_duration', 'Время SQL-запросов'),
+    ('db_queries_total', 'queries', 'Выполнено SQL-запросов'),
+    ('duplicate_queries_total', 'duplicates', 'Повторные выполнения одного и того же SQL'),
+    ('response_bytes_total', 'response_bytes', 'Отдано байт в телах ответов'),
+  )
+  for name, field, help_text in counters:
+    family(name, 'counter', help_text)
+    for view, entry in sorted(snapshot.items()):
+      value = entry[field]
+      value = f'{value:.6f}' if isinstance(value, float) else value
+      lines.append(f'{METRIC_PREFIX}_{name}{{view="{_label(view)}"}} {value}')
+  return '\n'.join(lines) + '\n'
+
+
+def _response_bytes(response):
+  if response.streaming:
+    return int(response.get('Content-Length') or 0)
+  return len(response.content)
+
+
+def _finish(request, response, started, recorder):
+  duration = time.perf_counter() - started
+  match = request.resolver_match
+  view = match.view_name if match else 'unresolved'
+  if view in SKIP_VIEWS:
+    return
+  size = _response_bytes(response)
+  observe(view, request.method, response.status_code, duration, recorder, size)
+
+  duplicate_sql, duplicate_count = recorder.top_duplicate()
+  slow = duration * 1000 >= _setting('RECIPES_SLOW_REQUEST_MS', 500)
+  repeated = duplicate_count >= _setting('RECIPES_DUPLICATE_QUERY_THRESHOLD', 3)
+  level = logging.WARNING if slow or repeated else logging.DEBUG
+  if not logger.isEnabledFor(level):
+    return
+  line = {
+    'event': 'request',
+    'view': view,
+    'method': request.method,
+    'path': request.path,
+    'status': response.status_code,
+    'duration_ms': round(duration * 1000, 2),
+    'db_ms': round(recorder.db_time * 1000, 2),
+    'queries': recorder.queries,
+    'duplicate_queries': recorder.duplicates,
+    'response_bytes': size,
+  }
+  if repeated:
+    line['top_duplicate'] = {'sql': duplicate_sql[:SQL_PREVIEW_LENGTH], 'count': duplicate_count}
+  logger.log(level, json.dumps(line, ensure_ascii=False))
+
+
+class InstrumentationMiddleware:
+  sync_capable = True
+  async_capable = True
+
+  def __init__(self, get_response):
+    self.get_response = get_response
+    if iscoroutinefunction(get_response):
+      markcoroutinefunction(self)
+
+  def __call__(self, request):
+    if iscoroutinefunction(self):
+      return self.__acall__(request)
+    started = time.perf_counter()
+    with record() as recorder:
+      response = self.get_response(request)
+    _finish(request, response, started, recorder)
+    return response
+
+  async def __acall__(self, request):
+    started = time.perf_counter()
+    with record() as recorder:
+      response = await self.get_response(request)
+    _finish(request, response, started, recorder)
+    return response
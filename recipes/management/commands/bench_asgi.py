@@ -0,0 +1,112 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+
+from recipes.models import Recipe
+
+
+BENCH_USERNAME = 'bench@foodplan.local'
+
+
+class Command(BaseCommand):
+  help = ('Сравнивает пропускную способность страницы подбора через WSGI- и '
+          'ASGI-обработчики Django в одном процессе, без веб-сервера')
+
+  def add_arguments(self, parser):
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--refresh', action='store_true',
+                        help='Чередовать GET страницы с POST обновления обеда')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Создать столько рецептов для замера, если их меньше; '
+                             'после замера они удаляются')
+
+  def handle(self, *args, **options):
+    # Все, что команда создала, удаляется в finally: замер не оставляет
+    # в настроенной базе ни рецептов, ни своего пользователя
+    seeded_ids = []
+    created = False
+    try:
+      if options['seed']:
+        existing = Recipe.objects.count()
+        seeded_ids = [recipe.pk for recipe in Recipe.objects.bulk_create([
+          Recipe(name=f'Рецепт для замера {i}', calories=300 + i % 400,
+                 meal_type=('breakfast', 'lunch', 'dinner')[i % 3], dish_type='grains')
+          for i in range(existing, options['seed'])
+        ])]
+      if not Recipe.objects.exists():
+        raise CommandError('Нет рецептов: запустите с --seed N')
+
+      user, created = User.objects.get_or_create(username=BENCH_USERNAME)
+      if created:
+        user.set_unusable_password()
+        user.save()
+      self._bench(user, options)
+    finally:
+      if created:
+        user.delete()
+      if seeded_ids:
+        Recipe.objects.filter(pk__in=seeded_ids).delete()
+
+  def _bench(self, user, options):
+    requests = self._requests(options['requests'], options['refresh'])
+    for name, run in (('WSGI', self._run_wsgi), ('ASGI', self._run_asgi)):
+      # Тестовые клиенты всегда представляются хостом testserver
+      with override_settings(ALLOWED_HOSTS=['testserver']):
+        started = time.perf_counter()
+        latencies = run(user, requests, options['concurrency'])
+        elapsed = time.perf_counter() - started
+      latencies.sort()
+      self.stdout.write(
+        f'{name}: {len(latencies) / elapsed:.1f} запросов/с, '
+        f'p50 {statistics.median(latencies) * 1000:.1f} мс, '
+        f'p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} мс'
+      )
+
+  def _requests(self, count, refresh):
+    details = ('get', reverse('recipes:recipe_details'))
+    refresh_lunch = ('post', reverse('recipes:refresh_lunch'))
+    return [refresh_lunch if refresh and i % 2 else details for i in range(count)]
+
+  def _run_wsgi(self, user, requests, concurrency):
+    def worker(chunk):
+      client = Client()
+      client.force_login(user)
+      latencies = []
+      try:
+        for method, path in chunk:
+          started = time.perf_counter()
+          getattr(client, method)(path)
+          latencies.append(time.perf_counter() - started)
+      finally:
+        connections.close_all()
+      return latencies
+
+    chunks = [requests[i::concurrency] for i in range(concurrency)]
+    with ThreadPoolExecutor(concurrency) as pool:
+      return [latency for latencies in pool.map(worker, chunks) for latency in latencies]
+
+  def _run_asgi(self, user, requests, concurrency):
+    async def worker(chunk):
+      client = AsyncClient()
+      await client.aforce_login(user)
+      latencies = []
+      for method, path in chunk:
+        started = time.perf_counter()
+        await getattr(client, method)(path)
+        latencies.append(time.perf_counter() - started)
+      return latencies
+
+    async def run():
+      chunks = [requests[i::concurrency] for i in range(concurrency)]
+      results = await asyncio.gather(*(worker(chunk) for chunk in chunks))
+      return [latency for latencies in results for latency in latencies]
+
+    return asyncio.run(run())
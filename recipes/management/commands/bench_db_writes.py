@@ -0,0 +1,90 @@
+import copy
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, transaction
+from django.db.models import F
+
+from recipes.models import UserProfile
+
+
+class Command(BaseCommand):
+  help = ('Замеряет конкурентную запись счетчиков профилей. Для SQLite сравнивает '
+          'соединения Django по умолчанию с профилем из settings.SQLITE_OPTIONS на '
+          'временных базах; для других СУБД пишет в настроенную базу default.')
+
+  def add_arguments(self, parser):
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--writes', type=int, default=50, help='Записей на поток')
+    parser.add_argument('--profiles', type=int, default=4,
+                        help='Сколько профилей делят потоки (меньше — больше конфликтов)')
+
+  def handle(self, *args, **options):
+    if connections['default'].vendor != 'sqlite':
+      self._report('default', self._bench('default', options))
+      return
+
+    with tempfile.TemporaryDirectory() as directory:
+      profiles = {'bench_plain': {}, 'bench_tuned': settings.SQLITE_OPTIONS}
+      for alias, sqlite_options in profiles.items():
+        database = copy.deepcopy(connections.settings['default'])
+        database.update(NAME=str(Path(directory) / f'{alias}.sqlite3'), OPTIONS=sqlite_options)
+        connections.settings[alias] = database
+        try:
+          call_command('migrate', database=alias, verbosity=0)
+          self._report(alias, self._bench(alias, options))
+        finally:
+          connections[alias].close()
+          del connections.settings[alias]
+
+  def _bench(self, alias, options):
+    users = User.objects.using(alias)
+    users.bulk_create([User(username=f'bench-writes-{i}') for i in range(options['profiles'])],
+                      ignore_conflicts=True)
+    user_ids = users.filter(username__startswith='bench-writes-').values_list('pk', flat=True)
+    UserProfile.objects.using(alias).bulk_create(
+      [UserProfile(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+    profile_ids = list(UserProfile.objects.using(alias)
+                       .filter(user_id__in=user_ids).values_list('pk', flat=True))
+
+    results = []
+
+    def worker(offset):
+      done = failed = 0
+      try:
+        for i in range(options['writes']):
+          profile_id = profile_ids[(offset + i) % len(profile_ids)]
+          try:
+            # Чтение и запись в одной транзакции, как в UserProfile.save()
+            with transaction.atomic(using=alias):
+              profile = UserProfile.objects.using(alias).get(pk=profile_id)
+              UserProfile.objects.using(alias).filter(pk=profile.pk).update(
+                lunch_refresh_count=F('lunch_refresh_count') + 1)
+            done += 1
+          except OperationalError:
+            failed += 1
+      finally:
+        connections[alias].close()
+      results.append((done, failed))
+
+    threads = [threading.Thread(target=worker, args=(offset,))
+               for offset in range(options['threads'])]
+    started = time.perf_counter()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    elapsed = time.perf_counter() - started
+
+    return (sum(done for done, _ in results), sum(failed for _, failed in results), elapsed)
+
+  def _report(self, alias, result):
+    done, failed, elapsed = result
+    self.stdout.write(f'{alias}: {done / elapsed:.0f} записей/с, ошибок блокировки {failed}, '
+                      f'{elapsed:.2f} с')
@@ -0,0 +1,47 @@
+import time
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+
+DB_ENGINES = ('django.contrib.sessions.backends.db', 'django.contrib.sessions.backends.cached_db')
+
+
+class Command(BaseCommand):
+  help = ('Удаляет просроченные строки django_session пачками, не блокируя таблицу '
+          'одним большим DELETE, как clearsessions')
+
+  def add_arguments(self, parser):
+    parser.add_argument('--chunk-size', type=int, default=5000,
+                        help='Сколько сессий удалять за одну транзакцию')
+    parser.add_argument('--pause', type=float, default=0,
+                        help='Пауза между пачками в секундах')
+    parser.add_argument('--all', action='store_true',
+                        help='Удалить все строки, например после перехода на signed_cookies')
+
+  def handle(self, *args, **options):
+    if options['all'] and settings.SESSION_ENGINE in DB_ENGINES:
+      self.stderr.write(self.style.ERROR(
+        f'--all разлогинит всех: сессии хранятся в базе ({settings.SESSION_ENGINE})'))
+      return
+
+    sessions = Session.objects.all()
+    if not options['all']:
+      sessions = sessions.filter(expire_date__lt=timezone.now())
+    chunk_size = max(options['chunk_size'], 1)
+
+    started = time.perf_counter()
+    deleted = 0
+    while True:
+      with transaction.atomic():
+        keys = list(sessions.order_by().values_list('pk', flat=True)[:chunk_size])
+        if not keys:
+          break
+        deleted += Session.objects.filter(pk__in=keys).delete()[0]
+      if options['pause']:
+        time.sleep(options['pause'])
+    elapsed = time.perf_counter() - started
+    self.stdout.write(self.style.SUCCESS(f'Удалено сессий: {deleted}, {elapsed:.1f} с'))
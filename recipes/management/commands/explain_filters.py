@@ -0,0 +1,82 @@
+import random
+from decimal import Decimal
+from itertools import product
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from recipes.models import Recipe
+
+
+BATCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+  help = ('Печатает план выполнения (EXPLAIN) запроса подбора рецептов для каждой '
+          'комбинации фильтров и отмечает комбинации, для которых не нашлось индекса')
+
+  def add_arguments(self, parser):
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Дополнить каталог случайными рецептами до N штук (например, 1000000)')
+    parser.add_argument('--meal-type', choices=[value for value, _ in Recipe.MEAL_TYPE_CHOICES],
+                        help='Только один прием пищи')
+    parser.add_argument('--dish-type', default='grains',
+                        help='Тип блюда для комбинаций с фильтром dish_type')
+    parser.add_argument('--max-cost', default='300', help='Значение max_cost для комбинаций')
+    parser.add_argument('--analyze', action='store_true',
+                        help='EXPLAIN ANALYZE, где СУБД его поддерживает (запрос выполняется)')
+
+  def handle(self, *args, **options):
+    if options['seed']:
+      self._seed(options['seed'])
+    if not Recipe.objects.exists():
+      raise CommandError('Нет рецептов: запустите с --seed N')
+    # Планировщику нужна статистика по свежим индексам и данным
+    with connection.cursor() as cursor:
+      cursor.execute('ANALYZE')
+      constraints = connection.introspection.get_constraints(cursor, Recipe._meta.db_table)
+    index_names = [name for name, constraint in constraints.items()
+                   if constraint['index'] and not constraint['primary_key']]
+    explain_options = {'analyze': True} if options['analyze'] and connection.vendor != 'sqlite' else {}
+    meal_types = ([options['meal_type']] if options['meal_type']
+                  else [None, *(value for value, _ in Recipe.MEAL_TYPE_CHOICES)])
+
+    missed = 0
+    combinations = list(product(meal_types, (False, True), (False, True), (False, True),
+                                (None, options['dish_type']), (None, options['max_cost'])))
+    for meal_type, low_calorie, vegetarian, no_gluten, dish_type, max_cost in combinations:
+      filters = {'low_calorie': low_calorie, 'is_vegetarian': vegetarian,
+                 'no_gluten': no_gluten, 'dish_type': dish_type, 'max_cost': max_cost}
+      queryset = Recipe.objects.matching(filters, meal_type).values_list('id', flat=True)
+      plan = queryset.explain(**explain_options)
+      used = [name for name in index_names if name in plan]
+      if not used:
+        missed += 1
+
+      label = ', '.join([f'meal_type={meal_type}' if meal_type else 'все приемы пищи',
+                         *(name for name, value in filters.items() if value is True),
+                         *(f'{name}={value}' for name, value in filters.items()
+                           if value and value is not True)])
+      self.stdout.write(self.style.MIGRATE_HEADING(label))
+      for line in plan.splitlines():
+        self.stdout.write(f'  {line}')
+      if not used:
+        self.stdout.write(self.style.WARNING('  без индекса'))
+
+    self.stdout.write(f'Комбинаций: {len(combinations)}, без индекса: {missed}')
+
+  def _seed(self, count):
+    existing = Recipe.objects.count()
+    meal_types = [value for value, _ in Recipe.MEAL_TYPE_CHOICES]
+    dish_types = [value for value, _ in Recipe.TYPE_CHOICES]
+    rng = random.Random(0)
+    for start in range(existing, count, BATCH_SIZE):
+      # bulk_create не шлет сигналов, total_cost задаем сразу
+      Recipe.objects.bulk_create([
+        Recipe(name=f'Рецепт для EXPLAIN {i}', calories=rng.randint(100, 1200),
+               is_vegetarian=rng.random() < 0.3, no_gluten=rng.random() < 0.2,
+               meal_type=rng.choice(meal_types), dish_type=rng.choice(dish_types),
+               total_cost=Decimal(rng.randint(5000, 150000)) / 100)
+        for i in range(start, min(start + BATCH_SIZE, count))
+      ])
+      self.stdout.write(f'Создано рецептов: {min(start + BATCH_SIZE, count)}')
@@ -0,0 +1,51 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from recipes import images
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+  help = ('Собирает JPEG- и WebP-варианты изображений рецептов, у которых их нет '
+          'или которые собраны для старой картинки')
+
+  def add_arguments(self, parser):
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Сколько изображений обрабатывать параллельно')
+    parser.add_argument('--force', action='store_true',
+                        help='Пересобрать варианты у всех рецептов с картинками')
+
+  def handle(self, *args, **options):
+    rows = (Recipe.objects
+            .exclude(image='').exclude(image__isnull=True)
+            .order_by('pk')
+            .values_list('pk', 'image', 'image_variants__source'))
+    recipe_ids = [pk for pk, image, source in rows.iterator()
+                  if options['force'] or source != image]
+    if not recipe_ids:
+      self.stdout.write('Все варианты уже собраны')
+      return
+
+    started = time.perf_counter()
+    done = failed = 0
+    with ThreadPoolExecutor(max_workers=max(options['workers'], 1)) as pool:
+      futures = [pool.submit(self._generate, recipe_id, options['force'])
+                 for recipe_id in recipe_ids]
+      for future in as_completed(futures):
+        if future.result():
+          done += 1
+        else:
+          failed += 1
+    elapsed = time.perf_counter() - started
+    self.stdout.write(f'Собрано: {done}, пропущено или с ошибкой: {failed}, {elapsed:.1f} с')
+
+  def _generate(self, recipe_id, force):
+    close_old_connections()
+    try:
+      return images.generate(recipe_id, force=force)
+    finally:
+      close_old_connections()
@@ -0,0 +1,42 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from recipes.models import Recipe, UserProfile
+
+
+SEGMENT_FIELDS = ('is_vegetarian', 'no_gluten', 'low_calorie', 'dish_type')
+
+
+class Command(BaseCommand):
+  help = ('Считает пользователей по сохраненным фильтрам одним GROUP BY '
+          'по индексу profile_segment_idx')
+
+  def handle(self, *args, **options):
+    rows = (UserProfile.objects
+            .order_by()
+            .values(*SEGMENT_FIELDS)
+            .annotate(count=Count('*')))
+    total = 0
+    totals = Counter()
+    dish_types = Counter()
+    for row in rows:
+      total += row['count']
+      for field in SEGMENT_FIELDS[:3]:
+        if row[field]:
+          totals[field] += row['count']
+      if row['dish_type']:
+        dish_types[row['dish_type']] += row['count']
+
+    labels = {
+      'is_vegetarian': 'Вегетарианское',
+      'no_gluten': 'Без глютена',
+      'low_calorie': 'Низкокалорийное',
+    }
+    self.stdout.write(f'Профилей: {total}')
+    for field, label in labels.items():
+      self.stdout.write(f'{label}: {totals[field]}')
+    for value, label in Recipe.TYPE_CHOICES:
+      if dish_types[value]:
+        self.stdout.write(f'Тип блюда «{label}»: {dish_types[value]}')
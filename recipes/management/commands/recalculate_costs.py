@@ -0,0 +1,45 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from recipes import recipe_cache
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+  help = 'Пересчитывает сохраненную стоимость рецептов по ингредиентам'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--check', action='store_true',
+                        help='Только проверить расхождения, ничего не меняя')
+    parser.add_argument('--fix', action='store_true',
+                        help='Вместе с --check: пересчитать найденные расхождения')
+
+  def handle(self, *args, **options):
+    if not options['check']:
+      updated = Recipe.objects.update_total_cost()
+      recipe_cache.bump_all()
+      self.stdout.write(self.style.SUCCESS(f'Пересчитано рецептов: {updated}'))
+      return
+
+    mismatched_ids = []
+    recipes = (Recipe.objects.with_actual_cost()
+               .values_list('id', 'total_cost', 'actual_cost')
+               .order_by('id'))
+    for recipe_id, stored, actual in recipes.iterator(chunk_size=2000):
+      stored = Decimal(stored).quantize(Decimal('0.01'))
+      actual = Decimal(actual).quantize(Decimal('0.01'))
+      if stored != actual:
+        mismatched_ids.append(recipe_id)
+        self.stdout.write(f'Рецепт {recipe_id}: сохранено {stored}, по ингредиентам {actual}')
+
+    if not mismatched_ids:
+      self.stdout.write(self.style.SUCCESS('Расхождений не найдено'))
+      return
+
+    if options['fix']:
+      Recipe.objects.filter(pk__in=mismatched_ids).update_total_cost()
+      recipe_cache.bump(mismatched_ids)
+      self.stdout.write(self.style.SUCCESS(f'Исправлено рецептов: {len(mismatched_ids)}'))
+    else:
+      self.stdout.write(self.style.ERROR(f'Найдено расхождений: {len(mismatched_ids)}'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from recipes import recipe_cache
+
+
+class Command(BaseCommand):
+  help = 'Показывает попадания и промахи кэша рецептов и фрагментов'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--reset', action='store_true',
+                        help='Обнулить счетчики после вывода')
+
+  def handle(self, *args, **options):
+    for kind, values in recipe_cache.stats().items():
+      self.stdout.write(
+        f"{kind}: попаданий {values['hits']}, промахов {values['misses']}, "
+        f"доля попаданий {values['ratio']:.1%}"
+      )
+    if options['reset']:
+      recipe_cache.reset_stats()
+      self.stdout.write(self.style.SUCCESS('Счетчики обнулены'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from recipes import bulk_actions
+from recipes.models import BulkJob
+
+
+class Command(BaseCommand):
+  help = 'Выполняет или продолжает незавершенные фоновые задачи админки'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--chunk-size', type=int, default=bulk_actions.CHUNK_SIZE)
+
+  def handle(self, *args, **options):
+    job_ids = BulkJob.objects.filter(status__in=['pending', 'running']).values_list('pk', flat=True)
+    for job_id in list(job_ids):
+      ran = bulk_actions.run(job_id, chunk_size=options['chunk_size'])
+      job = BulkJob.objects.get(pk=job_id)
+      if not ran:
+        self.stdout.write(f'{job}: выполняется другим обработчиком ({job.processed}/{job.total})')
+        continue
+      self.stdout.write(f'{job}: {job.get_status_display()} ({job.processed}/{job.total})')
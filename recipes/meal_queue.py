@@ -0,0 +1,72 @@
+"""Очередь следующих блюд для каждого приема пищи.
+
+В состоянии подбора (recipes/plan_state.py) для каждого приема пищи лежат
+QUEUE_SIZE id рецептов, заранее выбранных взвешенным сэмплером с учетом
+фильтров, лайков и дизлайков.
+Обновление блюда снимает id с головы очереди, а когда в ней остается
+меньше REFILL_AT рецептов, она пополняется одной пачкой. В очереди нет
+повторов и текущего блюда, поэтому обновления не показывают одно и то же
+блюдо подряд.
+
+Очередь помнит версию индекса кандидатов, фильтры и аллергены, под которые собрана,
+и пересобирается, если каталог или фильтры изменились.
+"""
+from . import candidates, sampling
+
+
+STATE_KEY = 'meal_queue'
+QUEUE_SIZE = 8
+REFILL_AT = 2
+
+
+def _signature(filters, allergen_mask):
+  return [candidates.current_version(), *candidates.filter_signature(filters),
+          candidates.parse_max_cost(filters.get('max_cost')), allergen_mask]
+
+
+def _fill(queue, meal_type, filters, current_id, liked_ids, disliked_ids, allergen_mask):
+  sampler = sampling.get_sampler(meal_type, filters, liked_ids, disliked_ids, allergen_mask)
+  taken = set(queue)
+  if current_id:
+    taken.add(current_id)
+  while len(queue) < QUEUE_SIZE:
+    recipe_id = sampler.pick(exclude=taken)
+    if recipe_id is None:
+      break
+    queue.append(recipe_id)
+    taken.add(recipe_id)
+
+
+def pop(state, meal_type, filters, current_id, preferences):
+  """Следующий id для meal_type или None, если подходящих рецептов нет.
+
+  preferences — объект с liked_ids, disliked_ids и allergen_mask (снимок
+  plan_cache), нужен при пополнении очереди.
+  """
+  queues = state.get(STATE_KEY, {})
+  allergen_mask = preferences.allergen_mask if preferences is not None else 0
+  signature = _signature(filters, allergen_mask)
+  entry = queues.get(meal_type)
+  queue = entry['ids'] if entry and entry['signature'] == signature else []
+  queue = [recipe_id for recipe_id in queue if recipe_id != current_id]
+
+  if len(queue) < REFILL_AT:
+    liked_ids, disliked_ids = ((preferences.liked_ids, preferences.disliked_ids)
+                               if preferences is not None else ((), ()))
+    _fill(queue, meal_type, filters, current_id, liked_ids, disliked_ids, allergen_mask)
+
+  recipe_id = queue.pop(0) if queue else None
+  queues[meal_type] = {'signature': signature, 'ids': queue}
+  state[STATE_KEY] = queues
+  return recipe_id
+
+
+def discard(state, recipe_id):
+  """Убирает рецепт из всех очередей, например после дизлайка."""
+  queues = state.get(STATE_KEY)
+  if not queues:
+    return
+  for entry in queues.values():
+    if recipe_id in entry['ids']:
+      entry['ids'].remove(recipe_id)
+  state[STATE_KEY] = queues
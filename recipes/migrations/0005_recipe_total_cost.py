@@ -0,0 +1,40 @@
+# Generated by Django 5.2.7 on 2026-10-17 04:15
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_total_cost(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    db_alias = schema_editor.connection.alias
+    costs = (Ingredient.objects.using(db_alias)
+             .filter(recipes=OuterRef('pk'))
+             .order_by()
+             .values('recipes')
+             .annotate(total=Sum('cost'))
+             .values('total'))
+    output_field = models.DecimalField(max_digits=12, decimal_places=2)
+    Recipe.objects.using(db_alias).update(total_cost=Coalesce(
+        Subquery(costs, output_field=output_field),
+        Value(Decimal('0.00')),
+        output_field=output_field,
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_recipe_meal_type_userprofile_breakfast_blocked_until_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='total_cost',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=Decimal('0.00'), editable=False, max_digits=12, verbose_name='Стоимость (₽)'),
+        ),
+        migrations.RunPython(fill_total_cost, migrations.RunPython.noop),
+    ]
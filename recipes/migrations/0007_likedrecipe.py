@@ -0,0 +1,49 @@
+# Generated by Django 5.2.7 on 2026-10-17 04:25
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_bulkjob'),
+    ]
+
+    operations = [
+        # Таблица связей liked_recipes уже существует: описываем ее моделью
+        # LikedRecipe, не трогая БД, и затем добавляем дату лайка.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='LikedRecipe',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='recipes.recipe', verbose_name='Рецепт')),
+                        ('userprofile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='recipes.userprofile', verbose_name='Профиль пользователя')),
+                    ],
+                    options={
+                        'verbose_name': 'Лайкнутый рецепт',
+                        'verbose_name_plural': 'Лайкнутые рецепты',
+                        'db_table': 'recipes_userprofile_liked_recipes',
+                        'unique_together': {('userprofile', 'recipe')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='userprofile',
+                    name='liked_recipes',
+                    field=models.ManyToManyField(blank=True, related_name='liked_by', through='recipes.LikedRecipe', to='recipes.recipe', verbose_name='Лайкнутые рецепты'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='likedrecipe',
+            name='liked_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата лайка'),
+        ),
+        migrations.AddIndex(
+            model_name='likedrecipe',
+            index=models.Index(fields=['userprofile', '-liked_at', '-id'], name='liked_recipe_keyset_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.7 on 2026-10-17 04:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_likedrecipe'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['meal_type', 'is_vegetarian', 'no_gluten', 'dish_type', 'calories'], name='recipe_filter_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['meal_type', 'total_cost'], name='recipe_meal_cost_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(condition=models.Q(('calories__lt', 500)), fields=['meal_type', 'dish_type', 'total_cost'], name='recipe_low_calorie_idx'),
+        ),
+    ]
@@ -0,0 +1,121 @@
+# Generated by Django 5.2.7 on 2026-10-17 04:48
+
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+MEAL_TYPES = ('breakfast', 'lunch', 'dinner')
+FILTER_FIELDS = ['meal_types', 'low_calorie', 'is_vegetarian', 'no_gluten', 'dish_type', 'max_cost']
+BATCH_SIZE = 1000
+
+
+def parse_cost(value):
+    if value in (None, ''):
+        return None
+    try:
+        cost = Decimal(str(value))
+    except (InvalidOperation, ValueError, TypeError):
+        return None
+    if not cost.is_finite() or abs(cost) >= Decimal('1e10'):
+        return None
+    return cost.quantize(Decimal('0.01'))
+
+
+def filters_to_columns(apps, schema_editor):
+    UserProfile = apps.get_model('recipes', 'UserProfile')
+    profiles = (UserProfile.objects.using(schema_editor.connection.alias)
+                .exclude(filters={}).only('pk', 'filters'))
+    batch = []
+    for profile in profiles.iterator(chunk_size=BATCH_SIZE):
+        filters = profile.filters if isinstance(profile.filters, dict) else {}
+        meal_types = filters.get('meal_types')
+        profile.meal_types = ','.join(meal_type for meal_type in meal_types or []
+                                      if meal_type in MEAL_TYPES)
+        profile.low_calorie = bool(filters.get('low_calorie'))
+        profile.is_vegetarian = bool(filters.get('is_vegetarian'))
+        profile.no_gluten = bool(filters.get('no_gluten'))
+        profile.dish_type = str(filters.get('dish_type') or '')[:20]
+        profile.max_cost = parse_cost(filters.get('max_cost'))
+        batch.append(profile)
+        if len(batch) >= BATCH_SIZE:
+            UserProfile.objects.using(schema_editor.connection.alias).bulk_update(batch, FILTER_FIELDS)
+            batch = []
+    if batch:
+        UserProfile.objects.using(schema_editor.connection.alias).bulk_update(batch, FILTER_FIELDS)
+
+
+def columns_to_filters(apps, schema_editor):
+    UserProfile = apps.get_model('recipes', 'UserProfile')
+    profiles = UserProfile.objects.using(schema_editor.connection.alias).only('pk', *FILTER_FIELDS)
+    batch = []
+    for profile in profiles.iterator(chunk_size=BATCH_SIZE):
+        filters = {}
+        if profile.meal_types:
+            filters['meal_types'] = profile.meal_types.split(',')
+        for field in ('low_calorie', 'is_vegetarian', 'no_gluten'):
+            if getattr(profile, field):
+                filters[field] = True
+        if profile.dish_type:
+            filters['dish_type'] = profile.dish_type
+        if profile.max_cost is not None:
+            filters['max_cost'] = str(profile.max_cost)
+        if filters:
+            profile.filters = filters
+            batch.append(profile)
+        if len(batch) >= BATCH_SIZE:
+            UserProfile.objects.using(schema_editor.connection.alias).bulk_update(batch, ['filters'])
+            batch = []
+    if batch:
+        UserProfile.objects.using(schema_editor.connection.alias).bulk_update(batch, ['filters'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_recipe_filter_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='dish_type',
+            field=models.CharField(blank=True, choices=[('fish', 'Рыба и морепродукты'), ('meat', 'Мясо'), ('grains', 'Зерновые'), ('honey', 'Продукты пчеловодства'), ('nuts', 'Орехи и бобовые'), ('dairy', 'Молочные продукты')], max_length=20, verbose_name='Тип блюда'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='is_vegetarian',
+            field=models.BooleanField(default=False, verbose_name='Вегетарианское'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='low_calorie',
+            field=models.BooleanField(default=False, verbose_name='Низкокалорийное'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='max_cost',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True, verbose_name='Максимальная стоимость (₽)'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='meal_types',
+            field=models.CharField(blank=True, max_length=50, verbose_name='Приемы пищи (через запятую)'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='no_gluten',
+            field=models.BooleanField(default=False, verbose_name='Без глютена'),
+        ),
+        migrations.RunPython(filters_to_columns, columns_to_filters),
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='filters',
+        ),
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(fields=['is_vegetarian', 'no_gluten', 'low_calorie', 'dish_type'], name='profile_segment_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.7 on 2026-10-17 04:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_userprofile_filter_columns'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Allergen',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='Название')),
+                ('mask', models.BigIntegerField(editable=False, unique=True, verbose_name='Бит маски')),
+            ],
+            options={
+                'verbose_name': 'Аллерген',
+                'verbose_name_plural': 'Аллергены',
+            },
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='allergen_mask',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='Аллергены (маска)'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='allergen_mask',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='Аллергены (маска)'),
+        ),
+        migrations.AddField(
+            model_name='ingredient',
+            name='allergens',
+            field=models.ManyToManyField(blank=True, related_name='ingredients', to='recipes.allergen', verbose_name='Аллергены'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='allergens',
+            field=models.ManyToManyField(blank=True, related_name='profiles', to='recipes.allergen', verbose_name='Исключаемые аллергены'),
+        ),
+    ]
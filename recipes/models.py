@@ -1,17 +1,119 @@
-from datetime import timedelta
+import logging
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
 
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models import F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import Exact
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
 
+from . import quota
+
+
+logger = logging.getLogger(__name__)
+
+# Порог фильтра low_calorie; на него же завязан частичный индекс Recipe
+LOW_CALORIE_LIMIT = 500
+# UserProfile.max_cost — DecimalField(max_digits=12, decimal_places=2)
+MAX_COST_LIMIT = Decimal('1e10')
+
+
+def parse_cost(value):
+  """Decimal из max_cost формы или сессии; None — если не задан или невалиден.
+
+  Значение округляется до копеек, а отрицательные и не влезающие в
+  UserProfile.max_cost считаются невалидными: иначе профиль сохранился бы
+  с числом, которое потом не читается из базы.
+  """
+  if value in (None, ''):
+    return None
+  try:
+    cost = Decimal(str(value))
+  except (InvalidOperation, ValueError, TypeError):
+    logger.warning("Invalid max_cost value in filters")
+    return None
+  if not cost.is_finite() or cost < 0 or cost >= MAX_COST_LIMIT:
+    logger.warning("Invalid max_cost value in filters")
+    return None
+  return cost.quantize(Decimal('0.01'))
+
+
+@lru_cache(maxsize=1024)
+def recipe_filter_q(meal_type=None, low_calorie=False, is_vegetarian=False, no_gluten=False,
+                    dish_type=None, max_cost=None, allergen_mask=0):
+  """Условие отбора рецептов, собранное один раз на комбинацию фильтров.
+
+  Условия идут в порядке столбцов индексов из Recipe.Meta: сначала
+  равенства, затем диапазоны по калорийности и стоимости. Q не меняется
+  при использовании в filter(), поэтому его можно кэшировать.
+  """
+  q = Q()
+  if meal_type:
+    q &= Q(meal_type=meal_type)
+  # filter(flag=True) Django пишет как голый столбец, и SQLite не считает
+  # его равенством для префикса составного индекса; IN (1) считает
+  if is_vegetarian:
+    q &= Q(is_vegetarian__in=[True])
+  if no_gluten:
+    q &= Q(no_gluten__in=[True])
+  if dish_type:
+    q &= Q(dish_type=dish_type)
+  if low_calorie:
+    q &= Q(calories__lt=LOW_CALORIE_LIMIT)
+  if max_cost is not None:
+    q &= Q(total_cost__lte=max_cost)
+  if allergen_mask:
+    # Одна проверка столбца рецепта вместо JOIN по ингредиентам
+    q &= Q(Exact(F('allergen_mask').bitand(allergen_mask), 0))
+  return q
+
+
+class Allergen(models.Model):
+  # Маска — один бит в BigIntegerField; старший (знаковый) бит не используем
+  MAX_ALLERGENS = 63
+
+  name = models.CharField(max_length=100, unique=True, verbose_name='Название')
+  mask = models.BigIntegerField(unique=True, editable=False, verbose_name='Бит маски')
+
+  def clean(self):
+    if not self.mask:
+      self.mask = self.free_mask()
+
+  def save(self, *args, **kwargs):
+    if not self.mask:
+      self.mask = self.free_mask()
+    super().save(*args, **kwargs)
+
+  @classmethod
+  def free_mask(cls):
+    """Младший бит, не занятый другими аллергенами."""
+    used = set(cls.objects.values_list('mask', flat=True))
+    for bit in range(cls.MAX_ALLERGENS):
+      if 1 << bit not in used:
+        return 1 << bit
+    raise ValidationError(f'Нельзя завести больше {cls.MAX_ALLERGENS} аллергенов')
+
+  def __str__(self):
+    return self.name
+
+  class Meta:
+    verbose_name = 'Аллерген'
+    verbose_name_plural = 'Аллергены'
+
 
 class Ingredient(models.Model):
   name = models.CharField(max_length=100, verbose_name='Название')
   weight = models.FloatField(verbose_name='Вес (г)')
   cost = models.DecimalField(max_digits=10, decimal_places=2,
                             verbose_name='Стоимость (₽)')
+  allergens = models.ManyToManyField(Allergen, related_name='ingredients', blank=True,
+                                     verbose_name='Аллергены')
+  updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата изменения')
 
   def __str__(self):
     return f"{self.name} ({self.weight}г, {self.cost}₽)"
@@ -21,6 +123,56 @@ class Ingredient(models.Model):
     verbose_name_plural = 'Ингредиенты'
 
 
+class RecipeQuerySet(models.QuerySet):
+  def with_actual_cost(self):
+    """Добавляет actual_cost — стоимость, посчитанную по ингредиентам."""
+    return self.annotate(actual_cost=_ingredients_cost_subquery())
+
+  def update_total_cost(self):
+    """Пересчитывает сохраненную стоимость одним UPDATE."""
+    return self.update(total_cost=_ingredients_cost_subquery(), updated_at=timezone.now())
+
+  def update_allergen_mask(self):
+    return self.update(allergen_mask=_allergen_mask_subquery())
+
+  def update_from_ingredients(self):
+    """Пересчитывает стоимость и маску аллергенов одним UPDATE."""
+    return self.update(total_cost=_ingredients_cost_subquery(),
+                       allergen_mask=_allergen_mask_subquery(), updated_at=timezone.now())
+
+  def matching(self, filters, meal_type=None, allergen_mask=0):
+    """Рецепты, подходящие под словарь фильтров (сессия, формы)."""
+    return self.filter(recipe_filter_q(
+      meal_type or None, bool(filters.get('low_calorie')), bool(filters.get('is_vegetarian')),
+      bool(filters.get('no_gluten')), filters.get('dish_type') or None,
+      parse_cost(filters.get('max_cost')), allergen_mask))
+
+
+def _ingredients_cost_subquery():
+  costs = (Ingredient.objects
+           .filter(recipes=OuterRef('pk'))
+           .order_by()
+           .values('recipes')
+           .annotate(total=Sum('cost'))
+           .values('total'))
+  return Coalesce(
+    Subquery(costs, output_field=models.DecimalField(max_digits=12, decimal_places=2)),
+    Value(Decimal('0.00')),
+    output_field=models.DecimalField(max_digits=12, decimal_places=2),
+  )
+
+
+def _allergen_mask_subquery():
+  # Биты аллергенов различны, поэтому сумма различных масок равна их OR
+  masks = (Allergen.objects
+           .filter(ingredients__recipes=OuterRef('pk'))
+           .order_by()
+           .values('ingredients__recipes')
+           .annotate(total=Sum('mask', distinct=True))
+           .values('total'))
+  return Coalesce(Subquery(masks, output_field=models.BigIntegerField()), Value(0))
+
+
 class Recipe(models.Model):
   DIET_CHOICES = [
     ('low_calorie', 'Низкокалорийное'),
@@ -45,6 +197,14 @@ class Recipe(models.Model):
   name = models.CharField(max_length=200, verbose_name='Название')
   image = models.ImageField(upload_to='recipes/', null=True, blank=True,
                            verbose_name='Изображение')
+  # Размеры оригинала и уменьшенные копии (recipes/images.py); width_field
+  # у ImageField не используем — он открывал бы файл при загрузке модели
+  image_width = models.PositiveIntegerField(null=True, blank=True, editable=False,
+                                            verbose_name='Ширина изображения')
+  image_height = models.PositiveIntegerField(null=True, blank=True, editable=False,
+                                             verbose_name='Высота изображения')
+  image_variants = models.JSONField(default=dict, blank=True, editable=False,
+                                    verbose_name='Варианты изображения')
   ingredients = models.ManyToManyField(Ingredient, related_name='recipes',
                                       verbose_name='Ингредиенты')
   calories = models.IntegerField(verbose_name='Калорийность (ккал)')
@@ -55,29 +215,90 @@ class Recipe(models.Model):
                               verbose_name='Тип блюда')
   no_gluten = models.BooleanField(default=False, verbose_name='Без глютена')
   created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+  # Вместе с updated_at ингредиентов дает Last-Modified карточки
+  # (recipes/page_cache.py); массовые UPDATE выставляют его сами
+  updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата изменения')
 
   meal_type = models.CharField(max_length=20, choices=MEAL_TYPE_CHOICES,
                                default='lunch', verbose_name='Тип приема пищи')
-
-  @property
-  def total_cost(self):
-    return sum(ingredient.cost for ingredient in self.ingredients.all())
+  # Денормализованная сумма Ingredient.cost, поддерживается сигналами ниже
+  total_cost = models.DecimalField(max_digits=12, decimal_places=2,
+                                   default=Decimal('0.00'), editable=False,
+                                   db_index=True, verbose_name='Стоимость (₽)')
+  # OR масок аллергенов всех ингредиентов, поддерживается сигналами ниже
+  allergen_mask = models.BigIntegerField(default=0, editable=False,
+                                         verbose_name='Аллергены (маска)')
+
+  objects = RecipeQuerySet.as_manager()
+
+  def calculate_total_cost(self):
+    total = self.ingredients.aggregate(total=Sum('cost'))['total']
+    return total if total is not None else Decimal('0.00')
+
+  def calculate_allergen_mask(self):
+    masks = Allergen.objects.filter(ingredients__recipes=self).values_list('mask', flat=True)
+    return sum(set(masks))
+
+  def save(self, *args, **kwargs):
+    # Экземпляр в памяти мог устареть после изменения ингредиентов
+    if self.pk:
+      self.total_cost = self.calculate_total_cost()
+      self.allergen_mask = self.calculate_allergen_mask()
+    super().save(*args, **kwargs)
 
   def __str__(self):
     return self.name
 
   class Meta:
+    indexes = [
+      # Равенства по приему пищи и флагам, диапазон по калорийности последним
+      models.Index(fields=['meal_type', 'is_vegetarian', 'no_gluten', 'dish_type', 'calories'],
+                   name='recipe_filter_idx'),
+      # Только max_cost или без фильтров: срез по стоимости внутри приема пищи
+      models.Index(fields=['meal_type', 'total_cost'], name='recipe_meal_cost_idx'),
+      # Низкокалорийные: строки с calories >= LOW_CALORIE_LIMIT в индекс не попадают
+      models.Index(fields=['meal_type', 'dish_type', 'total_cost'], name='recipe_low_calorie_idx',
+                   condition=Q(calories__lt=LOW_CALORIE_LIMIT)),
+    ]
     verbose_name = 'Рецепт'
     verbose_name_plural = 'Рецепты'
 
 
+class UserProfileQuerySet(models.QuerySet):
+  def update_allergen_mask(self):
+    masks = (Allergen.objects
+             .filter(profiles=OuterRef('pk'))
+             .order_by()
+             .values('profiles')
+             .annotate(total=Sum('mask'))
+             .values('total'))
+    return self.update(allergen_mask=Coalesce(
+      Subquery(masks, output_field=models.BigIntegerField()), Value(0)))
+
+
 class UserProfile(models.Model):
   user = models.OneToOneField(User, on_delete=models.CASCADE, verbose_name='Пользователь')
-  liked_recipes = models.ManyToManyField(Recipe, related_name='liked_by', blank=True, verbose_name='Лайкнутые рецепты')
+  liked_recipes = models.ManyToManyField(Recipe, related_name='liked_by', blank=True,
+                                         through='LikedRecipe', verbose_name='Лайкнутые рецепты')
   disliked_recipes = models.ManyToManyField(Recipe, related_name='disliked_by', blank=True,
                                             verbose_name='Дизлайкнутые рецепты')
   allergies = models.CharField(max_length=200, blank=True, verbose_name='Аллергии')
-  filters = models.JSONField(default=dict, blank=True, verbose_name='Фильтры пользователя')
+  allergens = models.ManyToManyField(Allergen, related_name='profiles', blank=True,
+                                     verbose_name='Исключаемые аллергены')
+  # OR масок allergens, поддерживается сигналами ниже
+  allergen_mask = models.BigIntegerField(default=0, editable=False,
+                                         verbose_name='Аллергены (маска)')
+
+  # Сохраненные фильтры подбора; словарь в прежнем формате отдает свойство filters
+  meal_types = models.CharField(max_length=50, blank=True,
+                                verbose_name='Приемы пищи (через запятую)')
+  low_calorie = models.BooleanField(default=False, verbose_name='Низкокалорийное')
+  is_vegetarian = models.BooleanField(default=False, verbose_name='Вегетарианское')
+  no_gluten = models.BooleanField(default=False, verbose_name='Без глютена')
+  dish_type = models.CharField(max_length=20, choices=Recipe.TYPE_CHOICES, blank=True,
+                               verbose_name='Тип блюда')
+  max_cost = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True,
+                                 verbose_name='Максимальная стоимость (₽)')
 
   breakfast_refresh_count = models.IntegerField(default=0, verbose_name='Счетчик обновлений завтрака')
   lunch_refresh_count = models.IntegerField(default=0, verbose_name='Счетчик обновлений обеда')
@@ -88,114 +309,274 @@ class UserProfile(models.Model):
   lunch_blocked_until = models.DateTimeField(null=True, blank=True, verbose_name='Блокировка обеда до')
   dinner_blocked_until = models.DateTimeField(null=True, blank=True, verbose_name='Блокировка ужина до')
 
+  objects = UserProfileQuerySet.as_manager()
+
   def __str__(self):
     return self.user.username
 
-  def reset_refresh_counts(self):
-    now = timezone.now()
-    if now - self.last_refresh_date > timedelta(hours=24):
-      self.breakfast_refresh_count = 0
-      self.lunch_refresh_count = 0
-      self.dinner_refresh_count = 0
-      self.last_refresh_date = now
-      self.breakfast_blocked_until = None
-      self.lunch_blocked_until = None
-      self.dinner_blocked_until = None
-      self.save()
+  @staticmethod
+  def filter_values(filters):
+    """Значения столбцов фильтров для словаря в формате формы и сессии."""
+    meal_types = [meal_type for meal_type in filters.get('meal_types') or []
+                  if meal_type in quota.MEAL_TYPES]
+    return {
+      'meal_types': ','.join(meal_types),
+      'low_calorie': bool(filters.get('low_calorie')),
+      'is_vegetarian': bool(filters.get('is_vegetarian')),
+      'no_gluten': bool(filters.get('no_gluten')),
+      'dish_type': filters.get('dish_type') or '',
+      'max_cost': parse_cost(filters.get('max_cost')),
+    }
+
+  @property
+  def filters(self):
+    """Фильтры словарем, как их собирает apply_filters: только заданные ключи."""
+    filters = {}
+    if self.meal_types:
+      filters['meal_types'] = self.meal_types.split(',')
+    for field in ('low_calorie', 'is_vegetarian', 'no_gluten'):
+      if getattr(self, field):
+        filters[field] = True
+    if self.dish_type:
+      filters['dish_type'] = self.dish_type
+    if self.max_cost is not None:
+      filters['max_cost'] = self.max_cost
+    return filters
+
+  @filters.setter
+  def filters(self, filters):
+    for field, value in self.filter_values(filters or {}).items():
+      setattr(self, field, value)
+
+  def recipe_filter(self, meal_type=None):
+    """Q для подбора рецептов по сохраненным фильтрам."""
+    return recipe_filter_q(meal_type or None, self.low_calorie, self.is_vegetarian,
+                           self.no_gluten, self.dish_type or None, self.max_cost,
+                           self.allergen_mask)
+
+  def refresh_status(self, meal_type):
+    """Состояние лимита обновлений приема пищи; ничего не записывает."""
+    return quota.get_backend().status(self, meal_type)
 
   def can_refresh_breakfast(self):
-    self.reset_refresh_counts()
-    if self.breakfast_blocked_until and timezone.now() < self.breakfast_blocked_until:
-      return False
-    return self.breakfast_refresh_count < 3
+    return self.refresh_status('breakfast').allowed
 
   def can_refresh_lunch(self):
-    self.reset_refresh_counts()
-    if self.lunch_blocked_until and timezone.now() < self.lunch_blocked_until:
-      return False
-    return self.lunch_refresh_count < 3
+    return self.refresh_status('lunch').allowed
 
   def can_refresh_dinner(self):
-    self.reset_refresh_counts()
-    if self.dinner_blocked_until and timezone.now() < self.dinner_blocked_until:
-      return False
-    return self.dinner_refresh_count < 3
+    return self.refresh_status('dinner').allowed
 
-  def refresh_breakfast(self):
-    self.reset_refresh_counts()
-    self.breakfast_refresh_count += 1
-    self.last_refresh_date = timezone.now()
+  def _consume_refresh(self, meal_type):
+    """Атомарно списывает обновление и отражает новые значения в экземпляре."""
+    from . import plan_cache
 
-    if self.breakfast_refresh_count >= 3:
-      self.breakfast_blocked_until = timezone.now() + timedelta(hours=24)
+    now = timezone.now()
+    values = quota.transition(self, [meal_type], now)
+    if not quota.get_backend().consume(self, meal_type, now):
+      return False
+    for field, value in values.items():
+      setattr(self, field, value)
+    # Счетчики в снимке страницы подбора устарели
+    plan_cache.invalidate([self.user_id])
+    return True
 
-    self.save()
+  async def arefresh_status(self, meal_type):
+    return await quota.get_backend().astatus(self, meal_type)
 
-  def refresh_lunch(self):
-    self.reset_refresh_counts()
-    self.lunch_refresh_count += 1
-    self.last_refresh_date = timezone.now()
+  async def aconsume_refresh(self, meal_type):
+    """Асинхронный вариант _consume_refresh для async-представлений."""
+    from . import plan_cache
 
-    if self.lunch_refresh_count >= 3:
-      self.lunch_blocked_until = timezone.now() + timedelta(hours=24)
-
-    self.save()
+    now = timezone.now()
+    values = quota.transition(self, [meal_type], now)
+    if not await quota.get_backend().aconsume(self, meal_type, now):
+      return False
+    for field, value in values.items():
+      setattr(self, field, value)
+    await plan_cache.ainvalidate([self.user_id])
+    return True
 
-  def refresh_dinner(self):
-    self.reset_refresh_counts()
-    self.dinner_refresh_count += 1
-    self.last_refresh_date = timezone.now()
+  def refresh_breakfast(self):
+    return self._consume_refresh('breakfast')
 
-    if self.dinner_refresh_count >= 3:
-      self.dinner_blocked_until = timezone.now() + timedelta(hours=24)
+  def refresh_lunch(self):
+    return self._consume_refresh('lunch')
 
-    self.save()
+  def refresh_dinner(self):
+    return self._consume_refresh('dinner')
 
   def apply_filters_breakfast(self):
-    self.reset_refresh_counts()
-    if self.breakfast_refresh_count < 3:
-      self.breakfast_refresh_count += 1
-      self.last_refresh_date = timezone.now()
-
-      if self.breakfast_refresh_count >= 3:
-        self.breakfast_blocked_until = timezone.now() + timedelta(hours=24)
-
-      self.save()
-      return True
-    return False
+    return self._consume_refresh('breakfast')
 
   def apply_filters_lunch(self):
-    self.reset_refresh_counts()
-    if self.lunch_refresh_count < 3:
-      self.lunch_refresh_count += 1
-      self.last_refresh_date = timezone.now()
+    return self._consume_refresh('lunch')
 
-      if self.lunch_refresh_count >= 3:
-        self.lunch_blocked_until = timezone.now() + timedelta(hours=24)
+  def apply_filters_dinner(self):
+    return self._consume_refresh('dinner')
 
-      self.save()
-      return True
-    return False
+  class Meta:
+    indexes = [
+      # Сегменты пользователей: GROUP BY по этим столбцам читает только индекс
+      models.Index(fields=['is_vegetarian', 'no_gluten', 'low_calorie', 'dish_type'],
+                   name='profile_segment_idx'),
+    ]
+    verbose_name = 'Профиль пользователя'
+    verbose_name_plural = 'Профили пользователей'
 
-  def apply_filters_dinner(self):
-    self.reset_refresh_counts()
-    if self.dinner_refresh_count < 3:
-      self.dinner_refresh_count += 1
-      self.last_refresh_date = timezone.now()
 
-      if self.dinner_refresh_count >= 3:
-        self.dinner_blocked_until = timezone.now() + timedelta(hours=24)
+class LikedRecipe(models.Model):
+  userprofile = models.ForeignKey(UserProfile, on_delete=models.CASCADE,
+                                  verbose_name='Профиль пользователя')
+  recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, verbose_name='Рецепт')
+  liked_at = models.DateTimeField(default=timezone.now, verbose_name='Дата лайка')
 
-      self.save()
-      return True
-    return False
+  def __str__(self):
+    return f'{self.userprofile} — {self.recipe}'
 
   class Meta:
-    verbose_name = 'Профиль пользователя'
-    verbose_name_plural = 'Профили пользователей'
+    # Таблица, которую раньше Django создавал для liked_recipes автоматически
+    db_table = 'recipes_userprofile_liked_recipes'
+    unique_together = [('userprofile', 'recipe')]
+    indexes = [
+      models.Index(fields=['userprofile', '-liked_at', '-id'], name='liked_recipe_keyset_idx'),
+    ]
+    verbose_name = 'Лайкнутый рецепт'
+    verbose_name_plural = 'Лайкнутые рецепты'
 
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
   if created:
-    UserProfile.objects.create(user=instance)
\ No newline at end of file
+    UserProfile.objects.create(user=instance)
+
+
+@receiver(m2m_changed, sender=Recipe.ingredients.through)
+def update_recipe_total_cost(sender, instance, action, reverse, pk_set, **kwargs):
+  if action == 'pre_clear' and reverse:
+    instance._cleared_recipe_ids = list(instance.recipes.values_list('id', flat=True))
+    return
+  if action not in ('post_add', 'post_remove', 'post_clear'):
+    return
+
+  if not reverse:
+    Recipe.objects.filter(pk=instance.pk).update_from_ingredients()
+    instance.total_cost = instance.calculate_total_cost()
+    instance.allergen_mask = instance.calculate_allergen_mask()
+    return
+
+  if action == 'post_clear':
+    recipe_ids = getattr(instance, '_cleared_recipe_ids', [])
+  else:
+    recipe_ids = pk_set or []
+  if recipe_ids:
+    Recipe.objects.filter(pk__in=recipe_ids).update_from_ingredients()
+
+
+@receiver(post_save, sender=Ingredient)
+def update_ingredient_recipes_cost(sender, instance, created, update_fields=None, **kwargs):
+  if created:
+    return
+  if update_fields is not None and 'cost' not in update_fields:
+    return
+  Recipe.objects.filter(ingredients=instance).update_total_cost()
+
+
+@receiver(pre_delete, sender=Ingredient)
+def remember_ingredient_recipes(sender, instance, **kwargs):
+  instance._recipe_ids = list(instance.recipes.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Ingredient)
+def update_deleted_ingredient_recipes_cost(sender, instance, **kwargs):
+  recipe_ids = getattr(instance, '_recipe_ids', [])
+  if recipe_ids:
+    Recipe.objects.filter(pk__in=recipe_ids).update_from_ingredients()
+
+
+@receiver(m2m_changed, sender=Ingredient.allergens.through)
+def update_recipe_allergen_mask(sender, instance, action, reverse, pk_set, **kwargs):
+  if action == 'pre_clear':
+    instance._allergen_recipe_ids = _allergen_recipe_ids(instance, reverse)
+    return
+  if action not in ('post_add', 'post_remove', 'post_clear'):
+    return
+
+  if action != 'post_clear':
+    ingredient_ids = pk_set if reverse else [instance.pk]
+    instance._allergen_recipe_ids = list(Recipe.objects
+                                         .filter(ingredients__in=ingredient_ids or [])
+                                         .values_list('id', flat=True).distinct())
+  recipe_ids = getattr(instance, '_allergen_recipe_ids', [])
+  if recipe_ids:
+    Recipe.objects.filter(pk__in=recipe_ids).update_allergen_mask()
+
+
+def _allergen_recipe_ids(instance, reverse):
+  lookup = 'ingredients__allergens' if reverse else 'ingredients'
+  return list(Recipe.objects.filter(**{lookup: instance}).values_list('id', flat=True).distinct())
+
+
+@receiver(pre_delete, sender=Allergen)
+def remember_allergen_owners(sender, instance, **kwargs):
+  instance._allergen_recipe_ids = _allergen_recipe_ids(instance, reverse=True)
+  instance._profile_ids = list(instance.profiles.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Allergen)
+def update_deleted_allergen_masks(sender, instance, **kwargs):
+  recipe_ids = getattr(instance, '_allergen_recipe_ids', [])
+  if recipe_ids:
+    Recipe.objects.filter(pk__in=recipe_ids).update_allergen_mask()
+  profile_ids = getattr(instance, '_profile_ids', [])
+  if profile_ids:
+    UserProfile.objects.filter(pk__in=profile_ids).update_allergen_mask()
+
+
+@receiver(m2m_changed, sender=UserProfile.allergens.through)
+def update_profile_allergen_mask(sender, instance, action, reverse, pk_set, **kwargs):
+  if action == 'pre_clear' and reverse:
+    instance._profile_ids = list(instance.profiles.values_list('id', flat=True))
+    return
+  if action not in ('post_add', 'post_remove', 'post_clear'):
+    return
+
+  if not reverse:
+    UserProfile.objects.filter(pk=instance.pk).update_allergen_mask()
+    instance.allergen_mask = sum(set(instance.allergens.values_list('mask', flat=True)))
+    return
+  profile_ids = getattr(instance, '_profile_ids', []) if action == 'post_clear' else pk_set
+  if profile_ids:
+    UserProfile.objects.filter(pk__in=profile_ids).update_allergen_mask()
+
+
+class BulkJob(models.Model):
+  STATUS_CHOICES = [
+    ('pending', 'Ожидает'),
+    ('running', 'Выполняется'),
+    ('done', 'Завершена'),
+    ('failed', 'Ошибка'),
+  ]
+
+  action = models.CharField(max_length=50, verbose_name='Действие')
+  object_ids = models.JSONField(default=list, verbose_name='Профили')
+  total = models.IntegerField(default=0, verbose_name='Всего')
+  processed = models.IntegerField(default=0, verbose_name='Обработано')
+  status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending',
+                            verbose_name='Статус')
+  error = models.TextField(blank=True, verbose_name='Ошибка')
+  # Аренда выполняющейся задачи: обработчик продлевает ее после каждой пачки
+  # (recipes/bulk_actions.py), чужую задачу можно продолжить, только когда
+  # аренда истекла
+  heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name='Последний отклик')
+  created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                                 verbose_name='Запустил')
+  created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создана')
+  finished_at = models.DateTimeField(null=True, blank=True, verbose_name='Завершена')
+
+  def __str__(self):
+    return f'{self.action} #{self.pk}'
+
+  class Meta:
+    verbose_name = 'Фоновая задача'
+    verbose_name_plural = 'Фоновые задачи'
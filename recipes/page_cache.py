@@ -0,0 +1,124 @@
+"""HTTP-кэширование страниц для браузеров и обратного прокси.
+
+recipe_card отвечает на условные запросы: Last-Modified — самый поздний
+updated_at рецепта и его ингредиентов, ETag добавляет к нему, вошел ли
+пользователь (от этого зависит шапка страницы). Рецепт берется из
+recipe_cache, поэтому ответ 304 обычно не стоит ни одного запроса к базе.
+
+index для анонимов целиком лежит в кэше RECIPES_FRAGMENT_CACHE и
+отдается с ETag по содержимому. В шаблон такой страницы нельзя класть
+ничего личного, в том числе csrf_token.
+
+Анонимные ответы помечаются public и могут кэшироваться прокси на
+RECIPES_PAGE_MAX_AGE секунд, ответы вошедшим — private и перепроверяются
+браузером при каждом показе. Везде ставится Vary: Cookie.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
+from django.views.decorators.http import condition
+
+from . import recipe_cache
+
+
+PAGE_KEY_PREFIX = 'recipes:page'
+
+
+def _max_age():
+  return getattr(settings, 'RECIPES_PAGE_MAX_AGE', 60)
+
+
+def _page_timeout():
+  return getattr(settings, 'RECIPES_PAGE_CACHE_TIMEOUT', 60 * 10)
+
+
+def patch_page_headers(request, response):
+  if request.user.is_authenticated:
+    patch_cache_control(response, private=True, no_cache=True)
+  else:
+    patch_cache_control(response, public=True, max_age=_max_age())
+  patch_vary_headers(response, ('Cookie',))
+  return response
+
+
+def cached_recipe(request, recipe_id):
+  """Рецепт из recipe_cache, прочитанный один раз за запрос.
+
+  condition() вызывает функции ETag и Last-Modified до представления, и
+  всем троим нужен один и тот же рецепт.
+  """
+  recipes = request.__dict__.setdefault('_page_recipes', {})
+  if recipe_id not in recipes:
+    recipes[recipe_id] = recipe_cache.get_recipe(recipe_id)
+  return recipes[recipe_id]
+
+
+def recipe_last_modified(request, recipe_id, *args, **kwargs):
+  recipe = cached_recipe(request, recipe_id)
+  if recipe is None:
+    return None
+  return max([recipe.updated_at,
+              *(ingredient.updated_at for ingredient in recipe.ingredients.all())])
+
+
+def recipe_etag(request, recipe_id, *args, **kwargs):
+  last_modified = recipe_last_modified(request, recipe_id)
+  if last_modified is None:
+    return None
+  audience = 'user' if request.user.is_authenticated else 'anon'
+  return f'recipe-{recipe_id}-{last_modified.timestamp():.6f}-{audience}'
+
+
+def conditional_recipe_page(view):
+  """ETag, Last-Modified и 304 для страницы одного рецепта."""
+  conditional = condition(etag_func=recipe_etag, last_modified_func=recipe_last_modified)(view)
+
+  @wraps(view)
+  def wrapper(request, *args, **kwargs):
+    response = conditional(request, *args, **kwargs)
+    if response.status_code in (200, 304):
+      patch_page_headers(request, response)
+    return response
+  return wrapper
+
+
+def _page_key(request):
+  path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+  return f'{PAGE_KEY_PREFIX}:{path}'
+
+
+def cache_anonymous_page(view):
+  """Кэширует страницу целиком для анонимов; вошедшим рендерит как обычно."""
+  @wraps(view)
+  def wrapper(request, *args, **kwargs):
+    if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+      return patch_page_headers(request, view(request, *args, **kwargs))
+
+    cache = recipe_cache.get_cache()
+    key = _page_key(request)
+    cached = cache.get(key)
+    if cached is None:
+      response = view(request, *args, **kwargs)
+      # Ошибки не кэшируем, но заголовки ставим как всем
+      if response.status_code != 200 or response.streaming:
+        return patch_page_headers(request, response)
+      content = response.content
+      etag = quote_etag(hashlib.md5(content).hexdigest())
+      # Ответ с cookie (например, csrftoken) тоже не кэшируем: ее получил бы
+      # каждый следующий аноним
+      if response.cookies:
+        response['ETag'] = etag
+        return patch_page_headers(request, response)
+      cached = (content, response['Content-Type'], etag)
+      cache.set(key, cached, _page_timeout())
+
+    content, content_type, etag = cached
+    response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = etag
+    response = get_conditional_response(request, etag=etag, response=response)
+    return patch_page_headers(request, response)
+  return wrapper
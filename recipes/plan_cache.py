@@ -0,0 +1,146 @@
+"""Снимок состояния профиля для страницы подбора блюд.
+
+Странице нужны фильтры, лайки, дизлайки и лимиты обновлений. Все это
+меняется только в apply_filters, refresh_*, like_recipe и dislike_recipe,
+поэтому снимок записывается там, а GET читает его из кэша без запросов
+к профилю. Прочие изменения (админка, массовые действия) сбрасывают снимок
+сигналами или явным invalidate, и он пересобирается при следующем чтении.
+
+Выбранные блюда лежат в cookie состояния подбора (recipes/plan_state.py):
+она уже прочитана middleware, и у анонимных пользователей другого
+хранилища нет.
+"""
+import asyncio
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from . import planner, quota
+from .models import UserProfile
+from .quota import MEAL_TYPES
+
+
+# Меняется вместе с форматом снимка, чтобы не читать снимки старых версий
+SNAPSHOT_VERSION = 2
+KEY_PREFIX = f'recipes:plan:v{SNAPSHOT_VERSION}'
+# Время жизни снимка, если кэш свой у каждого процесса
+LOCAL_CACHE_TIMEOUT = 60
+
+QUOTA_FIELDS = ('last_refresh_date',) + tuple(
+  field for meal_type in MEAL_TYPES
+  for field in (f'{meal_type}_refresh_count', f'{meal_type}_blocked_until')
+)
+
+
+class PlanSnapshot:
+  """Поля профиля, которые читает recipe_details.
+
+  Поля лимитов названы так же, как в UserProfile, поэтому снимок можно
+  передавать в quota.status вместо профиля.
+  """
+
+  def __init__(self, pk, user_id, filters, liked_ids, disliked_ids, quota_values,
+               allergen_mask=0):
+    self.pk = pk
+    self.user_id = user_id
+    self.filters = filters
+    self.allergen_mask = allergen_mask
+    self.liked_ids = frozenset(liked_ids)
+    self.disliked_ids = frozenset(disliked_ids)
+    for field in QUOTA_FIELDS:
+      setattr(self, field, quota_values[field])
+
+  @classmethod
+  def from_profile(cls, profile, liked_ids, disliked_ids):
+    return cls(profile.pk, profile.user_id, profile.filters or {}, liked_ids, disliked_ids,
+               {field: getattr(profile, field) for field in QUOTA_FIELDS},
+               profile.allergen_mask)
+
+  def refresh_status(self, meal_type):
+    return quota.get_backend().status(self, meal_type)
+
+  async def arefresh_status(self, meal_type):
+    return await quota.get_backend().astatus(self, meal_type)
+
+
+def get_cache():
+  return caches[getattr(settings, 'RECIPES_PLAN_CACHE', 'default')]
+
+
+def _timeout():
+  timeout = getattr(settings, 'RECIPES_PLAN_CACHE_TIMEOUT', 60 * 60 * 24)
+  if isinstance(get_cache(), LocMemCache):
+    # Сброс снимка в одном процессе не виден остальным: ограничиваем
+    # время, в течение которого они могут показывать устаревший
+    return min(timeout, LOCAL_CACHE_TIMEOUT)
+  return timeout
+
+
+def _key(user_id):
+  return f'{KEY_PREFIX}:{user_id}'
+
+
+def store(profile, liked_ids=None, disliked_ids=None):
+  """Записывает снимок профиля после изменения состояния.
+
+  Если лайки и дизлайки не переданы, они читаются одним запросом.
+  """
+  if liked_ids is None or disliked_ids is None:
+    liked_ids, disliked_ids = planner.load_preference_ids(userprofile=profile)
+  snapshot = PlanSnapshot.from_profile(profile, liked_ids, disliked_ids)
+  get_cache().set(_key(profile.user_id), snapshot, _timeout())
+  return snapshot
+
+
+def _load(user):
+  try:
+    profile = UserProfile.objects.get(user=user)
+  except UserProfile.DoesNotExist:
+    return None
+  liked_ids, disliked_ids = planner.load_preference_ids(userprofile=profile)
+  return PlanSnapshot.from_profile(profile, liked_ids, disliked_ids)
+
+
+def get(user):
+  """Снимок профиля пользователя или None, если профиля нет."""
+  snapshot = get_cache().get(_key(user.pk))
+  if snapshot is None:
+    snapshot = _load(user)
+    if snapshot is not None:
+      # add, а не set: снимок, записанный изменением за время чтения, новее
+      get_cache().add(_key(user.pk), snapshot, _timeout())
+  return snapshot
+
+
+async def aget(user):
+  """Асинхронный get: профиль и списки предпочтений читаются параллельно."""
+  snapshot = await get_cache().aget(_key(user.pk))
+  if snapshot is not None:
+    return snapshot
+  try:
+    profile, (liked_ids, disliked_ids) = await asyncio.gather(
+      UserProfile.objects.aget(user=user),
+      planner.aload_preference_ids(userprofile__user=user),
+    )
+  except UserProfile.DoesNotExist:
+    return None
+  snapshot = PlanSnapshot.from_profile(profile, liked_ids, disliked_ids)
+  await get_cache().aadd(_key(user.pk), snapshot, _timeout())
+  return snapshot
+
+
+def rebuild(user):
+  """Перечитывает снимок из базы, когда изменения сделаны мимо экземпляра профиля."""
+  snapshot = _load(user)
+  if snapshot is not None:
+    get_cache().set(_key(user.pk), snapshot, _timeout())
+  return snapshot
+
+
+def invalidate(user_ids):
+  get_cache().delete_many([_key(user_id) for user_id in user_ids])
+
+
+async def ainvalidate(user_ids):
+  await get_cache().adelete_many([_key(user_id) for user_id in user_ids])
@@ -0,0 +1,102 @@
+"""Состояние подбора блюд в отдельной подписанной cookie.
+
+Фильтры, выбранные блюда, очереди meal_queue и отложенные замены меняются
+почти на каждом обновлении блюда. Если держать их в сессии, каждое
+обновление пишет в django_session. Поэтому они лежат в своей cookie
+COOKIE_NAME, а сессия остается серверной и хранит только вход.
+
+Данные подписаны, но не зашифрованы: клиент может их прочитать и, зная
+SECRET_KEY, подделать. Секретного здесь ничего нет, а лимиты, лайки и
+аллергены живут в профиле. Cookie ставится, только когда состояние
+изменили, и очищается при входе и выходе (recipes/signals.py), как
+очищалась бы сессия.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core import signing
+
+
+COOKIE_NAME = 'foodplan_plan'
+SALT = 'recipes.plan_state'
+
+
+class PlanState(dict):
+  """Словарь состояния; modified выставляется при любом изменении."""
+
+  def __init__(self, data=None):
+    super().__init__(data or {})
+    self.modified = False
+
+  def __setitem__(self, key, value):
+    super().__setitem__(key, value)
+    self.modified = True
+
+  def __delitem__(self, key):
+    super().__delitem__(key)
+    self.modified = True
+
+  def pop(self, key, *default):
+    if key in self:
+      self.modified = True
+    return super().pop(key, *default)
+
+  def update(self, *args, **kwargs):
+    super().update(*args, **kwargs)
+    self.modified = True
+
+  def clear(self):
+    if self:
+      self.modified = True
+    super().clear()
+
+
+def load(request):
+  value = request.COOKIES.get(COOKIE_NAME)
+  if not value:
+    return PlanState()
+  try:
+    return PlanState(signing.loads(value, salt=SALT, max_age=settings.SESSION_COOKIE_AGE))
+  except signing.BadSignature:
+    return PlanState()
+
+
+def save(request, response):
+  state = getattr(request, 'plan_state', None)
+  if state is None or not state.modified:
+    return
+  if not state:
+    response.delete_cookie(COOKIE_NAME, path=settings.SESSION_COOKIE_PATH,
+                           domain=settings.SESSION_COOKIE_DOMAIN,
+                           samesite=settings.SESSION_COOKIE_SAMESITE)
+    return
+  response.set_cookie(
+    COOKIE_NAME, signing.dumps(dict(state), salt=SALT, compress=True),
+    max_age=settings.SESSION_COOKIE_AGE, path=settings.SESSION_COOKIE_PATH,
+    domain=settings.SESSION_COOKIE_DOMAIN, secure=settings.SESSION_COOKIE_SECURE,
+    httponly=True, samesite=settings.SESSION_COOKIE_SAMESITE,
+  )
+
+
+class PlanStateMiddleware:
+  """Кладет в request.plan_state состояние из cookie и сохраняет изменения."""
+  sync_capable = True
+  async_capable = True
+
+  def __init__(self, get_response):
+    self.get_response = get_response
+    if iscoroutinefunction(get_response):
+      markcoroutinefunction(self)
+
+  def __call__(self, request):
+    if iscoroutinefunction(self):
+      return self.__acall__(request)
+    request.plan_state = load(request)
+    response = self.get_response(request)
+    save(request, response)
+    return response
+
+  async def __acall__(self, request):
+    request.plan_state = load(request)
+    response = await self.get_response(request)
+    save(request, response)
+    return response
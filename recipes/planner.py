@@ -0,0 +1,84 @@
+"""Подбор сразу нескольких приемов пищи за один проход.
+
+Профиль, лайки и дизлайки читаются один раз, блюда выбираются из индекса
+кандидатов без запросов к Recipe, а фильтры и счетчики обновлений всех
+выбранных приемов пищи сохраняются одним UPDATE.
+"""
+import asyncio
+
+from django.db.models import Value
+from django.utils import timezone
+
+from . import quota, sampling
+from .models import UserProfile
+from .quota import MEAL_TYPES
+
+
+LIKED = 1
+DISLIKED = 0
+
+
+def load_preference_ids(**profile_lookup):
+  """Возвращает множества id лайкнутых и дизлайкнутых рецептов одним запросом.
+
+  profile_lookup — условие на профиль, например userprofile=profile или
+  userprofile__user=user.
+  """
+  liked = (UserProfile.liked_recipes.through.objects
+           .filter(**profile_lookup)
+           .annotate(kind=Value(LIKED))
+           .values_list('recipe_id', 'kind'))
+  disliked = (UserProfile.disliked_recipes.through.objects
+              .filter(**profile_lookup)
+              .annotate(kind=Value(DISLIKED))
+              .values_list('recipe_id', 'kind'))
+
+  liked_ids = set()
+  disliked_ids = set()
+  for recipe_id, kind in liked.union(disliked, all=True):
+    (liked_ids if kind == LIKED else disliked_ids).add(recipe_id)
+  return liked_ids, disliked_ids
+
+
+async def aload_preference_ids(**profile_lookup):
+  """Асинхронный load_preference_ids: лайки и дизлайки читаются параллельно."""
+  async def ids(through):
+    return {recipe_id async for recipe_id in (through.objects
+                                              .filter(**profile_lookup)
+                                              .values_list('recipe_id', flat=True))}
+
+  liked_ids, disliked_ids = await asyncio.gather(
+    ids(UserProfile.liked_recipes.through),
+    ids(UserProfile.disliked_recipes.through),
+  )
+  return liked_ids, disliked_ids
+
+
+def plan_meals(user, filters, meal_types=None, exclude=None):
+  """Подбирает блюда для meal_types (по умолчанию — для всех).
+
+  Возвращает словарь {meal_type: recipe_id} только для тех приемов пищи,
+  для которых не исчерпан лимит обновлений и нашелся подходящий рецепт.
+  exclude — словарь {meal_type: recipe_id} блюд, которые не нужно повторять.
+  """
+  profile = UserProfile.objects.get(user=user)
+  liked_ids, disliked_ids = load_preference_ids(userprofile=profile)
+
+  now = timezone.now()
+  backend = quota.get_backend()
+  picks = {}
+  meal_types = [meal_type for meal_type in (meal_types or MEAL_TYPES) if meal_type in MEAL_TYPES]
+  for meal_type in meal_types:
+    if not backend.status(profile, meal_type, now).allowed:
+      continue
+    sampler = sampling.get_sampler(meal_type, filters, liked_ids, disliked_ids,
+                                   profile.allergen_mask)
+    excluded = (exclude or {}).get(meal_type)
+    recipe_id = sampler.pick(exclude=(excluded,) if excluded else ())
+    if recipe_id is not None:
+      picks[meal_type] = recipe_id
+
+  granted = backend.consume_many(profile, list(picks), now,
+                                 extra_updates=UserProfile.filter_values(filters))
+  return {meal_type: recipe_id for meal_type, recipe_id in picks.items()
+          if meal_type in granted}
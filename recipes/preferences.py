@@ -0,0 +1,107 @@
+"""Лайки и дизлайки рецептов.
+
+Состояние рецепта для пользователя — лайк, дизлайк или ничего. Запись идет
+прямо в промежуточные таблицы: DELETE противоположной отметки по
+(профиль, рецепт) и INSERT с игнорированием конфликта по уникальному
+ключу. Оба запроса попадают в индекс, поэтому цена клика не зависит от
+длины списков, а повтор того же события ничего не меняет.
+
+Запись мимо менеджеров M2M не шлет m2m_changed, поэтому снимок страницы
+подбора (plan_cache) сбрасывается здесь явно.
+"""
+from datetime import timezone as dt_timezone
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import plan_cache
+from .models import LikedRecipe, Recipe, UserProfile
+
+
+LIKE = 'like'
+DISLIKE = 'dislike'
+CLEAR = 'clear'
+ACTIONS = (LIKE, DISLIKE, CLEAR)
+
+MAX_BATCH_SIZE = 500
+
+DislikedRecipe = UserProfile.disliked_recipes.through
+
+
+def _apply(profile, states, liked_at):
+  """states — {recipe_id: действие}, liked_at — {recipe_id: время лайка}."""
+  not_liked = [recipe_id for recipe_id, action in states.items() if action != LIKE]
+  not_disliked = [recipe_id for recipe_id, action in states.items() if action != DISLIKE]
+  with transaction.atomic():
+    if not_liked:
+      LikedRecipe.objects.filter(userprofile=profile, recipe_id__in=not_liked).delete()
+    if not_disliked:
+      DislikedRecipe.objects.filter(userprofile=profile, recipe_id__in=not_disliked).delete()
+    # Уже существующие лайки не трогаем, чтобы не сбить их дату в избранном
+    LikedRecipe.objects.bulk_create([
+      LikedRecipe(userprofile=profile, recipe_id=recipe_id, liked_at=liked_at[recipe_id])
+      for recipe_id, action in states.items() if action == LIKE
+    ], ignore_conflicts=True)
+    DislikedRecipe.objects.bulk_create([
+      DislikedRecipe(userprofile=profile, recipe_id=recipe_id)
+      for recipe_id, action in states.items() if action == DISLIKE
+    ], ignore_conflicts=True)
+  plan_cache.invalidate([profile.user_id])
+
+
+def like(profile, recipe_id):
+  _apply(profile, {recipe_id: LIKE}, {recipe_id: timezone.now()})
+
+
+def dislike(profile, recipe_id):
+  _apply(profile, {recipe_id: DISLIKE}, {})
+
+
+def clear(profile, recipe_id):
+  _apply(profile, {recipe_id: CLEAR}, {})
+
+
+def apply_events(profile, events):
+  """Применяет пачку событий [{'recipe_id', 'action', 'at'?}] по порядку.
+
+  Для каждого рецепта побеждает последнее событие. Возвращает
+  (число примененных рецептов, список отброшенных событий с причиной).
+  Неизвестные рецепты и некорректные события отбрасываются, остальные
+  записываются в одной транзакции.
+  """
+  states = {}
+  liked_at = {}
+  rejected = []
+  now = timezone.now()
+  for event in events:
+    try:
+      recipe_id = int(event['recipe_id'])
+      action = event['action']
+    except (KeyError, TypeError, ValueError):
+      rejected.append({'event': event, 'error': 'invalid'})
+      continue
+    if action not in ACTIONS:
+      rejected.append({'event': event, 'error': 'unknown action'})
+      continue
+    at = None
+    if event.get('at'):
+      try:
+        at = parse_datetime(event['at'])
+      except (TypeError, ValueError):
+        at = None
+      if at is None:
+        rejected.append({'event': event, 'error': 'invalid at'})
+        continue
+      if timezone.is_naive(at):
+        at = timezone.make_aware(at, dt_timezone.utc)
+    states[recipe_id] = action
+    liked_at[recipe_id] = min(at, now) if at else now
+
+  known = set(Recipe.objects.filter(pk__in=states).values_list('pk', flat=True))
+  for recipe_id in [recipe_id for recipe_id in states if recipe_id not in known]:
+    rejected.append({'event': {'recipe_id': recipe_id, 'action': states.pop(recipe_id)},
+                     'error': 'unknown recipe'})
+  if states:
+    _apply(profile, states, liked_at)
+  return len(states), rejected
@@ -0,0 +1,254 @@
+"""Лимиты обновлений блюд.
+
+На каждый прием пищи дается REFRESH_LIMIT обновлений; после исчерпания
+прием пищи блокируется на REFRESH_WINDOW. Если с последнего обновления
+прошло больше REFRESH_WINDOW, все счетчики сбрасываются.
+
+DatabaseQuota выполняет обновление одним условным UPDATE: сброс окна и
+проверка лимита живут в WHERE/CASE, поэтому параллельные клики не могут
+превысить лимит, а в строку профиля пишутся только поля лимитов.
+CacheTokenBucketQuota держит счетчики в общем кэше Redis или Memcached
+для нагруженных инсталляций. Бэкенд выбирается настройкой
+RECIPES_QUOTA_BACKEND, по умолчанию — DatabaseQuota.
+"""
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.core.cache.backends.redis import RedisCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+MEAL_TYPES = ('breakfast', 'lunch', 'dinner')
+REFRESH_LIMIT = 3
+REFRESH_WINDOW = timedelta(hours=24)
+
+DEFAULT_BACKEND = 'recipes.quota.DatabaseQuota'
+
+QuotaStatus = namedtuple('QuotaStatus', 'count remaining blocked_until allowed')
+
+
+def _count_field(meal_type):
+  return f'{meal_type}_refresh_count'
+
+
+def _blocked_field(meal_type):
+  return f'{meal_type}_blocked_until'
+
+
+def _check_meal_type(meal_type):
+  if meal_type not in MEAL_TYPES:
+    raise ValueError(f'Unknown meal type: {meal_type}')
+
+
+def window_expired(profile, now):
+  return now - profile.last_refresh_date > REFRESH_WINDOW
+
+
+def is_allowed(profile, meal_type, now):
+  """Разрешено ли обновление по значениям профиля в памяти."""
+  return status(profile, meal_type, now).allowed
+
+
+def status(profile, meal_type, now=None):
+  """Эффективное состояние лимита по сохраненным полям, без записи в БД.
+
+  Истекшее окно трактуется как сброшенное; сам сброс произойдет при
+  следующем реальном обновлении.
+  """
+  _check_meal_type(meal_type)
+  now = now or timezone.now()
+  if window_expired(profile, now):
+    return QuotaStatus(0, REFRESH_LIMIT, None, True)
+  count = getattr(profile, _count_field(meal_type))
+  blocked_until = getattr(profile, _blocked_field(meal_type))
+  if blocked_until and now >= blocked_until:
+    blocked_until = None
+  remaining = max(REFRESH_LIMIT - count, 0)
+  return QuotaStatus(count, remaining, blocked_until,
+                     blocked_until is None and remaining > 0)
+
+
+def transition(profile, meal_types, now):
+  """Значения полей профиля после обновления meal_types (без проверки лимита)."""
+  values = {}
+  if window_expired(profile, now):
+    for meal_type in MEAL_TYPES:
+      values[_count_field(meal_type)] = 0
+      values[_blocked_field(meal_type)] = None
+  for meal_type in meal_types:
+    count = values.get(_count_field(meal_type), getattr(profile, _count_field(meal_type))) + 1
+    values[_count_field(meal_type)] = count
+    if count >= REFRESH_LIMIT:
+      values[_blocked_field(meal_type)] = now + REFRESH_WINDOW
+  values['last_refresh_date'] = now
+  return values
+
+
+class DatabaseQuota:
+  def status(self, profile, meal_type, now=None):
+    return status(profile, meal_type, now)
+
+  async def astatus(self, profile, meal_type, now=None):
+    return status(profile, meal_type, now)
+
+  def _expired(self, now):
+    return Q(last_refresh_date__lt=now - REFRESH_WINDOW)
+
+  def _allowed(self, meal_type, now):
+    blocked = _blocked_field(meal_type)
+    return self._expired(now) | (
+      Q(**{f'{_count_field(meal_type)}__lt': REFRESH_LIMIT})
+      & (Q(**{f'{blocked}__isnull': True}) | Q(**{f'{blocked}__lte': now}))
+    )
+
+  def _updates(self, meal_type, now):
+    expired = self._expired(now)
+    blocked_at = Value(now + REFRESH_WINDOW, output_field=models.DateTimeField())
+    unblocked = Value(None, output_field=models.DateTimeField())
+    updates = {'last_refresh_date': Value(now, output_field=models.DateTimeField())}
+    for other in MEAL_TYPES:
+      count, blocked = _count_field(other), _blocked_field(other)
+      if other == meal_type:
+        updates[count] = Case(When(expired, then=Value(1)), default=F(count) + 1)
+        updates[blocked] = Case(
+          When(expired, then=blocked_at if REFRESH_LIMIT <= 1 else unblocked),
+          When(**{f'{count}__gte': REFRESH_LIMIT - 1}, then=blocked_at),
+          default=F(blocked),
+        )
+      else:
+        updates[count] = Case(When(expired, then=Value(0)), default=F(count))
+        updates[blocked] = Case(When(expired, then=unblocked), default=F(blocked))
+    return updates
+
+  def consume(self, profile, meal_type, now=None):
+    """Атомарно тратит одно обновление; возвращает, было ли оно разрешено."""
+    _check_meal_type(meal_type)
+    now = now or timezone.now()
+    rows = (type(profile)._default_manager
+            .filter(pk=profile.pk)
+            .filter(self._allowed(meal_type, now))
+            .update(**self._updates(meal_type, now)))
+    return rows == 1
+
+  async def aconsume(self, profile, meal_type, now=None):
+    _check_meal_type(meal_type)
+    now = now or timezone.now()
+    rows = await (type(profile)._default_manager
+                  .filter(pk=profile.pk)
+                  .filter(self._allowed(meal_type, now))
+                  .aupdate(**self._updates(meal_type, now)))
+    return rows == 1
+
+  def consume_many(self, profile, meal_types, now=None, extra_updates=None):
+    """Тратит по обновлению на каждый из meal_types одним UPDATE.
+
+    Решение принимается по значениям профиля в памяти, а UPDATE проверяет,
+    что строка с тех пор не менялась. При гонке каждый прием пищи
+    списывается отдельным атомарным consume. Возвращает множество
+    приемов пищи, для которых обновление разрешено.
+    """
+    now = now or timezone.now()
+    manager = type(profile)._default_manager
+    granted = [meal_type for meal_type in meal_types if is_allowed(profile, meal_type, now)]
+    updates = dict(extra_updates or {})
+    if granted:
+      updates.update(transition(profile, granted, now))
+    if not updates:
+      return set()
+
+    unchanged = {'last_refresh_date': profile.last_refresh_date}
+    for meal_type in MEAL_TYPES:
+      unchanged[_count_field(meal_type)] = getattr(profile, _count_field(meal_type))
+      unchanged[_blocked_field(meal_type)] = getattr(profile, _blocked_field(meal_type))
+    if manager.filter(pk=profile.pk, **unchanged).update(**updates):
+      return set(granted)
+
+    if extra_updates:
+      manager.filter(pk=profile.pk).update(**extra_updates)
+    return {meal_type for meal_type in granted if self.consume(profile, meal_type, now)}
+
+
+class CacheTokenBucketQuota:
+  """Ведро на REFRESH_LIMIT токенов на каждый прием пищи в кэше Django.
+
+  Ведро целиком наполняется через REFRESH_WINDOW после первого списания.
+  Лимит соблюдается без обращений к БД, только если кэш общий для всех
+  воркеров и incr в нем атомарен: у LocMemCache свои ведра в каждом
+  процессе, а FileBasedCache делает incr чтением и записью файла. Поэтому
+  алиас RECIPES_QUOTA_CACHE должен указывать на Redis или Memcached.
+  """
+  key_prefix = 'recipes:quota'
+  shared_backends = (RedisCache, BaseMemcachedCache)
+
+  def __init__(self):
+    alias = getattr(settings, 'RECIPES_QUOTA_CACHE', 'default')
+    self.cache = caches[alias]
+    if not isinstance(self.cache, self.shared_backends):
+      raise ImproperlyConfigured(
+        f'CacheTokenBucketQuota needs a Redis or Memcached cache, '
+        f'RECIPES_QUOTA_CACHE={alias!r} is {type(self.cache).__name__}')
+
+  def _key(self, profile, meal_type):
+    return f'{self.key_prefix}:{profile.pk}:{meal_type}'
+
+  def status(self, profile, meal_type, now=None):
+    _check_meal_type(meal_type)
+    key = self._key(profile, meal_type)
+    values = self.cache.get_many([key, f'{key}:refill'])
+    used = min(values.get(key, 0), REFRESH_LIMIT)
+    remaining = REFRESH_LIMIT - used
+    blocked_until = values.get(f'{key}:refill') if not remaining else None
+    return QuotaStatus(used, remaining, blocked_until, remaining > 0)
+
+  async def astatus(self, profile, meal_type, now=None):
+    _check_meal_type(meal_type)
+    key = self._key(profile, meal_type)
+    values = await self.cache.aget_many([key, f'{key}:refill'])
+    used = min(values.get(key, 0), REFRESH_LIMIT)
+    remaining = REFRESH_LIMIT - used
+    blocked_until = values.get(f'{key}:refill') if not remaining else None
+    return QuotaStatus(used, remaining, blocked_until, remaining > 0)
+
+  def consume(self, profile, meal_type, now=None):
+    _check_meal_type(meal_type)
+    key = self._key(profile, meal_type)
+    timeout = int(REFRESH_WINDOW.total_seconds())
+    if self.cache.add(key, 0, timeout):
+      self.cache.set(f'{key}:refill', (now or timezone.now()) + REFRESH_WINDOW, timeout)
+    try:
+      used = self.cache.incr(key)
+    except ValueError:
+      # Ведро истекло между add и incr
+      self.cache.add(key, 1, timeout)
+      used = 1
+    return used <= REFRESH_LIMIT
+
+  async def aconsume(self, profile, meal_type, now=None):
+    _check_meal_type(meal_type)
+    key = self._key(profile, meal_type)
+    timeout = int(REFRESH_WINDOW.total_seconds())
+    if await self.cache.aadd(key, 0, timeout):
+      await self.cache.aset(f'{key}:refill', (now or timezone.now()) + REFRESH_WINDOW, timeout)
+    try:
+      used = await self.cache.aincr(key)
+    except ValueError:
+      await self.cache.aadd(key, 1, timeout)
+      used = 1
+    return used <= REFRESH_LIMIT
+
+  def consume_many(self, profile, meal_types, now=None, extra_updates=None):
+    granted = {meal_type for meal_type in meal_types if self.consume(profile, meal_type, now)}
+    if extra_updates:
+      type(profile)._default_manager.filter(pk=profile.pk).update(**extra_updates)
+    return granted
+
+
+def get_backend():
+  return import_string(getattr(settings, 'RECIPES_QUOTA_BACKEND', DEFAULT_BACKEND))()
@@ -0,0 +1,205 @@
+"""Кэш рецептов и отрендеренных фрагментов карточек.
+
+Ключи строятся из id рецепта и его версии. Сигналы на Recipe и Ingredient
+меняют версию затронутых рецептов, поэтому старые записи просто перестают
+читаться и со временем вытесняются — удалять их не нужно. Поколение
+(generation) — общая часть версии для массовых изменений вроде
+recalculate_costs, после которых дешевле сбросить все сразу.
+
+Кэш берется по алиасу RECIPES_FRAGMENT_CACHE; счетчики попаданий и
+промахов лежат там же и видны всем процессам (manage.py recipe_cache_stats).
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import Recipe
+
+
+KEY_PREFIX = 'recipes:cache'
+GENERATION_KEY = f'{KEY_PREFIX}:generation'
+KINDS = ('object', 'fragment')
+
+
+def get_cache():
+  return caches[getattr(settings, 'RECIPES_FRAGMENT_CACHE', 'default')]
+
+
+def _timeout():
+  return getattr(settings, 'RECIPES_FRAGMENT_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def _version_key(recipe_id):
+  return f'{KEY_PREFIX}:version:{recipe_id}'
+
+
+def _new_version():
+  # Время в наносекундах не повторяется, поэтому версия, потерянная при
+  # вытеснении, не может совпасть с версией уже сохраненных записей
+  return time.time_ns()
+
+
+def get_versions(recipe_ids):
+  """Версии рецептов {id: 'поколение.версия'} за одно обращение к кэшу."""
+  cache = get_cache()
+  recipe_ids = list(recipe_ids)
+  keys = {_version_key(recipe_id): recipe_id for recipe_id in recipe_ids}
+  values = cache.get_many([GENERATION_KEY, *keys])
+
+  missing = {key: _new_version() for key in [GENERATION_KEY, *keys] if key not in values}
+  if missing:
+    for key, version in missing.items():
+      if not cache.add(key, version, None):
+        version = cache.get(key, version)
+      values[key] = version
+
+  generation = values[GENERATION_KEY]
+  return {recipe_id: f'{generation}.{values[key]}' for key, recipe_id in keys.items()}
+
+
+async def aget_versions(recipe_ids):
+  cache = get_cache()
+  recipe_ids = list(recipe_ids)
+  keys = {_version_key(recipe_id): recipe_id for recipe_id in recipe_ids}
+  values = await cache.aget_many([GENERATION_KEY, *keys])
+
+  for key in [GENERATION_KEY, *keys]:
+    if key not in values:
+      version = _new_version()
+      if not await cache.aadd(key, version, None):
+        version = await cache.aget(key, version)
+      values[key] = version
+
+  generation = values[GENERATION_KEY]
+  return {recipe_id: f'{generation}.{values[key]}' for key, recipe_id in keys.items()}
+
+
+def bump(recipe_ids):
+  """Делает устаревшими объекты и фрагменты перечисленных рецептов."""
+  version = _new_version()
+  versions = {_version_key(recipe_id): version for recipe_id in recipe_ids if recipe_id}
+  if versions:
+    get_cache().set_many(versions, None)
+
+
+def bump_all():
+  get_cache().set(GENERATION_KEY, _new_version(), None)
+
+
+def _count(kind, hits, misses):
+  cache = get_cache()
+  for outcome, amount in (('hits', hits), ('misses', misses)):
+    if not amount:
+      continue
+    key = f'{KEY_PREFIX}:stats:{kind}:{outcome}'
+    cache.add(key, 0, None)
+    try:
+      cache.incr(key, amount)
+    except ValueError:
+      cache.set(key, amount, None)
+
+
+async def _acount(kind, hits, misses):
+  cache = get_cache()
+  for outcome, amount in (('hits', hits), ('misses', misses)):
+    if not amount:
+      continue
+    key = f'{KEY_PREFIX}:stats:{kind}:{outcome}'
+    await cache.aadd(key, 0, None)
+    try:
+      await cache.aincr(key, amount)
+    except ValueError:
+      await cache.aset(key, amount, None)
+
+
+def stats():
+  """{kind: {'hits': ..., 'misses': ..., 'ratio': ...}} по всем процессам."""
+  keys = [f'{KEY_PREFIX}:stats:{kind}:{outcome}'
+          for kind in KINDS for outcome in ('hits', 'misses')]
+  values = get_cache().get_many(keys)
+  result = {}
+  for kind in KINDS:
+    hits = values.get(f'{KEY_PREFIX}:stats:{kind}:hits', 0)
+    misses = values.get(f'{KEY_PREFIX}:stats:{kind}:misses', 0)
+    total = hits + misses
+    result[kind] = {'hits': hits, 'misses': misses,
+                    'ratio': hits / total if total else 0.0}
+  return result
+
+
+def reset_stats():
+  get_cache().delete_many([f'{KEY_PREFIX}:stats:{kind}:{outcome}'
+                           for kind in KINDS for outcome in ('hits', 'misses')])
+
+
+def _object_key(recipe_id, version):
+  return f'{KEY_PREFIX}:object:{recipe_id}:{version}'
+
+
+def fragment_key(name, recipe_id, version):
+  return f'{KEY_PREFIX}:fragment:{name}:{recipe_id}:{version}'
+
+
+def get_recipes(recipe_ids):
+  """Рецепты с ингредиентами {id: Recipe}, как in_bulk с prefetch_related.
+
+  Из базы читаются только отсутствующие в кэше рецепты.
+  """
+  recipe_ids = [recipe_id for recipe_id in dict.fromkeys(recipe_ids) if recipe_id]
+  if not recipe_ids:
+    return {}
+  cache = get_cache()
+  versions = get_versions(recipe_ids)
+  keys = {_object_key(recipe_id, versions[recipe_id]): recipe_id for recipe_id in recipe_ids}
+  cached = cache.get_many(list(keys))
+  recipes = {keys[key]: recipe for key, recipe in cached.items()}
+
+  missing = [recipe_id for recipe_id in recipe_ids if recipe_id not in recipes]
+  if missing:
+    loaded = Recipe.objects.prefetch_related('ingredients').in_bulk(missing)
+    cache.set_many({_object_key(recipe_id, versions[recipe_id]): recipe
+                    for recipe_id, recipe in loaded.items()}, _timeout())
+    recipes.update(loaded)
+
+  _count('object', len(cached), len(missing))
+  return recipes
+
+
+async def aget_recipes(recipe_ids):
+  """Асинхронный get_recipes для async-представлений."""
+  recipe_ids = [recipe_id for recipe_id in dict.fromkeys(recipe_ids) if recipe_id]
+  if not recipe_ids:
+    return {}
+  cache = get_cache()
+  versions = await aget_versions(recipe_ids)
+  keys = {_object_key(recipe_id, versions[recipe_id]): recipe_id for recipe_id in recipe_ids}
+  cached = await cache.aget_many(list(keys))
+  recipes = {keys[key]: recipe for key, recipe in cached.items()}
+
+  missing = [recipe_id for recipe_id in recipe_ids if recipe_id not in recipes]
+  if missing:
+    loaded = await Recipe.objects.prefetch_related('ingredients').ain_bulk(missing)
+    await cache.aset_many({_object_key(recipe_id, versions[recipe_id]): recipe
+                           for recipe_id, recipe in loaded.items()}, _timeout())
+    recipes.update(loaded)
+
+  await _acount('object', len(cached), len(missing))
+  return recipes
+
+
+def get_recipe(recipe_id):
+  return get_recipes([recipe_id]).get(recipe_id)
+
+
+def get_fragment(name, recipe_id):
+  """Возвращает (html или None, ключ для сохранения)."""
+  version = get_versions([recipe_id])[recipe_id]
+  key = fragment_key(name, recipe_id, version)
+  html = get_cache().get(key)
+  _count('fragment', html is not None, html is None)
+  return html, key
+
+
+def set_fragment(key, html):
+  get_cache().set(key, html, _timeout())
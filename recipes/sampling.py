@@ -0,0 +1,98 @@
+"""Взвешенный выбор рецепта из пула кандидатов.
+
+Лайкнутые рецепты выбираются с весом LIKED_WEIGHT, остальные — с весом 1.
+Список кандидатов не материализуется: равномерная часть берется прямо из
+префикса пула, а добавочный вес лайков — из короткого списка позиций
+лайкнутых рецептов в этом пуле. Исключенные рецепты (дизлайки, текущее
+блюдо, рецепты с аллергенами пользователя) отбрасываются повторным броском, что сохраняет пропорции весов.
+"""
+import random
+import threading
+from collections import OrderedDict
+
+from . import candidates
+
+
+LIKED_WEIGHT = 3
+MAX_REJECTIONS = 32
+SAMPLER_CACHE_SIZE = 1024
+
+
+class WeightedSampler:
+  def __init__(self, index, pool, max_cost=None, liked_ids=(), excluded_ids=()):
+    self.pool = pool
+    self.size = pool.cut(max_cost)
+    self.excluded = frozenset(excluded_ids)
+
+    liked_positions = []
+    for recipe_id in liked_ids:
+      if recipe_id in self.excluded:
+        continue
+      cost = index.cost_of(recipe_id)
+      if cost is None:
+        continue
+      position = pool.position(recipe_id, cost)
+      if 0 <= position < self.size:
+        liked_positions.append(position)
+    self.liked_positions = sorted(liked_positions)
+    self.total_weight = self.size + (LIKED_WEIGHT - 1) * len(self.liked_positions)
+
+  def _draw(self, rng):
+    r = rng.randrange(self.total_weight)
+    if r < self.size:
+      return self.pool.ids[r]
+    extra = (r - self.size) // (LIKED_WEIGHT - 1)
+    return self.pool.ids[self.liked_positions[extra]]
+
+  def pick(self, exclude=(), rng=random):
+    """Возвращает id рецепта или None, если подходящих нет."""
+    if not self.size:
+      return None
+    for _ in range(MAX_REJECTIONS):
+      recipe_id = self._draw(rng)
+      if recipe_id not in self.excluded and recipe_id not in exclude:
+        return recipe_id
+    return self._pick_exact(exclude, rng)
+
+  def _pick_exact(self, exclude, rng):
+    # Почти все кандидаты исключены — выбираем честно по оставшимся
+    liked = {self.pool.ids[position] for position in self.liked_positions}
+    eligible = [recipe_id for recipe_id in self.pool.ids[:self.size]
+                if recipe_id not in self.excluded and recipe_id not in exclude]
+    if not eligible:
+      return None
+    weights = [LIKED_WEIGHT if recipe_id in liked else 1 for recipe_id in eligible]
+    return rng.choices(eligible, weights=weights, k=1)[0]
+
+
+_lock = threading.Lock()
+_samplers = OrderedDict()
+
+
+def get_sampler(meal_type, filters, liked_ids=(), disliked_ids=(), allergen_mask=0):
+  """Сэмплер для пула и предпочтений пользователя.
+
+  Сэмплеры кэшируются по версии индекса, пулу, наборам лайков/дизлайков и
+  маске аллергенов, поэтому пересобираются только при изменении каталога
+  или предпочтений. Рецепты с аллергенами из маски исключаются как дизлайки.
+  """
+  index = candidates.get_index()
+  liked_ids = frozenset(liked_ids)
+  disliked_ids = frozenset(disliked_ids)
+  max_cost = candidates.parse_max_cost(filters.get('max_cost'))
+  key = (index.version, index.pool_key(meal_type, filters), max_cost,
+         liked_ids, disliked_ids, allergen_mask)
+
+  with _lock:
+    sampler = _samplers.get(key)
+    if sampler is not None:
+      _samplers.move_to_end(key)
+      return sampler
+
+  sampler = WeightedSampler(index, index.pool(meal_type, filters), max_cost,
+                            liked_ids, disliked_ids | index.allergenic_ids(allergen_mask))
+  with _lock:
+    _samplers[key] = sampler
+    while len(_samplers) > SAMPLER_CACHE_SIZE:
+      _samplers.popitem(last=False)
+  return sampler
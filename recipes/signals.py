@@ -0,0 +1,137 @@
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import candidates, images, instrumentation, plan_cache, recipe_cache
+from .models import Allergen, Ingredient, Recipe, UserProfile
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def invalidate_candidate_index(sender, **kwargs):
+  candidates.invalidate()
+
+
+@receiver(m2m_changed, sender=Recipe.ingredients.through)
+def invalidate_candidate_index_on_ingredients(sender, action, **kwargs):
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    candidates.invalidate()
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def bump_recipe_cache(sender, instance, **kwargs):
+  recipe_cache.bump([instance.pk])
+
+
+@receiver(pre_save, sender=Recipe)
+def read_image_dimensions(sender, instance, **kwargs):
+  # Размеры до готовности вариантов; Pillow читает только заголовок файла
+  if instance.image and images.needs_variants(instance):
+    try:
+      instance.image_width, instance.image_height = instance.image.width, instance.image.height
+    except (OSError, ValueError, TypeError):
+      instance.image_width = instance.image_height = None
+  elif not instance.image:
+    instance.image_width = instance.image_height = None
+    instance.image_variants = {}
+
+
+@receiver(post_save, sender=Recipe)
+def schedule_image_variants(sender, instance, **kwargs):
+  if instance.image and images.needs_variants(instance):
+    images.schedule(instance.pk)
+
+
+@receiver(post_save, sender=Ingredient)
+def bump_ingredient_recipes_cache(sender, instance, created, **kwargs):
+  if not created:
+    recipe_cache.bump(instance.recipes.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Ingredient)
+def bump_deleted_ingredient_recipes_cache(sender, instance, **kwargs):
+  # id рецептов запоминает remember_ingredient_recipes до удаления связей
+  recipe_cache.bump(getattr(instance, '_recipe_ids', []))
+
+
+@receiver(m2m_changed, sender=Recipe.ingredients.through)
+def bump_recipe_cache_on_ingredients(sender, instance, action, reverse, pk_set, **kwargs):
+  if action not in ('post_add', 'post_remove', 'post_clear'):
+    return
+  if not reverse:
+    recipe_cache.bump([instance.pk])
+  elif action == 'post_clear':
+    recipe_cache.bump(getattr(instance, '_cleared_recipe_ids', []))
+  else:
+    recipe_cache.bump(pk_set or [])
+
+
+@receiver(m2m_changed, sender=Ingredient.allergens.through)
+def invalidate_recipes_on_allergens(sender, instance, action, **kwargs):
+  # id рецептов собирает update_recipe_allergen_mask, он подключен раньше
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    candidates.invalidate()
+    recipe_cache.bump(getattr(instance, '_allergen_recipe_ids', []))
+
+
+@receiver(post_delete, sender=Allergen)
+def invalidate_deleted_allergen(sender, instance, **kwargs):
+  candidates.invalidate()
+  recipe_cache.bump(getattr(instance, '_allergen_recipe_ids', []))
+  _invalidate_profiles(getattr(instance, '_profile_ids', []))
+
+
+def _invalidate_profiles(profile_ids):
+  if profile_ids:
+    plan_cache.invalidate(
+      UserProfile.objects.filter(pk__in=profile_ids).values_list('user_id', flat=True))
+
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_plan_snapshot(sender, instance, **kwargs):
+  plan_cache.invalidate([instance.user_id])
+
+
+@receiver(m2m_changed, sender=UserProfile.liked_recipes.through)
+@receiver(m2m_changed, sender=UserProfile.disliked_recipes.through)
+def invalidate_plan_snapshot_on_preferences(sender, instance, action, reverse, pk_set, **kwargs):
+  if not reverse:
+    if action in ('post_add', 'post_remove', 'post_clear'):
+      plan_cache.invalidate([instance.user_id])
+  elif action == 'pre_clear':
+    field = 'liked_by' if sender is UserProfile.liked_recipes.through else 'disliked_by'
+    instance._cleared_profile_ids = list(getattr(instance, field).values_list('id', flat=True))
+  elif action == 'post_clear':
+    _invalidate_profiles(getattr(instance, '_cleared_profile_ids', []))
+  elif action in ('post_add', 'post_remove'):
+    _invalidate_profiles(pk_set)
+
+
+@receiver(m2m_changed, sender=UserProfile.allergens.through)
+def invalidate_plan_snapshot_on_allergens(sender, instance, action, reverse, pk_set, **kwargs):
+  if action not in ('post_add', 'post_remove', 'post_clear'):
+    return
+  if not reverse:
+    plan_cache.invalidate([instance.user_id])
+  elif action == 'post_clear':
+    _invalidate_profiles(getattr(instance, '_profile_ids', []))
+  else:
+    _invalidate_profiles(pk_set)
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+  instrumentation.install(connection)
+
+
+@receiver(user_logged_in)
+@receiver(user_logged_out)
+def reset_plan_state(sender, request, **kwargs):
+  # Как сброс сессии: подбор прежнего пользователя новому не достается
+  state = getattr(request, 'plan_state', None)
+  if state is not None:
+    state.clear()
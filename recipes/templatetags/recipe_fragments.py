@@ -0,0 +1,40 @@
+from django import template
+
+from recipes import recipe_cache
+
+
+register = template.Library()
+
+
+class RecipeFragmentNode(template.Node):
+  def __init__(self, name, recipe, nodelist):
+    self.name = name
+    self.recipe = recipe
+    self.nodelist = nodelist
+
+  def render(self, context):
+    recipe = self.recipe.resolve(context)
+    if not recipe:
+      return self.nodelist.render(context)
+    html, key = recipe_cache.get_fragment(self.name.resolve(context), recipe.pk)
+    if html is None:
+      html = self.nodelist.render(context)
+      recipe_cache.set_fragment(key, html)
+    return html
+
+
+@register.tag
+def recipefragment(parser, token):
+  """Кэширует часть шаблона, зависящую только от рецепта.
+
+  {% recipefragment 'card' recipe %}...{% endrecipefragment %}
+
+  Фрагмент сбрасывается вместе с версией рецепта (recipes/recipe_cache.py),
+  поэтому внутрь нельзя класть ничего, что зависит от пользователя.
+  """
+  bits = token.split_contents()
+  if len(bits) != 3:
+    raise template.TemplateSyntaxError(f"'{bits[0]}' принимает имя фрагмента и рецепт")
+  nodelist = parser.parse(('endrecipefragment',))
+  parser.delete_first_token()
+  return RecipeFragmentNode(parser.compile_filter(bits[1]), parser.compile_filter(bits[2]), nodelist)
@@ -0,0 +1,53 @@
+from django import template
+from django.templatetags.static import static
+from django.utils.html import format_html, format_html_join
+
+from recipes import images
+
+
+register = template.Library()
+
+PLACEHOLDER = 'img/circle1.png'
+
+
+def _srcset(first, second, fmt):
+  if second is None or second[fmt] == first[fmt]:
+    return first[fmt]
+  return f'{first[fmt]} 1x, {second[fmt]} 2x'
+
+
+@register.simple_tag
+def recipe_image(recipe, variant='card', **attrs):
+  """<picture> с WebP и JPEG нужного размера.
+
+  {% recipe_image recipe 'card' class='card-img-top' style='height: 200px' %}
+
+  В srcset для 2x-экранов добавляется следующий по размеру вариант.
+  width и height берутся из варианта, чтобы браузер заранее знал пропорции
+  картинки. Пока варианты не собраны, отдается оригинал.
+  """
+  attrs.setdefault('alt', recipe.name if recipe else '')
+  attrs.setdefault('loading', 'lazy')
+  attrs.setdefault('decoding', 'async')
+  image = images.variant(recipe, variant) if recipe else None
+  if image is None:
+    return format_html('<img src="{}"{}>', static(PLACEHOLDER), _attributes(attrs))
+
+  names = list(images.VARIANTS)
+  larger = names[names.index(variant) + 1] if names.index(variant) + 1 < len(names) else None
+  double = images.variant(recipe, larger) if larger else None
+  if image['width'] and image['height']:
+    attrs.setdefault('width', image['width'])
+    attrs.setdefault('height', image['height'])
+
+  img = format_html('<img src="{}" srcset="{}"{}>', image['jpeg'],
+                    _srcset(image, double, 'jpeg'), _attributes(attrs))
+  if not image['webp']:
+    return img
+  return format_html('<picture><source type="image/webp" srcset="{}">{}</picture>',
+                     _srcset(image, double, 'webp'), img)
+
+
+def _attributes(attrs):
+  return format_html_join('', ' {}="{}"', ((name.replace('_', '-'), value)
+                                          for name, value in attrs.items()))
@@ -1,3 +1,1514 @@
-from django.test import TestCase
+from datetime import timedelta
+import gzip
+import json
+import logging
+from decimal import Decimal
+from io import BytesIO, StringIO
+from pathlib import Path
+import random
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.models import Session
+from django.core import signing
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import (AsyncClient, RequestFactory, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from foodplan.staticfiles import ImmutableStaticFiles
+
+from . import (bulk_actions, candidates, favorites, instrumentation, meal_queue, page_cache,
+               plan_cache, planner, plan_state, preferences, quota, recipe_cache, sampling)
+from .admin import RecipeAdmin, UserProfileAdmin
+from .models import (Allergen, BulkJob, Ingredient, LikedRecipe, Recipe, UserProfile,
+                     recipe_filter_q)
+
+
+# Кэш recipes по умолчанию лежит на диске в BASE_DIR/cache вместе с
+# сессиями и версией индекса кандидатов. Тесты работают со своими кэшами в
+# памяти: очистка в setUp не трогает рабочий кэш, а прошлые запуски не
+# оставляют в нем состояния.
+TEST_CACHES = {
+  'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'tests-default',
+  },
+  'recipes': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'tests-recipes',
+    'OPTIONS': settings.CACHES['recipes'].get('OPTIONS', {}),
+  },
+}
+isolated_caches = override_settings(CACHES=TEST_CACHES)
+# Строки замеров медленных админских страниц не печатаются в вывод тестов;
+# assertLogs сам понижает уровень логгера и ловит их
+views_logger = logging.getLogger('recipes.views')
+views_log_level = views_logger.level
+
+
+def setUpModule():
+  isolated_caches.enable()
+  views_logger.setLevel(logging.ERROR)
+
+
+def tearDownModule():
+  isolated_caches.disable()
+  views_logger.setLevel(views_log_level)
+
+
+def make_recipe(name='Рецепт', **kwargs):
+  fields = {
+    'calories': 400,
+    'dish_type': 'grains',
+    'meal_type': 'lunch',
+  }
+  fields.update(kwargs)
+  return Recipe.objects.create(name=name, **fields)
+
+
+def make_ingredient(name='Ингредиент', cost='10.00', weight=100):
+  return Ingredient.objects.create(name=name, weight=weight, cost=Decimal(cost))
+
+
+def plan_state_of(client):
+  cookie = client.cookies.get(plan_state.COOKIE_NAME)
+  if cookie is None or not cookie.value:
+    return {}
+  return signing.loads(cookie.value, salt=plan_state.SALT)
+
+
+def set_plan_state(client, **values):
+  state = {**plan_state_of(client), **values}
+  client.cookies[plan_state.COOKIE_NAME] = signing.dumps(state, salt=plan_state.SALT, compress=True)
+
+
+class RecipeTotalCostTests(TestCase):
+  def setUp(self):
+    self.rice = make_ingredient('Рис', '30.50')
+    self.milk = make_ingredient('Молоко', '20.00')
+    self.recipe = make_recipe('Каша')
+
+  def stored_cost(self, recipe=None):
+    return Recipe.objects.get(pk=(recipe or self.recipe).pk).total_cost
+
+  def test_add_and_remove_ingredients(self):
+    self.recipe.ingredients.add(self.rice, self.milk)
+    self.assertEqual(self.stored_cost(), Decimal('50.50'))
+    self.assertEqual(self.recipe.total_cost, Decimal('50.50'))
+
+    self.recipe.ingredients.remove(self.milk)
+    self.assertEqual(self.stored_cost(), Decimal('30.50'))
+
+    self.recipe.ingredients.clear()
+    self.assertEqual(self.stored_cost(), Decimal('0.00'))
+
+  def test_reverse_side_changes(self):
+    other = make_recipe('Суп')
+    self.milk.recipes.add(self.recipe, other)
+    self.assertEqual(self.stored_cost(other), Decimal('20.00'))
+
+    self.milk.recipes.clear()
+    self.assertEqual(self.stored_cost(), Decimal('0.00'))
+    self.assertEqual(self.stored_cost(other), Decimal('0.00'))
+
+  def test_ingredient_cost_edit_and_delete(self):
+    self.recipe.ingredients.add(self.rice, self.milk)
+
+    self.milk.cost = Decimal('25.00')
+    self.milk.save()
+    self.assertEqual(self.stored_cost(), Decimal('55.50'))
+
+    self.rice.delete()
+    self.assertEqual(self.stored_cost(), Decimal('25.00'))
+
+  def test_stale_instance_save_keeps_cost(self):
+    stale = Recipe.objects.get(pk=self.recipe.pk)
+    self.recipe.ingredients.add(self.rice)
+    stale.name = 'Каша на воде'
+    stale.save()
+    self.assertEqual(self.stored_cost(), Decimal('30.50'))
+
+  def test_max_cost_filter_uses_column(self):
+    self.recipe.ingredients.add(self.rice, self.milk)
+    cheap = make_recipe('Салат')
+    cheap.ingredients.add(self.milk)
+
+    candidates.get_index()
+    with self.assertNumQueries(0):
+      recipe_id = sampling.get_sampler('lunch', {'max_cost': '40'}).pick()
+    self.assertEqual(recipe_id, cheap.id)
+
+  def test_recalculate_command(self):
+    self.recipe.ingredients.add(self.rice)
+    Recipe.objects.update(total_cost=0)
+
+    out = StringIO()
+    call_command('recalculate_costs', '--check', stdout=out)
+    self.assertIn('Найдено расхождений: 1', out.getvalue())
+
+    call_command('recalculate_costs', stdout=StringIO())
+    self.assertEqual(self.stored_cost(), Decimal('30.50'))
+
+    out = StringIO()
+    call_command('recalculate_costs', '--check', stdout=out)
+    self.assertIn('Расхождений не найдено', out.getvalue())
+
+
+class CandidateIndexTests(TestCase):
+  def setUp(self):
+    candidates.invalidate()
+    self.oats = make_recipe('Овсянка', meal_type='breakfast', calories=300,
+                            is_vegetarian=True, no_gluten=True, dish_type='grains')
+    self.omelette = make_recipe('Омлет', meal_type='breakfast', calories=450,
+                                dish_type='dairy')
+    self.steak = make_recipe('Стейк', meal_type='dinner', calories=800,
+                             dish_type='meat')
+    self.oats.ingredients.add(make_ingredient('Овес', '15.00'))
+    self.omelette.ingredients.add(make_ingredient('Яйца', '40.00'))
+
+  def pool_ids(self, meal_type, filters, max_cost=None):
+    pool = candidates.get_index().pool(meal_type, filters)
+    return list(pool.ids_up_to(candidates.parse_max_cost(max_cost)))
+
+  def test_pools_by_meal_type_and_filters(self):
+    self.assertEqual(self.pool_ids('breakfast', {}), [self.oats.id, self.omelette.id])
+    self.assertEqual(self.pool_ids('breakfast', {'is_vegetarian': True}), [self.oats.id])
+    self.assertEqual(self.pool_ids('breakfast', {'dish_type': 'dairy'}), [self.omelette.id])
+    self.assertEqual(self.pool_ids('dinner', {'low_calorie': True}), [])
+    self.assertEqual(self.pool_ids(None, {'low_calorie': True, 'no_gluten': True}),
+                     [self.oats.id])
+
+  def test_max_cost_cut(self):
+    self.assertEqual(self.pool_ids('breakfast', {}, '39.99'), [self.oats.id])
+    self.assertEqual(self.pool_ids('breakfast', {}, '40'), [self.oats.id, self.omelette.id])
+    self.assertEqual(self.pool_ids('breakfast', {}, 'дорого'),
+                     [self.oats.id, self.omelette.id])
+
+  def test_invalidated_on_recipe_and_ingredient_changes(self):
+    index = candidates.get_index()
+    self.assertIs(candidates.get_index(), index)
+
+    self.steak.is_vegetarian = True
+    self.steak.save()
+    self.assertEqual(self.pool_ids('dinner', {'is_vegetarian': True}), [self.steak.id])
+
+    egg = self.omelette.ingredients.get()
+    egg.cost = Decimal('5.00')
+    egg.save()
+    self.assertEqual(self.pool_ids('breakfast', {}, '10'), [self.omelette.id])
+
+  def test_sql_filters_agree_with_pools(self):
+    for meal_type, filters in (('breakfast', {'is_vegetarian': True}),
+                               ('breakfast', {'dish_type': 'dairy', 'max_cost': '40'}),
+                               (None, {'low_calorie': True, 'no_gluten': True})):
+      self.assertEqual(
+        set(Recipe.objects.matching(filters, meal_type).values_list('id', flat=True)),
+        set(self.pool_ids(meal_type, filters, filters.get('max_cost'))))
+
+  def test_explain_filters_uses_indexes(self):
+    out = StringIO()
+    call_command('explain_filters', '--meal-type', 'breakfast', '--seed', '500', stdout=out)
+    self.assertIn('recipe_filter_idx', out.getvalue())
+    self.assertIn('Комбинаций: 32, без индекса: 0', out.getvalue())
+
+  def test_shared_version(self):
+    with self.settings(RECIPES_CANDIDATE_INDEX_CACHE='default',
+                       RECIPES_CANDIDATE_INDEX_SHARED=True):
+      index = candidates.get_index()
+      candidates.invalidate()
+      self.assertNotEqual(candidates.get_index().version, index.version)
+
+  def test_invalidation_from_another_process_is_seen(self):
+    candidates.get_index()
+    # bulk_create не шлет сигналов: так выглядит изменение, сделанное другим воркером
+    recipe, = Recipe.objects.bulk_create([Recipe(name='Из соседа', calories=300,
+                                                 dish_type='fish', meal_type='dinner')])
+    self.assertNotIn(recipe.id, candidates.get_index().recipe_ids)
+    candidates._shared_cache().incr(candidates.VERSION_KEY)
+    self.assertIn(recipe.id, candidates.get_index().recipe_ids)
+
+
+class WeightedSamplerTests(TestCase):
+  def setUp(self):
+    candidates.invalidate()
+    self.recipes = []
+    for i in range(10):
+      recipe = make_recipe(f'Ужин {i}', meal_type='dinner')
+      recipe.ingredients.add(make_ingredient(f'Продукт {i}', f'{10 + i}.00'))
+      self.recipes.append(recipe)
+
+  def test_liked_weighting_is_preserved(self):
+    ids = [recipe.id for recipe in self.recipes]
+    liked = {ids[0], ids[5]}
+    disliked = {ids[3]}
+    current = ids[7]
+    sampler = sampling.get_sampler('dinner', {}, liked, disliked)
+
+    weights = {recipe_id: (sampling.LIKED_WEIGHT if recipe_id in liked else 1)
+               for recipe_id in ids if recipe_id not in disliked and recipe_id != current}
+    total_weight = sum(weights.values())
+    draws = 30000
+    rng = random.Random(42)
+    counts = dict.fromkeys(ids, 0)
+    for _ in range(draws):
+      counts[sampler.pick(exclude=(current,), rng=rng)] += 1
+
+    self.assertEqual(counts[ids[3]], 0)
+    self.assertEqual(counts[current], 0)
+    chi_square = sum(
+      (counts[recipe_id] - draws * weight / total_weight) ** 2 / (draws * weight / total_weight)
+      for recipe_id, weight in weights.items()
+    )
+    # 99.9%-квантиль хи-квадрат для 7 степеней свободы
+    self.assertLess(chi_square, 24.32)
+
+  def test_max_cost_and_exhausted_pool(self):
+    ids = [recipe.id for recipe in self.recipes]
+    sampler = sampling.get_sampler('dinner', {'max_cost': '11'}, disliked_ids={ids[0]})
+    self.assertEqual(sampler.pick(), ids[1])
+    self.assertIsNone(sampler.pick(exclude=(ids[1],)))
+
+  def test_sampler_reused_until_catalog_changes(self):
+    sampler = sampling.get_sampler('dinner', {}, {self.recipes[0].id})
+    self.assertIs(sampling.get_sampler('dinner', {}, {self.recipes[0].id}), sampler)
+    self.recipes[0].save()
+    self.assertIsNot(sampling.get_sampler('dinner', {}, {self.recipes[0].id}), sampler)
+
+
+class PlannerTests(TestCase):
+  def setUp(self):
+    candidates.invalidate()
+    self.user = User.objects.create_user('planner@example.com', password='secret')
+    self.profile = self.user.userprofile
+    self.meals = {
+      meal_type: [make_recipe(f'{meal_type} {i}', meal_type=meal_type) for i in range(3)]
+      for meal_type in planner.MEAL_TYPES
+    }
+
+  def test_full_plan_query_budget(self):
+    self.profile.liked_recipes.add(self.meals['lunch'][0])
+    self.profile.disliked_recipes.add(self.meals['dinner'][0])
+    candidates.get_index()
+
+    with self.assertNumQueries(3):
+      plan = planner.plan_meals(self.user, {'max_cost': '1000'}, planner.MEAL_TYPES)
+
+    self.assertEqual(set(plan), set(planner.MEAL_TYPES))
+    self.assertNotEqual(plan['dinner'], self.meals['dinner'][0].id)
+    profile = UserProfile.objects.get(pk=self.profile.pk)
+    self.assertEqual(profile.max_cost, Decimal('1000.00'))
+    self.assertEqual(profile.filters, {'max_cost': Decimal('1000.00')})
+    self.assertEqual(profile.breakfast_refresh_count, 1)
+    self.assertEqual(profile.lunch_refresh_count, 1)
+    self.assertEqual(profile.dinner_refresh_count, 1)
+
+  def test_blocked_meal_is_skipped(self):
+    self.profile.lunch_refresh_count = quota.REFRESH_LIMIT
+    self.profile.save()
+
+    plan = planner.plan_meals(self.user, {}, ['breakfast', 'lunch'])
+    self.assertEqual(set(plan), {'breakfast'})
+
+  @mock.patch.object(quota.CacheTokenBucketQuota, 'shared_backends', (LocMemCache,))
+  def test_configured_backend_decides_which_meals_to_pick(self):
+    # Счетчики в профиле говорят «обед исчерпан», но лимитами ведает кэш
+    self.profile.lunch_refresh_count = quota.REFRESH_LIMIT
+    self.profile.save()
+    with self.settings(RECIPES_QUOTA_BACKEND='recipes.quota.CacheTokenBucketQuota'):
+      quota.get_backend().cache.clear()
+      plan = planner.plan_meals(self.user, {}, ['breakfast', 'lunch'])
+    self.assertEqual(set(plan), {'breakfast', 'lunch'})
+
+  def test_apply_filters_view(self):
+    self.client.force_login(self.user)
+    response = self.client.post(reverse('recipes:apply_filters'),
+                                {'meal_types': ['breakfast', 'dinner']})
+    self.assertRedirects(response, reverse('recipes:recipe_details'),
+                         fetch_redirect_response=False)
+
+    session = plan_state_of(self.client)
+    breakfast_ids = {recipe.id for recipe in self.meals['breakfast']}
+    self.assertIn(session['breakfast_recipe_id'], breakfast_ids)
+    self.assertNotIn('lunch_recipe_id', session)
+    self.assertEqual(session['recipe_filters'], {'meal_types': ['breakfast', 'dinner']})
+
+    response = self.client.get(reverse('recipes:recipe_details'))
+    self.assertIn(response.context['breakfast_recipe'].id, breakfast_ids)
+
+
+class DatabaseQuotaTests(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('quota@example.com', password='secret')
+    self.profile = self.user.userprofile
+    self.backend = quota.DatabaseQuota()
+
+  def reload(self):
+    return UserProfile.objects.get(pk=self.profile.pk)
+
+  def test_limit_blocks_meal(self):
+    results = [self.backend.consume(self.profile, 'lunch') for _ in range(4)]
+    self.assertEqual(results, [True, True, True, False])
+
+    profile = self.reload()
+    self.assertEqual(profile.lunch_refresh_count, quota.REFRESH_LIMIT)
+    self.assertIsNotNone(profile.lunch_blocked_until)
+    self.assertEqual(profile.breakfast_refresh_count, 0)
+
+  def test_expired_window_resets_all_meals(self):
+    past = timezone.now() - timedelta(hours=25)
+    UserProfile.objects.filter(pk=self.profile.pk).update(
+      last_refresh_date=past, lunch_refresh_count=3, dinner_refresh_count=2,
+      lunch_blocked_until=past + quota.REFRESH_WINDOW,
+    )
+
+    self.assertTrue(self.backend.consume(self.profile, 'lunch'))
+    profile = self.reload()
+    self.assertEqual(profile.lunch_refresh_count, 1)
+    self.assertIsNone(profile.lunch_blocked_until)
+    self.assertEqual(profile.dinner_refresh_count, 0)
+
+  def test_refresh_writes_only_quota_columns(self):
+    UserProfile.objects.filter(pk=self.profile.pk).update(allergies='орехи')
+    self.assertTrue(self.profile.refresh_dinner())
+    self.assertEqual(self.profile.dinner_refresh_count, 1)
+    self.assertEqual(self.reload().allergies, 'орехи')
+
+  def test_consume_many_detects_concurrent_change(self):
+    UserProfile.objects.filter(pk=self.profile.pk).update(breakfast_refresh_count=3)
+    granted = self.backend.consume_many(self.profile, ['breakfast', 'lunch'],
+                                        extra_updates={'no_gluten': True})
+    self.assertEqual(granted, {'lunch'})
+    profile = self.reload()
+    self.assertEqual(profile.breakfast_refresh_count, 3)
+    self.assertEqual(profile.lunch_refresh_count, 1)
+    self.assertTrue(profile.no_gluten)
+
+  def test_cache_token_bucket_requires_shared_cache(self):
+    with self.assertRaises(ImproperlyConfigured):
+      quota.CacheTokenBucketQuota()
+
+  @mock.patch.object(quota.CacheTokenBucketQuota, 'shared_backends', (LocMemCache,))
+  def test_cache_token_bucket(self):
+    backend = quota.CacheTokenBucketQuota()
+    backend.cache.clear()
+    results = [backend.consume(self.profile, 'breakfast') for _ in range(4)]
+    self.assertEqual(results, [True, True, True, False])
+    self.assertTrue(backend.consume(self.profile, 'dinner'))
+
+
+class ConcurrentQuotaTests(TransactionTestCase):
+  def test_parallel_refreshes_respect_limit(self):
+    user = User.objects.create_user('threads@example.com', password='secret')
+    profile = user.userprofile
+    results = []
+    barrier = threading.Barrier(8)
+
+    def refresh():
+      try:
+        barrier.wait()
+        for _ in range(10):
+          try:
+            results.append(quota.DatabaseQuota().consume(profile, 'lunch'))
+            break
+          except Exception as error:
+            # SQLite в общей памяти отвечает блокировкой вместо ожидания
+            if 'locked' not in str(error):
+              raise
+      finally:
+        connection.close()
+
+    threads = [threading.Thread(target=refresh) for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(len(results), 8)
+    self.assertEqual(results.count(True), quota.REFRESH_LIMIT)
+    self.assertEqual(UserProfile.objects.get(pk=profile.pk).lunch_refresh_count,
+                     quota.REFRESH_LIMIT)
+
+
+class ReadOnlyQuotaStatusTests(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('status@example.com', password='secret')
+    self.past = timezone.now() - timedelta(hours=30)
+    UserProfile.objects.filter(user=self.user).update(
+      last_refresh_date=self.past, breakfast_refresh_count=3,
+      breakfast_blocked_until=self.past + quota.REFRESH_WINDOW,
+    )
+
+  def assertNoWrites(self, queries):
+    writes = [query['sql'] for query in queries
+              if query['sql'].startswith(('UPDATE', 'INSERT', 'DELETE'))
+              and 'django_session' not in query['sql']]
+    self.assertEqual(writes, [])
+
+  def test_status_treats_expired_window_as_reset(self):
+    profile = UserProfile.objects.get(user=self.user)
+    status = quota.status(profile, 'breakfast')
+    self.assertEqual(status, quota.QuotaStatus(0, quota.REFRESH_LIMIT, None, True))
+    self.assertEqual(UserProfile.objects.get(user=self.user).breakfast_refresh_count, 3)
+
+  def test_recipe_details_does_not_write(self):
+    self.client.force_login(self.user)
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(reverse('recipes:recipe_details'))
+    self.assertEqual(response.context['remaining_breakfast'], quota.REFRESH_LIMIT)
+    self.assertNoWrites(queries)
+
+  def test_admin_changelist_does_not_write(self):
+    admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+    for i in range(5):
+      user = User.objects.create_user(f'user{i}@example.com')
+      UserProfile.objects.filter(user=user).update(last_refresh_date=self.past)
+    self.client.force_login(admin)
+
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(reverse('admin:recipes_userprofile_changelist'))
+    self.assertEqual(response.status_code, 200)
+    self.assertContains(response, '✅ 0/3 (ост: 3)')
+    self.assertNoWrites(queries)
+
+
+class AdminChangelistQueryTests(TestCase):
+  def setUp(self):
+    self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+    self.client.force_login(self.admin)
+
+  def changelist_queries(self, model_admin, url_name):
+    # Все строки на одной странице, чтобы запросы считались по всему списку
+    with mock.patch.object(model_admin, 'list_per_page', 1000), \
+         CaptureQueriesContext(connection) as queries:
+      response = self.client.get(reverse(url_name))
+    self.assertEqual(response.status_code, 200)
+    return len(queries)
+
+  def add_profiles(self, count):
+    start = User.objects.count()
+    users = User.objects.bulk_create(
+      User(username=f'bulk{start + i}@example.com') for i in range(count))
+    profiles = UserProfile.objects.bulk_create(UserProfile(user=user) for user in users)
+    recipe = make_recipe('Популярное')
+    for profile in profiles:
+      profile.liked_recipes.add(recipe)
+      profile.disliked_recipes.add(make_recipe('Нелюбимое'))
+
+  def add_recipes(self, count):
+    ingredient = make_ingredient()
+    profile = self.admin.userprofile
+    for i in range(count):
+      recipe = make_recipe(f'Блюдо {i}')
+      recipe.ingredients.add(ingredient)
+      profile.liked_recipes.add(recipe)
+
+  def test_userprofile_changelist_constant_queries(self):
+    self.add_profiles(10)
+    small = self.changelist_queries(UserProfileAdmin, 'admin:recipes_userprofile_changelist')
+    self.add_profiles(490)
+    large = self.changelist_queries(UserProfileAdmin, 'admin:recipes_userprofile_changelist')
+    self.assertEqual(small, large)
+
+  def test_recipe_changelist_constant_queries(self):
+    self.add_recipes(10)
+    small = self.changelist_queries(RecipeAdmin, 'admin:recipes_recipe_changelist')
+    self.add_recipes(490)
+    large = self.changelist_queries(RecipeAdmin, 'admin:recipes_recipe_changelist')
+    self.assertEqual(small, large)
+
+
+class BulkAdminActionTests(TestCase):
+  def setUp(self):
+    self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+    self.client.force_login(self.admin)
+    self.recipe = make_recipe()
+    for i in range(5):
+      user = User.objects.create_user(f'cohort{i}@example.com')
+      UserProfile.objects.filter(user=user).update(lunch_refresh_count=3, dinner_refresh_count=2)
+      user.userprofile.liked_recipes.add(self.recipe)
+    self.profile_ids = list(UserProfile.objects.exclude(user=self.admin).values_list('pk', flat=True))
+
+  def run_action(self, action):
+    return self.client.post(reverse('admin:recipes_userprofile_changelist'), {
+      'action': action,
+      '_selected_action': self.profile_ids,
+    })
+
+  def test_reset_is_single_update(self):
+    with CaptureQueriesContext(connection) as queries:
+      self.run_action('reset_lunch_limits')
+    updates = [query for query in queries if query['sql'].startswith('UPDATE "recipes_userprofile"')]
+    self.assertEqual(len(updates), 1)
+
+    profiles = UserProfile.objects.filter(pk__in=self.profile_ids)
+    self.assertEqual(set(profiles.values_list('lunch_refresh_count', flat=True)), {0})
+    self.assertEqual(set(profiles.values_list('dinner_refresh_count', flat=True)), {2})
+
+  def test_partial_reset_keeps_refresh_window(self):
+    started = timezone.now() - timedelta(hours=5)
+    profiles = UserProfile.objects.filter(pk__in=self.profile_ids)
+    profiles.update(last_refresh_date=started)
+
+    self.run_action('reset_lunch_limits')
+    self.assertEqual(set(profiles.values_list('last_refresh_date', flat=True)), {started})
+
+    self.run_action('reset_all_limits')
+    self.assertGreater(min(profiles.values_list('last_refresh_date', flat=True)), started)
+
+  def test_clear_liked_deletes_through_rows(self):
+    self.run_action('clear_liked_recipes')
+    self.assertFalse(UserProfile.liked_recipes.through.objects
+                     .filter(userprofile__in=self.profile_ids).exists())
+
+  def test_large_selection_runs_as_chunked_job(self):
+    with self.settings(RECIPES_BULK_ACTION_THRESHOLD=2), \
+         mock.patch.object(bulk_actions, 'start') as start:
+      with self.captureOnCommitCallbacks(execute=True):
+        self.run_action('reset_all_limits')
+
+    job = BulkJob.objects.get()
+    start.assert_called_once_with(job.pk)
+    self.assertEqual((job.status, job.total, job.processed), ('pending', 5, 0))
+
+    bulk_actions.run(job.pk, chunk_size=2)
+    job.refresh_from_db()
+    self.assertEqual((job.status, job.processed), ('done', 5))
+    self.assertFalse(UserProfile.objects.filter(lunch_refresh_count__gt=0).exists())
+
+  def make_job(self, **fields):
+    return BulkJob.objects.create(action='reset_lunch_limits', object_ids=self.profile_ids,
+                                  total=len(self.profile_ids), **fields)
+
+  def test_running_job_is_not_claimed_twice(self):
+    job = self.make_job(status='running', heartbeat_at=timezone.now())
+    out = StringIO()
+    call_command('run_bulk_jobs', stdout=out)
+    self.assertIn('выполняется другим обработчиком (0/5)', out.getvalue())
+    self.assertEqual(UserProfile.objects.filter(lunch_refresh_count=3).count(), 5)
+
+    BulkJob.objects.filter(pk=job.pk).update(
+      heartbeat_at=timezone.now() - bulk_actions.LEASE_TIMEOUT - timedelta(seconds=1))
+    self.assertTrue(bulk_actions.run(job.pk))
+    job.refresh_from_db()
+    self.assertEqual((job.status, job.processed), ('done', 5))
+
+  def test_worker_that_lost_lease_stops_without_applying_chunk(self):
+    job = self.make_job()
+    reset = bulk_actions.ACTIONS['reset_lunch_limits']
+
+    def reset_and_lose_lease(profiles):
+      reset(profiles)
+      # Тем временем задачу захватил другой обработчик
+      BulkJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() + timedelta(hours=1))
+
+    with mock.patch.dict(bulk_actions.ACTIONS, {'reset_lunch_limits': reset_and_lose_lease}), \
+         self.assertLogs('recipes.bulk_actions', 'WARNING'):
+      self.assertFalse(bulk_actions.run(job.pk, chunk_size=2))
+    job.refresh_from_db()
+    self.assertEqual((job.status, job.processed), ('running', 0))
+    self.assertEqual(UserProfile.objects.filter(lunch_refresh_count=3).count(), 5)
+
+
+class PageQueryCountTests(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('pages@example.com', password='secret')
+    self.client.force_login(self.user)
+
+  def page_queries(self, url):
+    # Считаем запросы холодного рендера, без кэша рецептов
+    recipe_cache.get_cache().clear()
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    return len(queries)
+
+  def add_ingredients(self, recipe, count):
+    recipe.ingredients.add(*[make_ingredient(f'{recipe.name} {i}') for i in range(count)])
+
+  def test_recipe_details_batches_meals(self):
+    meals = {}
+    for meal_type in planner.MEAL_TYPES:
+      meals[meal_type] = make_recipe(meal_type, meal_type=meal_type)
+      self.add_ingredients(meals[meal_type], 1)
+    set_plan_state(self.client, **{f'{meal_type}_recipe_id': recipe.id
+                                   for meal_type, recipe in meals.items()})
+
+    small = self.page_queries(reverse('recipes:recipe_details'))
+    for recipe in meals.values():
+      self.add_ingredients(recipe, 10)
+    response = self.client.get(reverse('recipes:recipe_details'))
+    self.assertEqual(response.context['dinner_recipe'], meals['dinner'])
+    self.assertContains(response, 'dinner 9')
+    self.assertEqual(self.page_queries(reverse('recipes:recipe_details')), small)
+
+  def test_lk_constant_for_many_favorites(self):
+    profile = self.user.userprofile
+    ingredient = make_ingredient()
+
+    def like(count):
+      for i in range(count):
+        recipe = make_recipe(f'Избранное {i}')
+        recipe.ingredients.add(ingredient)
+        profile.liked_recipes.add(recipe)
+
+    like(10)
+    small = self.page_queries(reverse('recipes:lk'))
+    like(190)
+    self.assertEqual(self.page_queries(reverse('recipes:lk')), small)
+
+  def test_recipe_card_constant_for_many_ingredients(self):
+    recipe = make_recipe('Карточка')
+    self.add_ingredients(recipe, 1)
+    url = reverse('recipes:recipe_card', args=[recipe.id])
+    small = self.page_queries(url)
+    self.add_ingredients(recipe, 20)
+    self.assertEqual(self.page_queries(url), small)
+
+
+class FavoritesPaginationTests(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('fav', password='pass')
+    self.client.force_login(self.user)
+    self.profile = self.user.userprofile
+    now = timezone.now()
+    self.recipes = []
+    for i in range(7):
+      recipe = make_recipe(f'Избранное {i}')
+      # Два лайка с одинаковым временем проверяют порядок по id
+      LikedRecipe.objects.create(userprofile=self.profile, recipe=recipe,
+                                 liked_at=now - timedelta(minutes=i // 2))
+      self.recipes.append(recipe)
+
+  def expected_order(self):
+    return [like.recipe for like in
+            LikedRecipe.objects.filter(userprofile=self.profile).order_by('-liked_at', '-id')]
+
+  def test_pages_cover_all_likes_once(self):
+    seen, cursor = [], None
+    while True:
+      page, cursor = favorites.get_page(self.profile, cursor, page_size=3)
+      seen.extend(page)
+      if cursor is None:
+        break
+    self.assertEqual(seen, self.expected_order())
+
+  def test_invalid_cursor_starts_from_first_page(self):
+    page, _ = favorites.get_page(self.profile, 'не-курсор', page_size=3)
+    self.assertEqual(page, self.expected_order()[:3])
+
+  def test_json_endpoint(self):
+    url = reverse('recipes:lk_favorites')
+    data = self.client.get(url, {'format': 'json', 'page_size': 5}).json()
+    self.assertEqual([item['id'] for item in data['results']],
+                     [recipe.id for recipe in self.expected_order()[:5]])
+    data = self.client.get(url, {'format': 'json', 'page_size': 5,
+                                 'cursor': data['next_cursor']}).json()
+    self.assertEqual(len(data['results']), 2)
+    self.assertIsNone(data['next_cursor'])
+
+  def test_fragment_query_count_independent_of_depth(self):
+    url = reverse('recipes:lk_favorites')
+    _, cursor = favorites.get_page(self.profile, None, page_size=1)
+    with CaptureQueriesContext(connection) as first:
+      self.client.get(url, {'page_size': 2})
+    with CaptureQueriesContext(connection) as deep:
+      response = self.client.get(url, {'page_size': 2, 'cursor': cursor})
+    self.assertEqual(len(first), len(deep))
+    self.assertContains(response, 'Показать еще')
+
+
+class RecipeCacheTests(TestCase):
+  def setUp(self):
+    recipe_cache.get_cache().clear()
+    self.recipe = make_recipe('Кэшируемый')
+    self.ingredient = make_ingredient('Сыр', '50.00')
+    self.recipe.ingredients.add(self.ingredient)
+    self.url = reverse('recipes:recipe_card', args=[self.recipe.id])
+
+  def test_card_served_from_cache_without_queries(self):
+    self.client.get(self.url)
+    with self.assertNumQueries(0):
+      response = self.client.get(self.url)
+    self.assertContains(response, 'Сыр')
+    stats = recipe_cache.stats()
+    self.assertEqual(stats['object']['hits'], 1)
+    self.assertEqual(stats['fragment']['hits'], 1)
+    self.assertEqual(stats['fragment']['misses'], 1)
+
+  def test_recipe_save_bumps_version(self):
+    self.client.get(self.url)
+    self.recipe.name = 'Переименованный'
+    self.recipe.save()
+    self.assertContains(self.client.get(self.url), 'Переименованный')
+
+  def test_ingredient_changes_bump_version(self):
+    self.client.get(self.url)
+    self.ingredient.cost = Decimal('70.00')
+    self.ingredient.save()
+    self.assertContains(self.client.get(self.url), '70,00')
+
+    self.recipe.ingredients.add(make_ingredient('Томат'))
+    self.assertContains(self.client.get(self.url), 'Томат')
+
+    self.ingredient.recipes.clear()
+    self.assertNotContains(self.client.get(self.url), 'Сыр')
+
+  def test_admin_action_bumps_version(self):
+    recipe_cache.get_recipe(self.recipe.id)
+    RecipeAdmin(Recipe, None).make_vegetarian(None, Recipe.objects.filter(pk=self.recipe.pk))
+    self.assertTrue(recipe_cache.get_recipe(self.recipe.id).is_vegetarian)
+
+  def test_missing_recipe_is_404(self):
+    response = self.client.get(reverse('recipes:recipe_card', args=[self.recipe.id + 1000]))
+    self.assertEqual(response.status_code, 404)
+
+
+class PlanSnapshotTests(TestCase):
+  def setUp(self):
+    recipe_cache.get_cache().clear()
+    plan_cache.get_cache().clear()
+    self.user = User.objects.create_user('plan@example.com', password='secret')
+    self.client.force_login(self.user)
+    self.recipes = {meal_type: make_recipe(meal_type, meal_type=meal_type)
+                    for meal_type in planner.MEAL_TYPES}
+    set_plan_state(self.client, **{f'{meal_type}_recipe_id': recipe.id
+                                   for meal_type, recipe in self.recipes.items()})
+    self.url = reverse('recipes:recipe_details')
+
+  def recipes_queries(self):
+    # Сессия и пользователь читаются middleware, в счет идут запросы страницы
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(self.url)
+    self.assertEqual(response.status_code, 200)
+    return response, [query['sql'] for query in queries
+                      if 'django_session' not in query['sql'] and 'auth_user' not in query['sql']]
+
+  def test_warm_page_needs_no_queries(self):
+    self.recipes_queries()
+    response, queries = self.recipes_queries()
+    self.assertEqual(queries, [])
+    self.assertEqual(response.context['lunch_recipe'], self.recipes['lunch'])
+
+  def test_like_refreshes_snapshot(self):
+    self.recipes_queries()
+    recipe = self.recipes['lunch']
+    self.client.post(reverse('recipes:like_recipe', args=[recipe.id]))
+    # Лайк сбрасывает снимок, не читая списки; первый GET его пересобирает
+    response, _ = self.recipes_queries()
+    self.assertEqual(response.context['user_liked_ids'], [recipe.id])
+    _, queries = self.recipes_queries()
+    self.assertEqual(queries, [])
+
+  def test_refresh_writes_snapshot(self):
+    make_recipe('Еще обед', meal_type='lunch')
+    self.recipes_queries()
+    self.client.post(reverse('recipes:refresh_lunch'))
+    response, queries = self.recipes_queries()
+    # Новое блюдо читается в кэш рецептов, профиль — нет
+    self.assertFalse([sql for sql in queries if 'recipes_userprofile' in sql])
+    self.assertEqual(response.context['remaining_lunch'], quota.REFRESH_LIMIT - 1)
+
+  def test_changes_outside_views_invalidate_snapshot(self):
+    self.recipes_queries()
+    profile = self.user.userprofile
+    profile.liked_recipes.add(self.recipes['dinner'])
+    response, _ = self.recipes_queries()
+    self.assertEqual(response.context['user_liked_ids'], [self.recipes['dinner'].id])
+
+    self.recipes['dinner'].liked_by.clear()
+    response, _ = self.recipes_queries()
+    self.assertEqual(response.context['user_liked_ids'], [])
+
+    profile._consume_refresh('dinner')
+    bulk_actions.apply('reset_dinner_limits', UserProfile.objects.filter(pk=profile.pk))
+    response, _ = self.recipes_queries()
+    self.assertEqual(response.context['remaining_dinner'], quota.REFRESH_LIMIT)
+
+  def test_consume_refresh_invalidates_snapshot(self):
+    self.recipes_queries()
+    self.user.userprofile.refresh_dinner()
+    response, _ = self.recipes_queries()
+    self.assertEqual(response.context['remaining_dinner'], quota.REFRESH_LIMIT - 1)
+
+  def test_local_cache_keeps_snapshot_briefly(self):
+    shared = {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'recipes_cache'}
+    with self.settings(CACHES={**TEST_CACHES, 'recipes': shared}):
+      self.assertEqual(plan_cache._timeout(), 60 * 60 * 24)
+    with self.settings(RECIPES_PLAN_CACHE='default'):
+      self.assertEqual(plan_cache._timeout(), plan_cache.LOCAL_CACHE_TIMEOUT)
+
+
+class PreferenceServiceTests(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('prefs@example.com', password='secret')
+    self.client.force_login(self.user)
+    self.profile = self.user.userprofile
+    self.recipe = make_recipe('Суп')
+
+  def test_like_and_dislike_are_exclusive_and_idempotent(self):
+    preferences.like(self.profile, self.recipe.id)
+    preferences.like(self.profile, self.recipe.id)
+    self.assertEqual(list(self.profile.liked_recipes.all()), [self.recipe])
+
+    preferences.dislike(self.profile, self.recipe.id)
+    self.assertFalse(self.profile.liked_recipes.exists())
+    self.assertEqual(list(self.profile.disliked_recipes.all()), [self.recipe])
+
+    preferences.clear(self.profile, self.recipe.id)
+    self.assertFalse(self.profile.disliked_recipes.exists())
+
+  def test_repeated_like_keeps_liked_at(self):
+    preferences.like(self.profile, self.recipe.id)
+    liked_at = LikedRecipe.objects.get(userprofile=self.profile).liked_at
+    preferences.like(self.profile, self.recipe.id)
+    self.assertEqual(LikedRecipe.objects.get(userprofile=self.profile).liked_at, liked_at)
+
+  def test_click_cost_independent_of_list_size(self):
+    url = reverse('recipes:like_recipe', args=[self.recipe.id])
+
+    def click_queries():
+      with CaptureQueriesContext(connection) as queries:
+        self.client.post(url)
+      return len(queries)
+
+    small = click_queries()
+    others = [make_recipe(f'Другое {i}') for i in range(50)]
+    self.profile.liked_recipes.add(*others[:25])
+    self.profile.disliked_recipes.add(*others[25:])
+    self.assertEqual(click_queries(), small)
+
+  def test_batch_endpoint(self):
+    other = make_recipe('Каша')
+    url = reverse('recipes:preferences_batch')
+    response = self.client.post(url, {'events': [
+      {'recipe_id': self.recipe.id, 'action': 'dislike'},
+      {'recipe_id': other.id, 'action': 'like', 'at': '2026-01-02T10:00:00Z'},
+      {'recipe_id': self.recipe.id, 'action': 'like'},
+      {'recipe_id': other.id + 1000, 'action': 'like'},
+      {'recipe_id': other.id, 'action': 'shrug'},
+    ]}, content_type='application/json')
+
+    data = response.json()
+    self.assertEqual(data['applied'], 2)
+    self.assertEqual([item['error'] for item in data['rejected']],
+                     ['unknown action', 'unknown recipe'])
+    self.assertEqual(set(self.profile.liked_recipes.all()), {self.recipe, other})
+    self.assertFalse(self.profile.disliked_recipes.exists())
+    self.assertEqual(LikedRecipe.objects.get(recipe=other).liked_at.year, 2026)
+
+  def test_batch_endpoint_rejects_bad_payload(self):
+    url = reverse('recipes:preferences_batch')
+    self.assertEqual(self.client.post(url, 'nope', content_type='application/json').status_code, 400)
+    events = [{'recipe_id': self.recipe.id, 'action': 'like'}] * (preferences.MAX_BATCH_SIZE + 1)
+    response = self.client.post(url, {'events': events}, content_type='application/json')
+    self.assertEqual(response.status_code, 400)
+
+
+class DeferredDislikeTests(TestCase):
+  def setUp(self):
+    plan_cache.get_cache().clear()
+    self.user = User.objects.create_user('dislike@example.com', password='secret')
+    self.client.force_login(self.user)
+    self.current = make_recipe('Текущий обед', meal_type='lunch')
+    self.replacement = make_recipe('Запасной обед', meal_type='lunch')
+    set_plan_state(self.client, lunch_recipe_id=self.current.id)
+
+  def test_dislike_does_not_replan(self):
+    with mock.patch.object(sampling, 'get_sampler') as get_sampler:
+      self.client.post(reverse('recipes:dislike_recipe', args=[self.current.id]))
+    get_sampler.assert_not_called()
+    self.assertEqual(plan_state_of(self.client)['pending_meals'], ['lunch'])
+    self.assertEqual(plan_state_of(self.client)['lunch_recipe_id'], self.current.id)
+
+  def test_next_render_replaces_disliked_meal(self):
+    self.client.post(reverse('recipes:dislike_recipe', args=[self.current.id]))
+    response = self.client.get(reverse('recipes:recipe_details'))
+    self.assertEqual(response.context['lunch_recipe'], self.replacement)
+    self.assertNotIn('pending_meals', plan_state_of(self.client))
+
+  def test_dislike_of_other_recipe_leaves_plan(self):
+    self.client.post(reverse('recipes:dislike_recipe', args=[self.replacement.id]))
+    self.assertNotIn('pending_meals', plan_state_of(self.client))
+    response = self.client.get(reverse('recipes:recipe_details'))
+    self.assertEqual(response.context['lunch_recipe'], self.current)
+
+
+class MealQueueTests(TestCase):
+  def setUp(self):
+    candidates.invalidate()
+    self.recipes = [make_recipe(f'Обед {i}', meal_type='lunch') for i in range(12)]
+    self.session = {}
+    self.preferences = mock.Mock(liked_ids=frozenset(), disliked_ids=frozenset(),
+                                 allergen_mask=0)
+
+  def pop(self, current_id=None, filters=None):
+    return meal_queue.pop(self.session, 'lunch', filters or {}, current_id, self.preferences)
+
+  def test_refills_in_bulk_and_never_repeats_current(self):
+    with mock.patch.object(sampling, 'get_sampler', wraps=sampling.get_sampler) as get_sampler:
+      current = None
+      for _ in range(meal_queue.QUEUE_SIZE - meal_queue.REFILL_AT + 1):
+        recipe_id = self.pop(current)
+        self.assertNotEqual(recipe_id, current)
+        current = recipe_id
+    self.assertEqual(get_sampler.call_count, 1)
+    self.assertEqual(len(set(self.session['meal_queue']['lunch']['ids'])),
+                     len(self.session['meal_queue']['lunch']['ids']))
+
+  def test_catalog_or_filter_change_rebuilds_queue(self):
+    self.pop()
+    vegetarian = make_recipe('Овощной обед', meal_type='lunch', is_vegetarian=True)
+    self.assertEqual(self.pop(filters={'is_vegetarian': True}), vegetarian.id)
+    self.assertEqual(self.session['meal_queue']['lunch']['ids'], [])
+
+  def test_discard_removes_disliked_recipe(self):
+    self.pop()
+    queued = self.session['meal_queue']['lunch']['ids'][0]
+    meal_queue.discard(self.session, queued)
+    self.assertNotIn(queued, self.session['meal_queue']['lunch']['ids'])
+
+  def test_refresh_view_pops_from_queue(self):
+    user = User.objects.create_user('queue@example.com', password='secret')
+    self.client.force_login(user)
+    self.client.post(reverse('recipes:refresh_lunch'))
+    session = plan_state_of(self.client)
+    first = session['lunch_recipe_id']
+    queued = session['meal_queue']['lunch']['ids']
+    self.client.post(reverse('recipes:refresh_lunch'))
+    self.assertEqual(plan_state_of(self.client)['lunch_recipe_id'], queued[0])
+    self.assertNotEqual(queued[0], first)
+
+
+class AsyncViewTests(TestCase):
+  def setUp(self):
+    plan_cache.get_cache().clear()
+    self.user = User.objects.create_user('async@example.com', password='secret')
+    self.recipes = [make_recipe(f'Обед {i}', meal_type='lunch') for i in range(3)]
+
+  async def test_planning_flow_over_asgi(self):
+    client = AsyncClient()
+    await client.aforce_login(self.user)
+
+    await client.post(reverse('recipes:apply_filters'), {'meal_types': ['lunch']})
+    response = await client.get(reverse('recipes:recipe_details'))
+    self.assertEqual(response.status_code, 200)
+    lunch = response.context['lunch_recipe']
+    self.assertIn(lunch, self.recipes)
+
+    await client.post(reverse('recipes:refresh_lunch'))
+    response = await client.get(reverse('recipes:recipe_details'))
+    self.assertNotEqual(response.context['lunch_recipe'], lunch)
+    self.assertEqual(response.context['remaining_lunch'], quota.REFRESH_LIMIT - 2)
+
+    liked = response.context['lunch_recipe']
+    await client.post(reverse('recipes:like_recipe', args=[liked.id]))
+    await client.post(reverse('recipes:dislike_recipe', args=[liked.id]))
+    response = await client.get(reverse('recipes:recipe_details'))
+    self.assertEqual(response.context['user_disliked_ids'], [liked.id])
+    self.assertNotEqual(response.context['lunch_recipe'], liked)
+
+  async def test_like_unknown_recipe_is_404(self):
+    client = AsyncClient()
+    await client.aforce_login(self.user)
+    response = await client.post(reverse('recipes:like_recipe', args=[10 ** 6]))
+    self.assertEqual(response.status_code, 404)
+
+
+class PreferenceColumnsTests(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('columns@example.com', password='secret')
+    self.profile = self.user.userprofile
+
+  def test_filters_round_trip(self):
+    self.profile.filters = {'meal_types': ['dinner', 'brunch'], 'is_vegetarian': True,
+                            'dish_type': 'fish', 'max_cost': '250.5'}
+    self.profile.save()
+
+    profile = UserProfile.objects.get(pk=self.profile.pk)
+    self.assertEqual(profile.meal_types, 'dinner')
+    self.assertEqual(profile.max_cost, Decimal('250.50'))
+    self.assertEqual(profile.filters, {'meal_types': ['dinner'], 'is_vegetarian': True,
+                                       'dish_type': 'fish', 'max_cost': Decimal('250.50')})
+
+    profile.filters = {'max_cost': 'дорого'}
+    self.assertIsNone(profile.max_cost)
+    self.assertEqual(profile.filters, {})
+
+  def test_recipe_filter_is_precompiled(self):
+    vegetarian = make_recipe('Овощи', is_vegetarian=True)
+    make_recipe('Котлета')
+    self.profile.filters = {'is_vegetarian': True}
+
+    self.assertIs(self.profile.recipe_filter('lunch'),
+                  recipe_filter_q('lunch', False, True, False, None, None, 0))
+    self.assertEqual(list(Recipe.objects.filter(self.profile.recipe_filter('lunch'))), [vegetarian])
+
+  def test_segments(self):
+    for i, filters in enumerate(({'is_vegetarian': True, 'dish_type': 'fish'},
+                                 {'is_vegetarian': True, 'no_gluten': True}, {})):
+      profile = User.objects.create_user(f'segment{i}@example.com').userprofile
+      profile.filters = filters
+      profile.save()
+
+    out = StringIO()
+    call_command('preference_segments', stdout=out)
+    self.assertIn('Профилей: 4', out.getvalue())
+    self.assertIn('Вегетарианское: 2', out.getvalue())
+    self.assertIn('Без глютена: 1', out.getvalue())
+    self.assertIn('Тип блюда «Рыба и морепродукты»: 1', out.getvalue())
+
+
+class AllergenMaskTests(TestCase):
+  def setUp(self):
+    candidates.invalidate()
+    self.nuts = Allergen.objects.create(name='Орехи')
+    self.milk = Allergen.objects.create(name='Молоко')
+    self.walnut = make_ingredient('Грецкий орех', '30.00')
+    self.cream = make_ingredient('Сливки', '20.00')
+    self.rice = make_ingredient('Рис', '10.00')
+    self.walnut.allergens.add(self.nuts)
+    self.cream.allergens.add(self.milk)
+    self.salad = make_recipe('Салат с орехами')
+    self.salad.ingredients.add(self.walnut, self.rice)
+    self.porridge = make_recipe('Рисовая каша')
+    self.porridge.ingredients.add(self.rice)
+
+  def mask(self, recipe):
+    return Recipe.objects.get(pk=recipe.pk).allergen_mask
+
+  def test_allergens_get_distinct_bits(self):
+    self.assertEqual({self.nuts.mask, self.milk.mask}, {1, 2})
+
+  def test_mask_follows_ingredients_and_allergens(self):
+    self.assertEqual(self.mask(self.salad), self.nuts.mask)
+    self.assertEqual(self.mask(self.porridge), 0)
+
+    self.porridge.ingredients.add(self.cream)
+    self.assertEqual(self.mask(self.porridge), self.milk.mask)
+
+    self.milk.ingredients.add(self.rice)
+    self.assertEqual(self.mask(self.salad), self.nuts.mask | self.milk.mask)
+
+    self.rice.allergens.clear()
+    self.assertEqual(self.mask(self.salad), self.nuts.mask)
+
+    self.nuts.delete()
+    self.assertEqual(self.mask(self.salad), 0)
+
+    self.cream.delete()
+    self.assertEqual(self.mask(self.porridge), 0)
+
+  def test_profile_allergens_exclude_recipes(self):
+    user = User.objects.create_user('allergy@example.com', password='secret')
+    user.userprofile.allergens.add(self.nuts)
+    profile = UserProfile.objects.get(pk=user.userprofile.pk)
+    self.assertEqual(profile.allergen_mask, self.nuts.mask)
+
+    self.assertEqual(list(Recipe.objects.filter(profile.recipe_filter('lunch'))), [self.porridge])
+    for _ in range(20):
+      plan = planner.plan_meals(user, {}, ['lunch'])
+      self.assertEqual(plan, {'lunch': self.porridge.id})
+      UserProfile.objects.filter(pk=profile.pk).update(lunch_refresh_count=0)
+
+    self.nuts.ingredients.add(self.rice)
+    self.assertEqual(planner.plan_meals(user, {}, ['lunch']), {})
+
+
+def make_image(width, height, name='dish.png'):
+  buffer = BytesIO()
+  Image.new('RGB', (width, height), 'orange').save(buffer, 'PNG')
+  return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class ImageVariantTests(TestCase):
+  def setUp(self):
+    media_root = tempfile.TemporaryDirectory()
+    self.addCleanup(media_root.cleanup)
+    settings_override = self.settings(MEDIA_ROOT=media_root.name, RECIPES_IMAGE_WORKERS=0)
+    settings_override.enable()
+    self.addCleanup(settings_override.disable)
+
+  def create(self, image):
+    with self.captureOnCommitCallbacks(execute=True):
+      recipe = make_recipe('Плов', image=image)
+    return Recipe.objects.get(pk=recipe.pk)
+
+  def test_variants_generated_on_upload(self):
+    recipe = self.create(make_image(1200, 800))
+    self.assertEqual((recipe.image_width, recipe.image_height), (1200, 800))
+    self.assertEqual(recipe.image_variants['source'], recipe.image.name)
+    card = recipe.image_variants['card']
+    self.assertEqual((card['width'], card['height']), (480, 320))
+    for fmt in ('jpeg', 'webp'):
+      self.assertTrue(recipe.image.storage.exists(card[fmt]))
+    with Image.open(recipe.image.storage.path(card['webp'])) as webp:
+      self.assertEqual(webp.format, 'WEBP')
+
+    small = self.create(make_image(100, 50, 'small.png'))
+    self.assertEqual(small.image_variants['large']['width'], 100)
+
+  def test_replaced_image_gets_new_variants(self):
+    recipe = self.create(make_image(1200, 800))
+    recipe.image = make_image(600, 600, 'square.png')
+    with self.captureOnCommitCallbacks(execute=True):
+      recipe.save()
+    recipe.refresh_from_db()
+    self.assertEqual(recipe.image_variants['source'], recipe.image.name)
+    self.assertEqual(recipe.image_variants['card']['height'], 480)
+
+  def test_template_tag(self):
+    recipe = self.create(make_image(1200, 800))
+    html = Template("{% load recipe_images %}{% recipe_image recipe 'card' class='x' %}").render(
+      Context({'recipe': recipe}))
+    card, large = recipe.image_variants['card'], recipe.image_variants['large']
+    self.assertIn(f'<source type="image/webp" srcset="/media/{card["webp"]} 1x, '
+                  f'/media/{large["webp"]} 2x">', html)
+    self.assertIn('width="480" height="320"', html)
+    self.assertIn('loading="lazy"', html)
+
+    html = Template("{% load recipe_images %}{% recipe_image recipe 'card' %}").render(
+      Context({'recipe': make_recipe('Без фото')}))
+    self.assertIn('circle1.png', html)
+    self.assertNotIn('<picture>', html)
+
+
+class BenchAsgiTests(TransactionTestCase):
+  def test_seed_leaves_no_rows(self):
+    kept = make_recipe('Свой рецепт')
+    out = StringIO()
+    # Один поток: общая база SQLite в памяти не выдерживает параллельной записи
+    call_command('bench_asgi', '--seed', '6', '--requests', '4', '--concurrency', '1', stdout=out)
+    self.assertIn('ASGI:', out.getvalue())
+    self.assertEqual(list(Recipe.objects.values_list('pk', flat=True)), [kept.pk])
+    self.assertFalse(User.objects.exists())
+
+
+class ImageBackfillTests(TransactionTestCase):
+  def test_backfill_in_parallel(self):
+    with tempfile.TemporaryDirectory() as media_root, \
+         self.settings(MEDIA_ROOT=media_root, RECIPES_IMAGE_WORKERS=0):
+      recipes = [make_recipe(f'Блюдо {i}', image=make_image(800, 600, f'dish{i}.png'))
+                 for i in range(4)]
+      Recipe.objects.update(image_variants={})
+
+      out = StringIO()
+      call_command('generate_recipe_images', '--workers', '2', stdout=out)
+      self.assertIn('Собрано: 4', out.getvalue())
+      for recipe in recipes:
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.image_variants['thumb']['width'], 120)
+
+      out = StringIO()
+      call_command('generate_recipe_images', stdout=out)
+      self.assertIn('Все варианты уже собраны', out.getvalue())
+
+
+class StaticPipelineTests(TestCase):
+  def setUp(self):
+    source = tempfile.TemporaryDirectory()
+    target = tempfile.TemporaryDirectory()
+    self.addCleanup(source.cleanup)
+    self.addCleanup(target.cleanup)
+    self.source, self.root = Path(source.name), Path(target.name)
+    (self.source / 'css').mkdir()
+    (self.source / 'css' / 'site.css').write_text(
+      'body { background: url("../img/bg.png"); }\n' + '.card { margin: 0 auto; }\n' * 100)
+    (self.source / 'img').mkdir()
+    Image.effect_noise((300, 200), 40).convert('RGB').save(self.source / 'img' / 'bg.png')
+
+  def collect(self):
+    storages = {
+      'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+      'staticfiles': {'BACKEND': 'foodplan.staticfiles.OptimizedManifestStaticFilesStorage'},
+    }
+    with self.settings(STATICFILES_DIRS=[self.source], STATIC_ROOT=self.root, STORAGES=storages,
+                       INSTALLED_APPS=['django.contrib.staticfiles', 'recipes']):
+      call_command('collectstatic', '--noinput', verbosity=0)
+      manifest = json.loads((self.root / 'staticfiles.json').read_text())['paths']
+    return manifest
+
+  def request(self, path, **environ):
+    app = ImmutableStaticFiles(lambda environ, start_response: [b'django'], self.root, '/static/')
+    response = {}
+
+    def start_response(status, headers):
+      response['status'] = status
+      response['headers'] = dict(headers)
+
+    body = b''.join(app({'REQUEST_METHOD': 'GET', 'PATH_INFO': path, **environ},
+                        start_response))
+    return response.get('status'), response.get('headers', {}), body
+
+  def test_collectstatic_writes_hashed_variants(self):
+    manifest = self.collect()
+    css = self.root / manifest['css/site.css']
+    png = self.root / manifest['img/bg.png']
+    self.assertIn(manifest['img/bg.png'].split('/')[-1], css.read_text())
+    self.assertLess((Path(f'{css}.gz')).stat().st_size, css.stat().st_size)
+    self.assertTrue(Path(f'{png}.webp').exists())
+
+  def test_handler_headers_and_negotiation(self):
+    manifest = self.collect()
+    css_url = f"/static/{manifest['css/site.css']}"
+
+    status, headers, body = self.request(css_url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+    self.assertEqual(status, '200 OK')
+    self.assertEqual(headers['Cache-Control'], 'public, max-age=31536000, immutable')
+    self.assertEqual(headers['Content-Encoding'], 'gzip')
+    self.assertEqual(headers['Vary'], 'Accept-Encoding')
+    self.assertIn(b'.card', gzip.decompress(body))
+
+    status, headers, _ = self.request(css_url, HTTP_IF_NONE_MATCH=headers['ETag'],
+                                      HTTP_ACCEPT_ENCODING='gzip')
+    self.assertEqual(status, '304 Not Modified')
+
+    status, headers, _ = self.request(f"/static/{manifest['img/bg.png']}",
+                                      HTTP_ACCEPT='image/webp,*/*')
+    self.assertEqual(headers['Content-Type'], 'image/webp')
+    self.assertEqual(headers['Vary'], 'Accept')
+
+    status, headers, _ = self.request('/static/css/site.css')
+    self.assertEqual(headers['Cache-Control'], 'public, max-age=3600')
+    self.assertNotIn('Content-Encoding', headers)
+
+    for path in ('/static/../etc/passwd', '/static/missing.css', '/recipes/'):
+      self.assertEqual(self.request(path), (None, {}, b'django'))
+
+
+class HttpCachingTests(TestCase):
+  def setUp(self):
+    recipe_cache.get_cache().clear()
+    self.recipe = make_recipe('Условный')
+    self.ingredient = make_ingredient('Базилик')
+    self.recipe.ingredients.add(self.ingredient)
+    self.url = reverse('recipes:recipe_card', args=[self.recipe.id])
+
+  def test_recipe_card_revalidates_with_304(self):
+    response = self.client.get(self.url)
+    self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+    self.assertIn('Cookie', response['Vary'])
+    etag, last_modified = response['ETag'], response['Last-Modified']
+
+    with self.assertNumQueries(0):
+      response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 304)
+    self.assertEqual(response['ETag'], etag)
+    self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code,
+                     304)
+
+    self.ingredient.name = 'Тимьян'
+    self.ingredient.save()
+    response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+    self.assertContains(response, 'Тимьян')
+    self.assertNotEqual(response['ETag'], etag)
+
+  def test_recipe_card_etag_depends_on_login(self):
+    etag = self.client.get(self.url)['ETag']
+    self.client.force_login(User.objects.create_user('etag', password='pass'))
+    response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+  def test_admin_action_changes_last_modified(self):
+    etag = self.client.get(self.url)['ETag']
+    RecipeAdmin(Recipe, None).make_vegetarian(None, Recipe.objects.filter(pk=self.recipe.pk))
+    self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+  def test_anonymous_index_served_from_page_cache(self):
+    url = reverse('recipes:index')
+    first = self.client.get(url)
+    with mock.patch('recipes.views.render') as render:
+      cached = self.client.get(url)
+    render.assert_not_called()
+    self.assertEqual(cached.content, first.content)
+    self.assertEqual(cached['Cache-Control'], 'public, max-age=60')
+    self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=cached['ETag']).status_code, 304)
+
+    self.client.force_login(User.objects.create_user('index', password='pass'))
+    response = self.client.get(url)
+    self.assertContains(response, 'Личный кабинет')
+    self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+  def test_anonymous_page_with_cookie_gets_headers_but_is_not_cached(self):
+    calls = []
+
+    @page_cache.cache_anonymous_page
+    def view(request):
+      calls.append(request)
+      response = HttpResponse('<p>форма</p>')
+      response.set_cookie('csrftoken', f'token-{len(calls)}')
+      return response
+
+    request = RequestFactory().get('/form/')
+    request.user = AnonymousUser()
+    first = view(request)
+    self.assertEqual(first['Cache-Control'], 'public, max-age=60')
+    self.assertIn('Cookie', first['Vary'])
+    self.assertTrue(first.has_header('ETag'))
+
+    second = view(request)
+    self.assertEqual(len(calls), 2)
+    self.assertEqual(second.cookies['csrftoken'].value, 'token-2')
+
+
+class SessionStorageTests(TestCase):
+  def test_anonymous_pages_set_no_session_cookie(self):
+    recipe = make_recipe('Без cookie')
+    for url in (reverse('recipes:index'), reverse('recipes:recipe_card', args=[recipe.id]),
+                reverse('recipes:recipe_details')):
+      response = self.client.get(url)
+      self.assertEqual(response.status_code, 200)
+      self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+    self.assertFalse(Session.objects.exists())
+
+  def test_refresh_does_not_write_session_table(self):
+    make_recipe('Обед 1')
+    make_recipe('Обед 2')
+    self.client.force_login(User.objects.create_user('cookie@example.com', password='secret'))
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.post(reverse('recipes:refresh_lunch'))
+    self.assertIn(plan_state.COOKIE_NAME, response.cookies)
+    self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+    self.assertFalse([query for query in queries if 'django_session' in query['sql']
+                      and not query['sql'].startswith('SELECT')])
+    self.assertTrue(plan_state_of(self.client)['lunch_recipe_id'])
+
+  def test_logout_revokes_session_and_plan_state(self):
+    self.client.force_login(User.objects.create_user('revoke@example.com', password='secret'))
+    set_plan_state(self.client, lunch_recipe_id=1)
+    copied = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+
+    response = self.client.get(reverse('recipes:logout'))
+    self.assertEqual(response.cookies[plan_state.COOKIE_NAME].value, '')
+
+    self.client.cookies[settings.SESSION_COOKIE_NAME] = copied
+    self.assertEqual(self.client.get(reverse('recipes:lk')).status_code, 302)
+
+  def test_tampered_plan_state_is_ignored(self):
+    recipe = make_recipe('Подделка')
+    self.client.force_login(User.objects.create_user('tamper@example.com', password='secret'))
+    self.client.cookies[plan_state.COOKIE_NAME] = signing.dumps(
+      {'lunch_recipe_id': recipe.id}, salt=plan_state.SALT, key='чужой ключ')
+    response = self.client.get(reverse('recipes:recipe_details'))
+    self.assertIsNone(response.context['lunch_recipe'])
+
+  def test_clear_stale_sessions_in_chunks(self):
+    now = timezone.now()
+    for i in range(5):
+      Session.objects.create(session_key=f'old{i}', session_data='', expire_date=now - timedelta(days=1))
+    Session.objects.create(session_key='fresh', session_data='', expire_date=now + timedelta(days=1))
+
+    out = StringIO()
+    with CaptureQueriesContext(connection) as queries:
+      call_command('clear_stale_sessions', '--chunk-size', '2', stdout=out)
+    self.assertIn('Удалено сессий: 5', out.getvalue())
+    self.assertEqual(list(Session.objects.values_list('pk', flat=True)), ['fresh'])
+    self.assertEqual(len([query for query in queries if query['sql'].startswith('DELETE')]), 3)
+
+    call_command('clear_stale_sessions', '--all', stdout=out, stderr=StringIO())
+    self.assertTrue(Session.objects.exists())
+    with self.settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies'):
+      call_command('clear_stale_sessions', '--all', stdout=out)
+    self.assertFalse(Session.objects.exists())
+
+
+class InstrumentationTests(TestCase):
+  def setUp(self):
+    recipe_cache.get_cache().clear()
+    instrumentation.reset_stats()
+    self.recipe = make_recipe('Замеряемый')
+    self.recipe.ingredients.add(make_ingredient('Рис'))
+
+  def logged_requests(self, logs):
+    return [json.loads(record.getMessage()) for record in logs.records]
+
+  def test_request_logged_with_queries_and_size(self):
+    url = reverse('recipes:recipe_card', args=[self.recipe.id])
+    with self.assertLogs('recipes.views', 'DEBUG') as logs, \
+         CaptureQueriesContext(connection) as queries:
+      response = self.client.get(url)
+    line, = self.logged_requests(logs)
+    self.assertEqual(line['view'], 'recipes:recipe_card')
+    self.assertEqual(line['status'], 200)
+    self.assertEqual(line['queries'], len(queries))
+    self.assertEqual(line['response_bytes'], len(response.content))
+    self.assertEqual(logs.records[0].levelname, 'DEBUG')
+
+    with self.settings(RECIPES_SLOW_REQUEST_MS=0), self.assertLogs('recipes.views') as logs:
+      self.client.get(url)
+    self.assertEqual(logs.records[0].levelname, 'WARNING')
+
+  def test_recorder_counts_duplicate_statements(self):
+    with instrumentation.record() as recorder:
+      for recipe_id in range(3):
+        Recipe.objects.filter(pk=recipe_id).exists()
+      Ingredient.objects.exists()
+    self.assertEqual(recorder.queries, 4)
+    self.assertEqual(recorder.duplicates, 2)
+    self.assertEqual(recorder.top_duplicate()[1], 3)
+    self.assertGreater(recorder.db_time, 0)
+
+  async def test_async_view_queries_are_recorded(self):
+    user = await User.objects.acreate_user('metrics@example.com', password='secret')
+    client = AsyncClient()
+    await client.aforce_login(user)
+    with self.assertLogs('recipes.views', 'DEBUG') as logs:
+      await client.post(reverse('recipes:refresh_lunch'))
+    line, = self.logged_requests(logs)
+    self.assertEqual(line['view'], 'recipes:refresh_lunch')
+    self.assertGreater(line['queries'], 0)
+
+  def test_metrics_endpoint(self):
+    self.assertEqual(self.client.get(reverse('recipes:metrics')).status_code, 404)
+
+    self.client.get(reverse('recipes:recipe_card', args=[self.recipe.id]))
+    self.client.get(reverse('recipes:recipe_card', args=[self.recipe.id]))
+    with self.settings(RECIPES_METRICS_TOKEN='s3cret'):
+      response = self.client.get(reverse('recipes:metrics'), headers={'Authorization': 'Bearer s3cret'})
+      for authorization in ('', 'Bearer wrong', 's3cret'):
+        self.assertEqual(self.client.get(reverse('recipes:metrics'),
+                                         headers={'Authorization': authorization}).status_code, 404)
+    self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+    body = response.content.decode()
+    self.assertIn('foodplan_requests_total{view="recipes:recipe_card",method="GET",status="200"} 2',
+                  body)
+    self.assertIn('foodplan_request_duration_seconds_count{view="recipes:recipe_card"} 2', body)
+    self.assertIn('foodplan_db_queries_total{view="recipes:recipe_card"}', body)
+    self.assertNotIn('view="recipes:metrics"', body)
+
+
+class MaxCostValidationTests(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('budget@example.com', password='secret')
+    self.client.force_login(self.user)
+
+  def apply(self, max_cost):
+    self.client.post(reverse('recipes:apply_filters'), {'max_cost': max_cost})
+    return UserProfile.objects.get(user=self.user)
+
+  def test_out_of_range_max_cost_is_dropped(self):
+    for value in ('1e20', '99999999999', '-5', 'NaN'):
+      with self.subTest(value=value):
+        with self.assertLogs('recipes.models', 'WARNING'):
+          profile = self.apply(value)
+        self.assertIsNone(profile.max_cost)
+        for url in (reverse('recipes:recipe_details'), reverse('recipes:lk')):
+          self.assertEqual(self.client.get(url).status_code, 200)
+
+  def test_max_cost_is_rounded_to_kopecks(self):
+    profile = self.apply('12.349')
+    self.assertEqual(profile.max_cost, Decimal('12.35'))
+    self.assertEqual(self.client.get(reverse('recipes:recipe_details')).status_code, 200)
@@ -13,13 +13,16 @@ urlpatterns = [
     path('recipe/card/<int:recipe_id>/', views.recipe_card, name='recipe_card'),
     path('like/<int:recipe_id>/', views.like_recipe, name='like_recipe'),
     path('dislike/<int:recipe_id>/', views.dislike_recipe, name='dislike_recipe'),
+    path('api/preferences/', views.preferences_batch, name='preferences_batch'),
     path('filters/', views.apply_filters, name='apply_filters'),
     path('login/', views.user_login, name='login'),
     path('register/', views.register, name='register'),
     path('logout/', views.user_logout, name='logout'),
     path('lk/', views.lk, name='lk'),
+    path('lk/favorites/', views.lk_favorites, name='lk_favorites'),
     path('refresh-breakfast/', views.refresh_breakfast, name='refresh_breakfast'),
     path('refresh-lunch/', views.refresh_lunch, name='refresh_lunch'),
     path('refresh-dinner/', views.refresh_dinner, name='refresh_dinner'),
+    path('metrics/', views.metrics, name='metrics'),
 
 ]
\ No newline at end of file
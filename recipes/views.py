@@ -1,9 +1,18 @@
+from asgiref.sync import sync_to_async
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.shortcuts import render, redirect, get_object_or_404
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import render, redirect
+from django.urls import reverse
+from django.views.decorators.http import require_POST
+from . import (favorites, images, instrumentation, meal_queue, page_cache, plan_cache, planner,
+               preferences, recipe_cache)
 from .models import Recipe, UserProfile
-import random
+import asyncio
+import hmac
+import json
 import logging
 
 
@@ -11,45 +20,33 @@ logger = logging.getLogger(__name__)
 
 
 def _apply_filters(recipes, filters):
-  if filters.get('low_calorie', False):
-    recipes = recipes.filter(calories__lt=500)
-  if filters.get('is_vegetarian', False):
-    recipes = recipes.filter(is_vegetarian=True)
-  if filters.get('dish_type'):
-    recipes = recipes.filter(dish_type=filters['dish_type'])
-  if filters.get('no_gluten', False):
-    recipes = recipes.filter(no_gluten=True)
-  if filters.get('max_cost'):
-    try:
-      max_cost = float(filters['max_cost'])
-      recipes = recipes.filter(id__in=[r.id for r in recipes
-                                      if r.total_cost() <= max_cost])
-    except (ValueError, TypeError):
-      logger.warning("Invalid max_cost value in filters")
-  return recipes
+  return recipes.matching(filters)
 
 
+@page_cache.cache_anonymous_page
 def index(request):
   return render(request, 'index.html')
 
 
-def recipe_details(request, recipe_id=None):
-  if request.user.is_authenticated:
-    try:
-      profile = UserProfile.objects.get(user=request.user)
-      filters = profile.filters
-      profile.reset_refresh_counts()
-    except UserProfile.DoesNotExist:
-      filters = {}
+async def recipe_details(request, recipe_id=None):
+  user = await request.auser()
+  # Шаблон и context processors читают request.user синхронно
+  request.user = user
+  state = request.plan_state
+  planned_ids = [state.get(f'{meal_type}_recipe_id') for meal_type in planner.MEAL_TYPES]
+
+  # Снимок профиля и блюда из сессии не зависят друг от друга
+  profile = None
+  if user.is_authenticated:
+    profile, recipes = await asyncio.gather(
+      plan_cache.aget(user), recipe_cache.aget_recipes(planned_ids))
+    filters = profile.filters if profile is not None else {}
   else:
-    filters = request.session.get('recipe_filters', {})
+    recipes = await recipe_cache.aget_recipes(planned_ids)
+    filters = state.get('recipe_filters', {})
 
   selected_meal_types = filters.get('meal_types', [])
 
-  breakfast_recipe = None
-  lunch_recipe = None
-  dinner_recipe = None
-
   show_all = not selected_meal_types
 
   user_liked_ids = []
@@ -61,48 +58,41 @@ def recipe_details(request, recipe_id=None):
   remaining_lunch = 3
   remaining_dinner = 3
 
-  if request.user.is_authenticated:
-    try:
-      profile = UserProfile.objects.get(user=request.user)
-      user_liked_ids = list(profile.liked_recipes.values_list('id', flat=True))
-      user_disliked_ids = list(profile.disliked_recipes.values_list('id', flat=True))
-      can_refresh_breakfast = profile.can_refresh_breakfast()
-      can_refresh_lunch = profile.can_refresh_lunch()
-      can_refresh_dinner = profile.can_refresh_dinner()
-      remaining_breakfast = 3 - profile.breakfast_refresh_count
-      remaining_lunch = 3 - profile.lunch_refresh_count
-      remaining_dinner = 3 - profile.dinner_refresh_count
-    except UserProfile.DoesNotExist:
-      pass
-
-
-  if show_all or 'breakfast' in selected_meal_types:
-    breakfast_id = request.session.get('breakfast_recipe_id')
-    if breakfast_id:
-      try:
-        breakfast_recipe = Recipe.objects.get(id=breakfast_id)
-      except Recipe.DoesNotExist:
-        pass
-
-  if show_all or 'lunch' in selected_meal_types:
-    lunch_id = request.session.get('lunch_recipe_id')
-    if lunch_id:
-      try:
-        lunch_recipe = Recipe.objects.get(id=lunch_id)
-      except Recipe.DoesNotExist:
-        pass
-
-  if show_all or 'dinner' in selected_meal_types:
-    dinner_id = request.session.get('dinner_recipe_id')
-    if dinner_id:
-      try:
-        dinner_recipe = Recipe.objects.get(id=dinner_id)
-      except Recipe.DoesNotExist:
-        pass
+  if profile is not None:
+    user_liked_ids = list(profile.liked_ids)
+    user_disliked_ids = list(profile.disliked_ids)
+    if state.get('pending_meals'):
+      await sync_to_async(_replace_pending_meals)(request, profile)
+    breakfast_status, lunch_status, dinner_status = await asyncio.gather(
+      profile.arefresh_status('breakfast'),
+      profile.arefresh_status('lunch'),
+      profile.arefresh_status('dinner'),
+    )
+    can_refresh_breakfast = breakfast_status.allowed
+    can_refresh_lunch = lunch_status.allowed
+    can_refresh_dinner = dinner_status.allowed
+    remaining_breakfast = breakfast_status.remaining
+    remaining_lunch = lunch_status.remaining
+    remaining_dinner = dinner_status.remaining
+
+  meal_ids = {}
+  for meal_type in planner.MEAL_TYPES:
+    if show_all or meal_type in selected_meal_types:
+      meal_ids[meal_type] = state.get(f'{meal_type}_recipe_id')
+  # Дозагружаем блюда, подобранные взамен дизлайкнутых
+  missing_ids = [recipe_id for recipe_id in meal_ids.values()
+                 if recipe_id and recipe_id not in recipes]
+  if missing_ids:
+    recipes.update(await recipe_cache.aget_recipes(missing_ids))
+
+  breakfast_recipe = recipes.get(meal_ids.get('breakfast'))
+  lunch_recipe = recipes.get(meal_ids.get('lunch'))
+  dinner_recipe = recipes.get(meal_ids.get('dinner'))
 
   recipe = lunch_recipe or breakfast_recipe or dinner_recipe
 
-  return render(request, 'recipe-details.html', {
+  # Фрагменты карточек читают кэш синхронно, поэтому рендер — в потоке
+  return await sync_to_async(render)(request, 'recipe-details.html', {
     'recipe': recipe,
     'breakfast_recipe': breakfast_recipe,
     'lunch_recipe': lunch_recipe,
@@ -132,57 +122,82 @@ def recipe_details_reset(request):
   except UserProfile.DoesNotExist:
     pass
 
-  request.session.pop('recipe_filters', None)
-  request.session.pop('breakfast_recipe_id', None)
-  request.session.pop('lunch_recipe_id', None)
-  request.session.pop('dinner_recipe_id', None)
+  request.plan_state.pop('recipe_filters', None)
+  request.plan_state.pop('breakfast_recipe_id', None)
+  request.plan_state.pop('lunch_recipe_id', None)
+  request.plan_state.pop('dinner_recipe_id', None)
 
   return redirect('recipes:recipe_details')
 
+@page_cache.conditional_recipe_page
 def recipe_card(request, recipe_id):
   """Отображает карточку рецепта."""
-  recipe = get_object_or_404(Recipe, id=recipe_id)
+  recipe = page_cache.cached_recipe(request, recipe_id)
+  if recipe is None:
+    raise Http404('Рецепт не найден')
   return render(request, 'recipe-card.html', {'recipe': recipe})
 
 
+async def _profile_and_recipe(request, recipe_id):
+  user = await request.auser()
+  profile, recipe_exists = await asyncio.gather(
+    UserProfile.objects.aget(user=user),
+    Recipe.objects.filter(pk=recipe_id).aexists(),
+  )
+  if not recipe_exists:
+    raise Http404('Рецепт не найден')
+  return profile
+
+
 @login_required
-def like_recipe(request, recipe_id):
+async def like_recipe(request, recipe_id):
   if request.method != 'POST':
     return redirect('recipes:recipe_details')
 
-  recipe = get_object_or_404(Recipe, id=recipe_id)
-  profile = UserProfile.objects.get(user=request.user)
-
-  if recipe in profile.disliked_recipes.all():
-    profile.disliked_recipes.remove(recipe)
-
-  if recipe not in profile.liked_recipes.all():
-    profile.liked_recipes.add(recipe)
+  profile = await _profile_and_recipe(request, recipe_id)
+  await sync_to_async(preferences.like)(profile, recipe_id)
 
   return redirect('recipes:recipe_details')
 
 @login_required
-def dislike_recipe(request, recipe_id):
+async def dislike_recipe(request, recipe_id):
   if request.method != 'POST':
     return redirect('recipes:recipe_details')
 
-  recipe = get_object_or_404(Recipe, id=recipe_id)
-  profile = UserProfile.objects.get(user=request.user)
+  profile = await _profile_and_recipe(request, recipe_id)
+  await sync_to_async(preferences.dislike)(profile, recipe_id)
 
-  if recipe in profile.liked_recipes.all():
-    profile.liked_recipes.remove(recipe)
+  meal_queue.discard(request.plan_state, recipe_id)
+  _defer_replacement(request, recipe_id)
 
-  if recipe not in profile.disliked_recipes.all():
-    profile.disliked_recipes.add(recipe)
+  return redirect('recipes:recipe_details')
 
-  _update_session_recipes(request, recipe)
 
-  return redirect('recipes:recipe_details')
+@login_required
+@require_POST
+def preferences_batch(request):
+  """Пачка лайков и дизлайков, например отложенных офлайн-свайпов.
+
+  Тело: {"events": [{"recipe_id": 1, "action": "like|dislike|clear", "at": "ISO"}]}.
+  """
+  try:
+    events = json.loads(request.body)['events']
+  except (ValueError, KeyError, TypeError):
+    return JsonResponse({'error': 'Ожидается JSON с полем events'}, status=400)
+  if not isinstance(events, list):
+    return JsonResponse({'error': 'events должен быть списком'}, status=400)
+  if len(events) > preferences.MAX_BATCH_SIZE:
+    return JsonResponse(
+      {'error': f'Не больше {preferences.MAX_BATCH_SIZE} событий за запрос'}, status=400)
+
+  profile = UserProfile.objects.get(user=request.user)
+  applied, rejected = preferences.apply_events(profile, events)
+  return JsonResponse({'applied': applied, 'rejected': rejected})
 
 
 
 @login_required
-def apply_filters(request):
+async def apply_filters(request):
     if request.method == 'POST':
         filters = {}
 
@@ -207,38 +222,14 @@ def apply_filters(request):
         if max_cost:
             filters['max_cost'] = max_cost
 
-        profile = UserProfile.objects.get(user=request.user)
-        profile.filters = filters
-        profile.save()
-
-        request.session['recipe_filters'] = filters
-
-
-        if 'breakfast' in meal_types or not meal_types:
-            if profile.can_refresh_breakfast():
-                breakfast_recipes = get_filtered_recipes(filters, meal_type='breakfast', user=request.user)
-                if breakfast_recipes:
-                    new_recipe = random.choice(breakfast_recipes)
-                    request.session['breakfast_recipe_id'] = new_recipe.id
-                    profile.apply_filters_breakfast()
+        request.plan_state['recipe_filters'] = filters
 
-
-        if 'lunch' in meal_types or not meal_types:
-            if profile.can_refresh_lunch():
-                lunch_recipes = get_filtered_recipes(filters, meal_type='lunch', user=request.user)
-                if lunch_recipes:
-                    new_recipe = random.choice(lunch_recipes)
-                    request.session['lunch_recipe_id'] = new_recipe.id
-                    profile.apply_filters_lunch()
-
-
-        if 'dinner' in meal_types or not meal_types:
-            if profile.can_refresh_dinner():
-                dinner_recipes = get_filtered_recipes(filters, meal_type='dinner', user=request.user)
-                if dinner_recipes:
-                    new_recipe = random.choice(dinner_recipes)
-                    request.session['dinner_recipe_id'] = new_recipe.id
-                    profile.apply_filters_dinner()
+        # Подбор и списание лимитов — условные UPDATE, их выполняем в потоке
+        user = await request.auser()
+        plan = await sync_to_async(planner.plan_meals)(user, filters, meal_types)
+        for meal_type, recipe_id in plan.items():
+            request.plan_state[f'{meal_type}_recipe_id'] = recipe_id
+        await sync_to_async(plan_cache.rebuild)(user)
 
         return redirect('recipes:recipe_details')
 
@@ -286,154 +277,123 @@ def user_logout(request):
 @login_required
 def lk(request):
   profile = UserProfile.objects.get(user=request.user)
-  liked_recipes = profile.liked_recipes.all()
+  liked_recipes, next_cursor = favorites.get_page(profile, request.GET.get('cursor'))
   return render(request, 'lk.html', {
     'liked_recipes': liked_recipes,
+    'next_cursor': next_cursor,
     'user': request.user,
     'profile': profile
   })
 
 
 @login_required
-def refresh_breakfast(request):
-  if request.method == 'POST':
-    profile = UserProfile.objects.get(user=request.user)
+def lk_favorites(request):
+  """Следующая страница избранного: HTML-фрагмент или JSON (?format=json)."""
+  profile = UserProfile.objects.get(user=request.user)
+  try:
+    page_size = min(int(request.GET.get('page_size', favorites.PAGE_SIZE)),
+                    favorites.MAX_PAGE_SIZE)
+  except ValueError:
+    page_size = favorites.PAGE_SIZE
+  liked_recipes, next_cursor = favorites.get_page(
+    profile, request.GET.get('cursor'), max(page_size, 1))
+
+  if request.GET.get('format') == 'json':
+    return JsonResponse({
+      'results': [{
+        'id': recipe.id,
+        'name': recipe.name,
+        'calories': recipe.calories,
+        'total_cost': str(recipe.total_cost),
+        'image': recipe.image.url if recipe.image else None,
+        'thumbnail': images.variant(recipe, 'card'),
+        'url': reverse('recipes:recipe_card', args=[recipe.id]),
+      } for recipe in liked_recipes],
+      'next_cursor': next_cursor,
+    })
 
-    if not profile.can_refresh_breakfast():
-      return redirect('recipes:recipe_details')
+  return render(request, 'favorites-page.html', {
+    'liked_recipes': liked_recipes,
+    'next_cursor': next_cursor,
+  })
 
-    filters = request.session.get('recipe_filters', {})
-    breakfast_recipes = get_filtered_recipes(filters, meal_type='breakfast', user=request.user)
 
-    if breakfast_recipes:
-      new_recipe = random.choice(breakfast_recipes)
-      request.session['breakfast_recipe_id'] = new_recipe.id
-      profile.refresh_breakfast()
+async def _refresh_meal(request, meal_type):
+  user = await request.auser()
+  profile, snapshot = await asyncio.gather(
+    UserProfile.objects.aget(user=user),
+    plan_cache.aget(user),
+  )
+  state = request.plan_state
+  filters = state.get('recipe_filters', {})
 
+  if not (await profile.arefresh_status(meal_type)).allowed:
     return redirect('recipes:recipe_details')
-  return redirect('recipes:recipe_details')
-
-
-@login_required
-def refresh_lunch(request):
-  if request.method == 'POST':
-    profile = UserProfile.objects.get(user=request.user)
-
-    if not profile.can_refresh_lunch():
-      return redirect('recipes:recipe_details')
 
-    filters = request.session.get('recipe_filters', {})
-    lunch_recipes = get_filtered_recipes(filters, meal_type='lunch', user=request.user)
+  current_id = state.get(f'{meal_type}_recipe_id')
+  recipe_id = await sync_to_async(meal_queue.pop)(state, meal_type, filters,
+                                                  current_id, snapshot)
 
-    if lunch_recipes:
-      new_recipe = random.choice(lunch_recipes)
-      request.session['lunch_recipe_id'] = new_recipe.id
-      profile.refresh_lunch()
+  if recipe_id and await profile.aconsume_refresh(meal_type):
+    state[f'{meal_type}_recipe_id'] = recipe_id
+    await sync_to_async(plan_cache.store)(profile)
 
-    return redirect('recipes:recipe_details')
   return redirect('recipes:recipe_details')
 
 
 @login_required
-def refresh_dinner(request):
+async def refresh_breakfast(request):
   if request.method == 'POST':
-    profile = UserProfile.objects.get(user=request.user)
-
-    if not profile.can_refresh_dinner():
-      return redirect('recipes:recipe_details')
-
-    filters = request.session.get('recipe_filters', {})
-    dinner_recipes = get_filtered_recipes(filters, meal_type='dinner', user=request.user)
+    return await _refresh_meal(request, 'breakfast')
+  return redirect('recipes:recipe_details')
 
-    if dinner_recipes:
-      new_recipe = random.choice(dinner_recipes)
-      request.session['dinner_recipe_id'] = new_recipe.id
-      profile.refresh_dinner()
 
-    return redirect('recipes:recipe_details')
+@login_required
+async def refresh_lunch(request):
+  if request.method == 'POST':
+    return await _refresh_meal(request, 'lunch')
   return redirect('recipes:recipe_details')
 
 
+@login_required
+async def refresh_dinner(request):
+  if request.method == 'POST':
+    return await _refresh_meal(request, 'dinner')
+  return redirect('recipes:recipe_details')
 
 
-def _update_session_recipes(request, disliked_recipe):
-    filters = request.session.get('recipe_filters', {})
-
-    breakfast_id = request.session.get('breakfast_recipe_id')
-    if breakfast_id == disliked_recipe.id:
-      breakfast_recipes = get_filtered_recipes(filters, meal_type='breakfast', user=request.user)
-      if breakfast_recipes:
-        request.session['breakfast_recipe_id'] = random.choice(breakfast_recipes).id
-      else:
-        request.session.pop('breakfast_recipe_id', None)
-
-    lunch_id = request.session.get('lunch_recipe_id')
-    if lunch_id == disliked_recipe.id:
-      lunch_recipes = get_filtered_recipes(filters, meal_type='lunch', user=request.user)
-      if lunch_recipes:
-        request.session['lunch_recipe_id'] = random.choice(lunch_recipes).id
-      else:
-        request.session.pop('lunch_recipe_id', None)
-
-    dinner_id = request.session.get('dinner_recipe_id')
-    if dinner_id == disliked_recipe.id:
-      dinner_recipes = get_filtered_recipes(filters, meal_type='dinner', user=request.user)
-      if dinner_recipes:
-        request.session['dinner_recipe_id'] = random.choice(dinner_recipes).id
-      else:
-        request.session.pop('dinner_recipe_id', None)
-
-
-def get_filtered_recipes(filters, meal_type=None, user=None):
-  recipes = Recipe.objects.all()
-
-  if user and user.is_authenticated:
-    try:
-      profile = UserProfile.objects.get(user=user)
-      disliked_recipe_ids = profile.disliked_recipes.values_list('id', flat=True)
-      recipes = recipes.exclude(id__in=disliked_recipe_ids)
-    except UserProfile.DoesNotExist:
-      pass
-
-  if meal_type:
-    recipes = recipes.filter(meal_type=meal_type)
-
-  if filters.get('low_calorie'):
-    recipes = recipes.filter(calories__lt=500)
-  if filters.get('is_vegetarian'):
-    recipes = recipes.filter(is_vegetarian=True)
-  if filters.get('no_gluten'):
-    recipes = recipes.filter(no_gluten=True)
-  if filters.get('dish_type'):
-    recipes = recipes.filter(dish_type=filters['dish_type'])
-
-  filtered_recipes = list(recipes)
-
-  if filters.get('max_cost'):
-    try:
-      max_cost = float(filters['max_cost'])
-      filtered_recipes = [r for r in filtered_recipes if r.total_cost <= max_cost]
-    except (ValueError, TypeError):
-      pass
-
-  # Сделал приоритет по весу
-  if user and user.is_authenticated and filtered_recipes:
-    try:
-      profile = UserProfile.objects.get(user=user)
-      liked_recipe_ids = set(profile.liked_recipes.values_list('id', flat=True))
-
-      if liked_recipe_ids:
-        weights = []
-        for recipe in filtered_recipes:
-          if recipe.id in liked_recipe_ids:
-            weights.append(3)
-          else:
-            weights.append(1)
-
-        chosen_recipe = random.choices(filtered_recipes, weights=weights, k=1)[0]
-        return [chosen_recipe]
-
-    except UserProfile.DoesNotExist:
-      pass
-
-  return filtered_recipes
\ No newline at end of file
+def _defer_replacement(request, disliked_recipe_id):
+  """Помечает приемы пищи с дизлайкнутым блюдом; замену подберет recipe_details."""
+  pending = request.plan_state.get('pending_meals', [])
+  for meal_type in planner.MEAL_TYPES:
+    if request.plan_state.get(f'{meal_type}_recipe_id') == disliked_recipe_id and meal_type not in pending:
+      pending.append(meal_type)
+  if pending:
+    request.plan_state['pending_meals'] = pending
+
+
+def _replace_pending_meals(request, snapshot):
+  """Подбирает замены дизлайкнутым блюдам из очередей приемов пищи."""
+  pending = request.plan_state.pop('pending_meals', None)
+  if not pending:
+    return
+  filters = request.plan_state.get('recipe_filters', {})
+  for meal_type in pending:
+    recipe_id = meal_queue.pop(request.plan_state, meal_type, filters,
+                               request.plan_state.get(f'{meal_type}_recipe_id'), snapshot)
+    if recipe_id:
+      request.plan_state[f'{meal_type}_recipe_id'] = recipe_id
+    else:
+      request.plan_state.pop(f'{meal_type}_recipe_id', None)
+
+
+def metrics(request):
+  """Счетчики instrumentation в формате Prometheus по токену RECIPES_METRICS_TOKEN."""
+  token = settings.RECIPES_METRICS_TOKEN
+  if not token:
+    raise Http404
+  scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+  if scheme.lower() != 'bearer' or not hmac.compare_digest(credentials.encode(), token.encode()):
+    raise Http404
+  return HttpResponse(instrumentation.render_metrics(),
+                      content_type='text/plain; version=0.0.4; charset=utf-8')